@@ -0,0 +1,79 @@
+"""Microbenchmark: clip + AdamW step + zero_grad over SD3 LoRA-shaped parameters, per-tensor vs flat buffers.
+
+    python bench_flat_optimizer.py --rank 64 --num_blocks 24 --device cuda
+"""
+
+import argparse
+import time
+
+import torch
+
+from flat_optimizer import flatten_param_groups, fused_adamw_kwargs
+
+
+def make_lora_params(num_blocks, num_modules, hidden_size, rank, device, dtype):
+    params = []
+    for _ in range(num_blocks * num_modules):
+        params.append(torch.nn.Parameter(torch.randn(rank, hidden_size, device=device, dtype=dtype) * 0.01))
+        params.append(torch.nn.Parameter(torch.zeros(hidden_size, rank, device=device, dtype=dtype)))
+    return params
+
+
+def fill_grads(params):
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.randn_like(p)
+        else:
+            p.grad.normal_()
+
+
+def run(params, flat, steps, warmup, device):
+    groups = [{"params": params, "lr": 1e-4}]
+    if flat:
+        groups = flatten_param_groups(groups)
+        optimizer = torch.optim.AdamW(groups, weight_decay=1e-4, **fused_adamw_kwargs(groups))
+        params_to_clip = [p for group in groups for p in group["params"]]
+    else:
+        # Default settings, as the training script uses without `--flat_lora_params` (foreach on CUDA).
+        optimizer = torch.optim.AdamW(groups, weight_decay=1e-4)
+        params_to_clip = params
+
+    elapsed = 0.0
+    for i in range(warmup + steps):
+        fill_grads(params)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        torch.nn.utils.clip_grad_norm_(params_to_clip, 1.0)
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=not flat)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        if i >= warmup:
+            elapsed += time.perf_counter() - start
+    return elapsed / steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_blocks", type=int, default=24)
+    parser.add_argument("--num_modules", type=int, default=8, help="LoRA target modules per transformer block")
+    parser.add_argument("--hidden_size", type=int, default=1536)
+    parser.add_argument("--rank", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    results = {}
+    for flat in (False, True):
+        params = make_lora_params(
+            args.num_blocks, args.num_modules, args.hidden_size, args.rank, args.device, torch.float32
+        )
+        results[flat] = run(params, flat, args.steps, args.warmup, args.device)
+
+    num_tensors = args.num_blocks * args.num_modules * 2
+    print(f"{num_tensors} LoRA tensors, rank {args.rank}, device {args.device}")
+    print(f"per-tensor step: {results[False] * 1000:.2f} ms")
+    print(f"flat step:       {results[True] * 1000:.2f} ms")
+    print(f"speedup:         {results[False] / results[True]:.2f}x")
@@ -0,0 +1,79 @@
+"""Import-time benchmark for the training script, based on `python -X importtime`.
+
+Measures the cumulative import time of `train_text_to_image_lora_sd3` (what every spawned dataloader
+worker pays) and the wall-clock time of `--help`, lists the slowest top-level imports and exits
+with status 1 when the import exceeds `--target_ms`.
+
+    python bench_import_time.py --target_ms 2500
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+MODULE = "train_text_to_image_lora_sd3"
+
+
+def parse_importtime(stderr):
+    """Return `[(cumulative_us, module)]` for the top-level imports in `-X importtime` output."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # Nested imports are indented below their parent, only count the top level.
+        if name.startswith("  "):
+            continue
+        entries.append((int(cumulative), name.strip()))
+    return entries
+
+
+def import_time(runs):
+    best = None
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {MODULE}"],
+            cwd=SCRIPT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        entries = parse_importtime(result.stderr)
+        total = dict((name, us) for us, name in entries).get(MODULE, 0)
+        if best is None or total < best[0]:
+            best = (total, entries)
+    return best
+
+
+def help_time(runs):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, f"{MODULE}.py", "--help"], cwd=SCRIPT_DIR, capture_output=True, check=True
+        )
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target_ms", type=float, default=2500.0, help="maximum cumulative import time of the script")
+    parser.add_argument("--runs", type=int, default=3, help="best of N runs")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    total_us, entries = import_time(args.runs)
+    print(f"import {MODULE}: {total_us / 1000:.1f} ms (target {args.target_ms:.0f} ms)")
+    print(f"{MODULE}.py --help: {help_time(args.runs) * 1000:.1f} ms wall clock")
+    print("slowest top-level imports:")
+    for us, name in sorted(entries, reverse=True)[: args.top]:
+        print(f"  {us / 1000:>9.1f} ms  {name}")
+
+    if total_us / 1000 > args.target_ms:
+        print("FAILED: import time exceeds target")
+        sys.exit(1)
@@ -0,0 +1,112 @@
+"""Benchmark `--noise_samples_per_latent`: transformer samples/s and probe loss reached per wall-clock budget.
+
+Every step fetches `batch_size` images, encodes them with the VAE (plus an optional simulated data
+loading / text encoding delay) and trains the LoRA on `batch_size * M` noisy samples.
+
+    python bench_multi_noise.py --noise_samples 1 4 --seconds 60 --data_ms 50
+"""
+
+import argparse
+import time
+
+import torch
+
+from bench_utils import add_lora, make_tiny_transformer, make_tiny_vae
+from train_text_to_image_lora_sd3 import repeat_for_noise_samples
+
+
+def flow_matching_loss(transformer, latents, noise, sigmas, prompt_embeds, pooled_prompt_embeds):
+    sigmas_ = sigmas.view(-1, 1, 1, 1)
+    noisy = (1.0 - sigmas_) * latents + sigmas_ * noise
+    model_pred = transformer(
+        hidden_states=noisy,
+        timestep=sigmas * 1000.0,
+        encoder_hidden_states=prompt_embeds,
+        pooled_projections=pooled_prompt_embeds,
+        return_dict=False,
+    )[0]
+    return ((model_pred.float() - (noise - latents).float()) ** 2).mean()
+
+
+def run(args, num_samples, images, probe):
+    torch.manual_seed(0)
+    device = args.device
+    vae = make_tiny_vae().to(device).eval()
+    transformer = make_tiny_transformer(num_layers=args.num_layers).to(device)
+    lora_params = add_lora(transformer)
+    optimizer = torch.optim.AdamW(lora_params, lr=1e-3)
+    prompt_embeds = torch.randn(1, 16, 32, device=device)
+    pooled_prompt_embeds = torch.randn(1, 64, device=device)
+
+    steps = 0
+    fetched = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < args.seconds:
+        index = torch.randint(0, images.shape[0], (args.batch_size,))
+        with torch.no_grad():
+            if args.data_ms > 0:
+                time.sleep(args.data_ms / 1000.0)
+            latents = vae.encode(images[index].to(device)).latent_dist.sample()
+        latents = repeat_for_noise_samples(latents, latents.shape[0], num_samples)
+        bsz = latents.shape[0]
+        loss = flow_matching_loss(
+            transformer,
+            latents,
+            torch.randn_like(latents),
+            torch.rand(bsz, device=device),
+            prompt_embeds.expand(bsz, -1, -1),
+            pooled_prompt_embeds.expand(bsz, -1),
+        )
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        steps += 1
+        fetched += args.batch_size
+    elapsed = time.perf_counter() - start
+
+    with torch.no_grad():
+        latents, noise, sigmas = (t.to(device) for t in probe)
+        latents = vae.encode(latents).latent_dist.mean
+        n = latents.shape[0]
+        probe_loss = flow_matching_loss(
+            transformer,
+            latents,
+            noise,
+            sigmas,
+            prompt_embeds.expand(n, -1, -1),
+            pooled_prompt_embeds.expand(n, -1),
+        ).item()
+
+    return {
+        "steps": steps,
+        "fetched/s": fetched / elapsed,
+        "samples/s": fetched * num_samples / elapsed,
+        "probe_loss": probe_loss,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--noise_samples", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--seconds", type=float, default=30.0, help="wall-clock training budget per setting")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--num_layers", type=int, default=2)
+    parser.add_argument("--data_ms", type=float, default=0.0, help="simulated data loading/encoding delay per step")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(1)
+    images = torch.rand(64, 3, 64, 64, generator=generator) * 2 - 1
+    probe = (
+        images[:16],
+        torch.randn(16, 4, 32, 32, generator=generator),
+        torch.linspace(0.05, 0.95, 16),
+    )
+
+    print(f"{'M':>4} {'steps':>8} {'fetched/s':>10} {'samples/s':>10} {'probe loss':>11}")
+    for num_samples in args.noise_samples:
+        result = run(args, num_samples, images, probe)
+        print(
+            f"{num_samples:>4} {result['steps']:>8} {result['fetched/s']:>10.2f} {result['samples/s']:>10.2f}"
+            f" {result['probe_loss']:>11.4f}"
+        )
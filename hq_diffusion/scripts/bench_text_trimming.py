@@ -0,0 +1,72 @@
+"""Benchmark `--text_seq_bucket_size`: transformer step time with padded vs trimmed text sequences.
+
+A padded SD3 prompt is 77 CLIP + `max_sequence_length` T5 tokens. A ~5 token prompt trimmed with a
+bucket size of 8 is 8 + 8 tokens.
+
+    python bench_text_trimming.py --max_sequence_length 77 --bucket_size 8 --latent_size 64
+"""
+
+import argparse
+
+import torch
+
+from bench_utils import Timer, add_lora, make_tiny_transformer
+
+
+def step_time(transformer, text_len, args, train):
+    device = args.device
+    latents = torch.randn(args.batch_size, 4, args.latent_size, args.latent_size, device=device)
+    prompt_embeds = torch.randn(args.batch_size, text_len, 32, device=device)
+    pooled_prompt_embeds = torch.randn(args.batch_size, 64, device=device)
+    timesteps = torch.full((args.batch_size,), 500.0, device=device)
+
+    def step():
+        with torch.set_grad_enabled(train):
+            out = transformer(
+                hidden_states=latents,
+                timestep=timesteps,
+                encoder_hidden_states=prompt_embeds,
+                pooled_projections=pooled_prompt_embeds,
+                return_dict=False,
+            )[0]
+            if train:
+                out.float().pow(2).mean().backward()
+
+    for _ in range(args.warmup):
+        step()
+    with Timer(device) as timer:
+        for _ in range(args.steps):
+            step()
+    return timer.elapsed / args.steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max_sequence_length", type=int, default=77)
+    parser.add_argument("--bucket_size", type=int, default=8)
+    parser.add_argument("--prompt_tokens", type=int, default=5, help="real tokens in the prompt (incl. special tokens)")
+    parser.add_argument("--latent_size", type=int, default=64)
+    parser.add_argument("--num_layers", type=int, default=4)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    transformer = make_tiny_transformer(num_layers=args.num_layers, sample_size=args.latent_size).to(args.device)
+    add_lora(transformer)
+
+    trimmed_segment = -(-args.prompt_tokens // args.bucket_size) * args.bucket_size
+    padded_len = 77 + args.max_sequence_length
+    trimmed_len = min(77, trimmed_segment) + min(args.max_sequence_length, trimmed_segment)
+    image_tokens = (args.latent_size // 2) ** 2
+    print(f"image tokens: {image_tokens}, text tokens padded: {padded_len}, trimmed: {trimmed_len}")
+
+    for train in (True, False):
+        padded = step_time(transformer, padded_len, args, train)
+        trimmed = step_time(transformer, trimmed_len, args, train)
+        phase = "train step" if train else "inference step"
+        print(
+            f"{phase:>15}: padded {padded * 1000:.2f} ms, trimmed {trimmed * 1000:.2f} ms,"
+            f" speedup {padded / trimmed:.2f}x"
+        )
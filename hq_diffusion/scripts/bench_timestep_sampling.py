@@ -0,0 +1,115 @@
+"""Benchmark `--timestep_sampling`: optimizer steps needed to reach a target probe loss.
+
+Each mode trains the same miniature LoRA from the same initialization and evaluates the flow matching
+loss on a fixed-noise, fixed-timestep probe set every `--probe_steps` steps. The target defaults to
+the best probe loss reached by the 'independent' baseline.
+
+    python bench_timestep_sampling.py --steps 400 --probe_steps 10
+"""
+
+import argparse
+
+import torch
+from diffusers import FlowMatchEulerDiscreteScheduler
+from diffusers.training_utils import compute_density_for_timestep_sampling
+
+from bench_utils import add_lora, make_tiny_transformer
+from timestep_sampling import TimestepSampler
+
+
+def per_sample_loss(transformer, latents, noise, indices, scheduler, prompt_embeds, pooled_prompt_embeds):
+    sigmas = scheduler.sigmas[indices].to(latents).view(-1, 1, 1, 1)
+    noisy = (1.0 - sigmas) * latents + sigmas * noise
+    bsz = latents.shape[0]
+    model_pred = transformer(
+        hidden_states=noisy,
+        timestep=scheduler.timesteps[indices].to(latents.device),
+        encoder_hidden_states=prompt_embeds.expand(bsz, -1, -1),
+        pooled_projections=pooled_prompt_embeds.expand(bsz, -1),
+        return_dict=False,
+    )[0]
+    return ((model_pred.float() - (noise - latents).float()) ** 2).reshape(bsz, -1).mean(1)
+
+
+def run(args, mode, data, probe):
+    torch.manual_seed(0)
+    device = args.device
+    scheduler = FlowMatchEulerDiscreteScheduler(num_train_timesteps=1000, shift=3.0)
+    transformer = make_tiny_transformer(num_layers=args.num_layers).to(device)
+    optimizer = torch.optim.AdamW(add_lora(transformer), lr=args.learning_rate)
+    prompt_embeds = torch.randn(1, 16, 32, device=device)
+    pooled_prompt_embeds = torch.randn(1, 64, device=device)
+
+    def density(batch_size):
+        return compute_density_for_timestep_sampling(weighting_scheme="logit_normal", batch_size=batch_size)
+
+    sampler = None
+    if mode != "independent":
+        sampler = TimestepSampler.from_density(density, 1000, device=device, mode=mode, num_buckets=args.buckets)
+
+    curve = []
+    for step in range(1, args.steps + 1):
+        latents = data[torch.randint(0, data.shape[0], (args.batch_size,))].to(device)
+        if sampler is not None:
+            indices, weights = sampler.sample(args.batch_size)
+            indices = indices.cpu()
+        else:
+            indices = (density(args.batch_size) * 1000).long()
+            weights = torch.ones(args.batch_size, device=device)
+        losses = per_sample_loss(
+            transformer, latents, torch.randn_like(latents), indices, scheduler, prompt_embeds, pooled_prompt_embeds
+        )
+        if sampler is not None:
+            sampler.update(indices.to(device), losses)
+        (losses * weights).mean().backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+        if step % args.probe_steps == 0:
+            with torch.no_grad():
+                latents, noise, indices = (t.to(device) for t in probe)
+                probe_loss = per_sample_loss(
+                    transformer, latents, noise, indices.cpu(), scheduler, prompt_embeds, pooled_prompt_embeds
+                ).mean()
+            curve.append((step, probe_loss.item()))
+    return curve
+
+
+def steps_to_target(curve, target):
+    for step, loss in curve:
+        if loss <= target:
+            return step
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", type=str, nargs="+", default=["independent", "stratified", "importance"])
+    parser.add_argument("--steps", type=int, default=400)
+    parser.add_argument("--probe_steps", type=int, default=10)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--buckets", type=int, default=20)
+    parser.add_argument("--learning_rate", type=float, default=1e-3)
+    parser.add_argument("--num_layers", type=int, default=2)
+    parser.add_argument("--target_loss", type=float, default=None)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(1)
+    data = torch.randn(64, 4, 32, 32, generator=generator)
+    probe = (
+        data[:16],
+        torch.randn(16, 4, 32, 32, generator=generator),
+        torch.linspace(0, 999, 16).long(),
+    )
+
+    curves = {mode: run(args, mode, data, probe) for mode in args.modes}
+    target = args.target_loss
+    if target is None:
+        target = min(loss for _, loss in curves.get("independent", next(iter(curves.values()))))
+
+    print(f"target probe loss: {target:.5f}")
+    for mode, curve in curves.items():
+        step = steps_to_target(curve, target)
+        best = min(loss for _, loss in curve)
+        print(f"{mode:>12}: best probe loss {best:.5f}, steps to target {step if step is not None else 'not reached'}")
@@ -0,0 +1,76 @@
+"""Miniature SD3 components and timing helpers shared by the `bench_*.py` scripts.
+
+The miniature models use the same classes as the real ones, so the benchmarks exercise the real
+code paths on a CPU or a small GPU.
+"""
+
+import time
+
+import torch
+
+
+def make_tiny_transformer(num_layers=2, sample_size=32, joint_attention_dim=32, pooled_projection_dim=64):
+    from diffusers import SD3Transformer2DModel
+
+    return SD3Transformer2DModel(
+        sample_size=sample_size,
+        patch_size=2,
+        in_channels=4,
+        num_layers=num_layers,
+        attention_head_dim=8,
+        num_attention_heads=4,
+        joint_attention_dim=joint_attention_dim,
+        caption_projection_dim=32,
+        pooled_projection_dim=pooled_projection_dim,
+        out_channels=4,
+    )
+
+
+def make_tiny_vae():
+    from diffusers import AutoencoderKL
+
+    return AutoencoderKL(
+        block_out_channels=[32, 64],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+        up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"],
+        latent_channels=4,
+    )
+
+
+def add_lora(transformer, rank=4):
+    from peft import LoraConfig
+
+    transformer.requires_grad_(False)
+    transformer.add_adapter(
+        LoraConfig(
+            r=rank,
+            lora_alpha=rank,
+            init_lora_weights="gaussian",
+            target_modules=["attn.to_k", "attn.to_q", "attn.to_v", "attn.to_out.0"],
+        )
+    )
+    return [p for p in transformer.parameters() if p.requires_grad]
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+class Timer:
+    """Context manager measuring wall-clock seconds, synchronizing CUDA on entry and exit."""
+
+    def __init__(self, device="cpu"):
+        self.device = device
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        synchronize(self.device)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        synchronize(self.device)
+        self.elapsed = time.perf_counter() - self.start
@@ -0,0 +1,54 @@
+"""Pack the LoRA parameters into one contiguous buffer per (device, dtype).
+
+With the default `target_modules` and a high `--rank`, training touches hundreds of small LoRA
+tensors, and gradient clipping and the optimizer step launch kernels for each of them. After
+`flatten_param_groups`, every LoRA parameter (and its `.grad`) is a view into a single flat
+tensor, so the optimizer, grad-norm and clipping run over a handful of large tensors instead.
+The model keeps its original parameters and sees every optimizer update through the views.
+
+Gradients must be zeroed in place (`optimizer.zero_grad(set_to_none=False)`), otherwise the
+gradient views held by the model parameters are lost.
+"""
+
+import torch
+
+
+def _flatten(params):
+    reference = params[0]
+    numel = sum(p.numel() for p in params)
+    flat = torch.nn.Parameter(torch.empty(numel, dtype=reference.dtype, device=reference.device))
+    flat.grad = torch.zeros_like(flat)
+
+    offset = 0
+    for p in params:
+        n = p.numel()
+        flat.data[offset : offset + n].copy_(p.data.view(-1))
+        p.data = flat.data[offset : offset + n].view_as(p)
+        p.grad = flat.grad[offset : offset + n].view_as(p)
+        offset += n
+    return flat
+
+
+def flatten_param_groups(param_groups):
+    """Return optimizer param groups whose `params` are flat buffers backing the original parameters.
+
+    Each group is split by (device, dtype) and keeps its other options (`lr`, `weight_decay`, ...).
+    Must be called before the model is wrapped for distributed training.
+    """
+    flat_groups = []
+    for group in param_groups:
+        params_by_key = {}
+        for p in group["params"]:
+            params_by_key.setdefault((p.device, p.dtype), []).append(p)
+        flat_group = dict(group)
+        flat_group["params"] = [_flatten(params) for params in params_by_key.values()]
+        flat_groups.append(flat_group)
+    return flat_groups
+
+
+def fused_adamw_kwargs(param_groups):
+    """Select the fastest multi-tensor implementation of `torch.optim.AdamW` for the given params."""
+    params = [p for group in param_groups for p in group["params"]]
+    if params and all(p.device.type == "cuda" and p.dtype.is_floating_point for p in params):
+        return {"fused": True}
+    return {"foreach": True}
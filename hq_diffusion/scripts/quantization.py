@@ -0,0 +1,116 @@
+"""Weight-only quantization of the frozen transformer used for LoRA training.
+
+Only the LoRA adapters are trained, so the base `Linear` weights can be stored in a compact
+format and dequantized on the fly inside `forward`. `Int8Linear` subclasses `torch.nn.Linear`
+so PEFT still recognises it as a LoRA target and wraps it as the `base_layer`.
+"""
+
+import torch
+import torch.nn.functional as F
+
+
+def _dequantize(weight, weight_scale, dtype):
+    return weight.to(dtype) * weight_scale.to(dtype)[:, None]
+
+
+class _Int8LinearFunction(torch.autograd.Function):
+    """`F.linear` with an int8 weight that saves only the int8 weight and its scale for backward.
+
+    With plain `F.linear(input, dequantized_weight)` autograd keeps the dequantized weight alive until
+    backward whenever the input requires grad (always the case below a LoRA layer), so every quantized
+    layer would hold a full-precision copy of its weight at peak memory. Here the weight is dequantized
+    again in backward instead.
+    """
+
+    @staticmethod
+    def forward(ctx, input, weight, weight_scale, bias):
+        ctx.save_for_backward(weight, weight_scale)
+        ctx.input_dtype = input.dtype
+        ctx.has_bias = bias is not None
+        return F.linear(input, _dequantize(weight, weight_scale, input.dtype), bias)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        weight, weight_scale = ctx.saved_tensors
+        grad_input = grad_bias = None
+        if ctx.needs_input_grad[0]:
+            grad_input = (grad_output @ _dequantize(weight, weight_scale, grad_output.dtype)).to(ctx.input_dtype)
+        if ctx.has_bias and ctx.needs_input_grad[3]:
+            grad_bias = grad_output.reshape(-1, grad_output.shape[-1]).sum(dim=0)
+        return grad_input, None, None, grad_bias
+
+
+class Int8Linear(torch.nn.Linear):
+    """`torch.nn.Linear` whose weight is stored as int8 with a per-output-channel absmax scale.
+
+    The weight is dequantized to the input dtype for every forward pass (and again in backward,
+    so only the int8 weight is saved for it), so it works on any device that supports `F.linear`
+    (including CPU). Calls such as `module.to(dtype=...)` only
+    cast the floating point scale and bias; the int8 weight keeps its dtype.
+    """
+
+    def __init__(self, in_features, out_features, bias=True, device=None, dtype=None):
+        # Skip `nn.Linear.__init__` to avoid allocating a full-precision weight.
+        torch.nn.Module.__init__(self)
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = torch.nn.Parameter(
+            torch.empty(out_features, in_features, dtype=torch.int8, device=device), requires_grad=False
+        )
+        self.register_buffer("weight_scale", torch.ones(out_features, dtype=dtype or torch.float32, device=device))
+        if bias:
+            self.bias = torch.nn.Parameter(
+                torch.zeros(out_features, dtype=dtype or torch.float32, device=device), requires_grad=False
+            )
+        else:
+            self.register_parameter("bias", None)
+
+    @classmethod
+    def from_linear(cls, linear):
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+        module = cls(
+            linear.in_features,
+            linear.out_features,
+            bias=linear.bias is not None,
+            device=weight.device,
+            dtype=linear.weight.dtype,
+        )
+        module.weight.data = torch.round(weight / scale[:, None]).clamp(-127, 127).to(torch.int8)
+        module.weight_scale.copy_(scale.to(linear.weight.dtype))
+        if linear.bias is not None:
+            module.bias.data = linear.bias.detach().clone()
+        return module
+
+    def dequantize(self, dtype=None):
+        return _dequantize(self.weight, self.weight_scale, dtype or self.weight_scale.dtype)
+
+    def forward(self, input):
+        bias = self.bias.to(input.dtype) if self.bias is not None else None
+        return _Int8LinearFunction.apply(input, self.weight, self.weight_scale, bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}, int8"
+
+
+def quantize_linear_weights(model, modules_to_convert=("transformer_blocks",)):
+    """Replace `torch.nn.Linear` layers under the given submodule prefixes with `Int8Linear`.
+
+    Must be called before LoRA adapters are added. Returns `(num_converted, bytes_before, bytes_after)`.
+    """
+    num_converted = 0
+    bytes_before = 0
+    bytes_after = 0
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            full_name = f"{name}.{child_name}" if name else child_name
+            if type(child) is not torch.nn.Linear:
+                continue
+            if not any(full_name == prefix or full_name.startswith(prefix + ".") for prefix in modules_to_convert):
+                continue
+            quantized = Int8Linear.from_linear(child)
+            setattr(module, child_name, quantized)
+            bytes_before += child.weight.numel() * child.weight.element_size()
+            bytes_after += quantized.weight.numel() + quantized.weight_scale.numel() * quantized.weight_scale.element_size()
+            num_converted += 1
+    return num_converted, bytes_before, bytes_after
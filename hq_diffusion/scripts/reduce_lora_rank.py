@@ -0,0 +1,182 @@
+"""Shrink a trained LoRA adapter with a per-module truncated SVD of its update `B @ A`.
+
+The adapters are trained at `--rank=64` with `lora_alpha == rank`, so each module's update is
+exactly `B @ A` and the saved file carries no alpha. The update has rank at most `r`, so its SVD
+is computed from the small `r x r` core of the QR decompositions of `B` and `A^T` instead of the
+full `out x in` matrix. The kept singular values are split evenly between the new factors
+(`B' = U sqrt(S)`, `A' = sqrt(S) V^T`). With `--energy` every module gets its own rank, so the output
+carries diffusers' `lora_adapter_metadata` with a `rank_pattern` and an `alpha_pattern` that keep
+`lora_alpha == rank` (scale 1) for every module; without it diffusers would infer one rank and alpha
+for the whole adapter and rescale the other modules. It loads with `load_lora_weights` like any
+adapter saved by `StableDiffusion3Pipeline.save_lora_weights`.
+
+    python reduce_lora_rank.py --input lora/pytorch_lora_weights.safetensors --output lora-r16 --rank 16
+    python reduce_lora_rank.py --input lora --output lora-e99 --energy 0.99 --report report.json
+"""
+
+import argparse
+import collections
+import json
+import os
+
+import torch
+from safetensors.torch import load_file, save_file
+
+
+WEIGHT_NAME = "pytorch_lora_weights.safetensors"
+LORA_ADAPTER_METADATA_KEY = "lora_adapter_metadata"
+
+
+def lora_pairs(state_dict):
+    """Group a LoRA state dict into `{module_prefix: (lora_A, lora_B)}`. Other keys are returned separately."""
+    pairs = {}
+    others = {}
+    for key, value in state_dict.items():
+        for part in ("lora_A", "lora_B"):
+            marker = f".{part}."
+            if marker in key:
+                prefix = key.split(marker)[0]
+                pairs.setdefault(prefix, {})[part] = value
+                break
+        else:
+            others[key] = value
+    incomplete = [prefix for prefix, pair in pairs.items() if len(pair) != 2]
+    if incomplete:
+        raise ValueError(f"Modules without both lora_A and lora_B weights: {incomplete[:5]}")
+    return {prefix: (pair["lora_A"], pair["lora_B"]) for prefix, pair in pairs.items()}, others
+
+
+def low_rank_svd(lora_A, lora_B):
+    """SVD of `lora_B @ lora_A` without forming it. Returns `(U, S, Vh)` with `len(S) <= r`."""
+    q_b, r_b = torch.linalg.qr(lora_B)
+    q_a, r_a = torch.linalg.qr(lora_A.T)
+    u, s, vh = torch.linalg.svd(r_b @ r_a.T)
+    return q_b @ u, s, vh @ q_a.T
+
+
+def rank_for_energy(singular_values, energy):
+    """Smallest rank whose singular values keep at least `energy` of the squared Frobenius norm."""
+    squared = singular_values**2
+    total = squared.sum()
+    if total == 0:
+        return 1
+    cumulative = torch.cumsum(squared, dim=0) / total
+    return int(torch.searchsorted(cumulative, torch.tensor(energy, device=cumulative.device))) + 1
+
+
+def reduce_lora_rank(state_dict, rank=None, energy=None, max_rank=None, device="cpu"):
+    """
+    Truncate every LoRA module of `state_dict` to `rank`, or to the smallest rank keeping `energy` of the update.
+
+    Returns `(reduced_state_dict, report)`, where `report` has one entry per module with the old and new rank, the
+    retained energy and the relative Frobenius error of the truncated update.
+    """
+    if (rank is None) == (energy is None):
+        raise ValueError("Specify exactly one of `rank` and `energy`.")
+
+    pairs, others = lora_pairs(state_dict)
+    reduced = dict(others)
+    report = []
+    for prefix, (lora_A, lora_B) in pairs.items():
+        dtype = lora_A.dtype
+        u, s, vh = low_rank_svd(lora_A.to(device, torch.float32), lora_B.to(device, torch.float32))
+        new_rank = rank if rank is not None else rank_for_energy(s, energy)
+        if max_rank is not None:
+            new_rank = min(new_rank, max_rank)
+        new_rank = max(1, min(new_rank, s.shape[0]))
+
+        sqrt_s = s[:new_rank].sqrt()
+        reduced[f"{prefix}.lora_A.weight"] = (sqrt_s[:, None] * vh[:new_rank]).to("cpu", dtype).contiguous()
+        reduced[f"{prefix}.lora_B.weight"] = (u[:, :new_rank] * sqrt_s[None, :]).to("cpu", dtype).contiguous()
+
+        total = (s**2).sum().item()
+        dropped = (s[new_rank:] ** 2).sum().item()
+        report.append(
+            {
+                "module": prefix,
+                "rank": lora_A.shape[0],
+                "new_rank": new_rank,
+                "energy": 1.0 - dropped / total if total > 0 else 1.0,
+                "relative_error": (dropped / total) ** 0.5 if total > 0 else 0.0,
+            }
+        )
+    return reduced, report
+
+
+def adapter_metadata(report):
+    """diffusers' `lora_adapter_metadata` (PEFT `LoraConfig` kwargs per component) for the reduced adapter.
+
+    The most common rank becomes `r`, the others go to `rank_pattern`, and the alphas mirror the ranks.
+    """
+    ranks_by_component = {}
+    for entry in report:
+        component, module = entry["module"].split(".", 1)
+        ranks_by_component.setdefault(component, {})[module] = entry["new_rank"]
+
+    metadata = {}
+    for component, ranks in ranks_by_component.items():
+        r = collections.Counter(ranks.values()).most_common(1)[0][0]
+        rank_pattern = {module: rank for module, rank in ranks.items() if rank != r}
+        config = {
+            "r": r,
+            "lora_alpha": r,
+            "rank_pattern": rank_pattern,
+            "alpha_pattern": dict(rank_pattern),
+            "target_modules": sorted(ranks),
+            "use_dora": False,
+            "lora_bias": False,
+        }
+        metadata.update({f"{component}.{key}": value for key, value in config.items()})
+    return metadata
+
+
+def save_reduced(reduced, report, output_path):
+    metadata = {
+        "format": "pt",
+        LORA_ADAPTER_METADATA_KEY: json.dumps(adapter_metadata(report), indent=2, sort_keys=True),
+    }
+    save_file(reduced, output_path, metadata=metadata)
+
+
+def num_bytes(state_dict):
+    return sum(t.numel() * t.element_size() for t in state_dict.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reduce the rank of a saved LoRA adapter with truncated SVDs.")
+    parser.add_argument("--input", type=str, required=True, help="LoRA .safetensors file or the directory holding it")
+    parser.add_argument("--output", type=str, required=True, help="output directory (or .safetensors file)")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--rank", type=int, default=None, help="target rank for every module")
+    group.add_argument("--energy", type=float, default=None, help="fraction of each update's energy to keep, e.g. 0.99")
+    parser.add_argument("--max_rank", type=int, default=None, help="upper bound on the rank chosen by --energy")
+    parser.add_argument("--report", type=str, default=None, help="write the per-module report to this JSON file")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    if args.energy is not None and not 0.0 < args.energy <= 1.0:
+        parser.error("--energy must be in (0, 1].")
+
+    input_path = os.path.join(args.input, WEIGHT_NAME) if os.path.isdir(args.input) else args.input
+    output_path = args.output if args.output.endswith(".safetensors") else os.path.join(args.output, WEIGHT_NAME)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+
+    state_dict = load_file(input_path)
+    reduced, report = reduce_lora_rank(
+        state_dict, rank=args.rank, energy=args.energy, max_rank=args.max_rank, device=args.device
+    )
+    save_reduced(reduced, report, output_path)
+
+    width = max(len(entry["module"]) for entry in report)
+    for entry in report:
+        print(
+            f"{entry['module']:<{width}}  rank {entry['rank']:>3} -> {entry['new_rank']:>3}"
+            f"  energy {entry['energy']:.4f}  rel. error {entry['relative_error']:.4f}"
+        )
+    worst = max(report, key=lambda entry: entry["relative_error"])
+    print(f"{len(report)} modules, worst relative error {worst['relative_error']:.4f} ({worst['module']})")
+    print(f"{num_bytes(state_dict) / 2**20:.1f} MiB -> {num_bytes(reduced) / 2**20:.1f} MiB, saved to {output_path}")
+
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
@@ -7,18 +7,26 @@ SD3 Inpainting Flask Web应用
 import os
 import sys
 import torch
-import numpy as np
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, render_template, request, jsonify, send_from_directory, Response, stream_with_context
 from PIL import Image
-import io
 import base64
+import json
 import diffusers
-from diffusers.pipelines import StableDiffusion3InpaintPipeline
 from diffusers.utils import numpy_to_pil
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import traceback
-import gc
 import PIL.Image
+from model_manager import ModelManager
+from job_queue import JobCancelled, JobQueue, QueueFullError
+from prompt_cache import PromptEmbeddingCache
+from image_store import ImageExpiredError, ImageStore
+from model_worker import DEFAULT_AUTHKEY, ModelWorkerUnavailable, RemoteBackend
+from memory_model import MemoryModel, available_bytes
+from mask_regions import (
+    calculate_auto_padding, crop_region_box, fill_model_input, paste_region, region_mask_crop, split_mask_regions,
+)
+from mask_utils import decode_mask, mask_bbox
 
 # 获取应用根目录
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -39,6 +47,52 @@ pipe = None
 device = "cuda" if torch.cuda.is_available() else "cpu"
 use_cpu_offload = False  # 是否启用CPU offload以节省显存
 MODEL_INPUT_SIZE = 512  # 模型输入图像尺寸
+TEXT_SEQ_BUCKET_SIZE = 8  # 文本token序列裁剪到批内最长提示词并按此粒度向上取整，None表示补齐到最大长度
+MAX_SEQUENCE_LENGTH = 256  # T5最大token长度（与pipeline默认值一致）
+RESULT_IMAGE_FORMAT = 'png'  # 结果图片格式：'png'、'webp'（无损）或 'jpeg'，请求中可用 result_format 覆盖
+RESULT_PNG_COMPRESS_LEVEL = 1  # PNG压缩级别，1编码最快，文件稍大
+RESULT_JPEG_QUALITY = 95
+RESULT_FORMATS = {
+    'png': ('PNG', '.png', {'compress_level': RESULT_PNG_COMPRESS_LEVEL}),
+    'webp': ('WEBP', '.webp', {'lossless': True, 'method': 0}),
+    'jpeg': ('JPEG', '.jpg', {'quality': RESULT_JPEG_QUALITY}),
+}
+SSE_KEEPALIVE_SECONDS = 15  # 任务事件流没有新事件时，每隔多久发一次进度（保持连接）
+IMAGE_STORE_MAX_MB = 2048  # 已上传原图（解码后）的缓存上限
+# 生产模式：设置后模型由独立的模型工作进程（model_worker.py）持有，本进程只处理HTTP请求，通过此Unix socket调用
+MODEL_WORKER_SOCKET = os.environ.get('SD3_MODEL_WORKER_SOCKET')
+MODEL_WORKER_AUTHKEY = os.environ.get('SD3_MODEL_WORKER_AUTHKEY', DEFAULT_AUTHKEY).encode()
+IMAGE_STORE_DIR = os.path.join(app.config['UPLOAD_FOLDER'], 'images')  # 生产模式下各进程共享上传原图的目录
+IMAGE_STORE_DIR_MAX_MB = 10240  # 共享目录中上传原图文件的总大小上限，超出后删除最久未用的文件
+PROMPT_CACHE_SIZE = 64  # 提示词embedding缓存条数，0表示不缓存
+TEXT_ENCODER_OFFLOAD = None  # 文本编码器平时放在CPU，只在缓存未命中时移到GPU：'t5' 只移出T5（约10GB），'all' 全部，None 常驻GPU
+SPLIT_MASK_REGIONS = True  # 按连通区域分别裁剪修复（每个区域用自己的padding），请求中可用 split_regions 覆盖
+REGION_MERGE_DISTANCE = 32  # 外接矩形间距不超过此像素数的区域合并成一个
+MAX_MASK_REGIONS = 16  # 区域数超过上限时退回到整体裁剪
+REGION_FEATHER_RADIUS = 0  # 区域结果贴回原图时的掩码羽化半径，0为硬边
+DEFAULT_BATCH_SIZE = 4  # 显存模型未标定时（如CPU上运行）每批生成的张数
+MAX_BATCH_SIZE = 16  # 每批生成张数的上限，实际batch由显存模型按可用显存选择
+MEMORY_SAFETY_MARGIN = 0.1  # 选择batch时保留的可用显存比例
+MAX_QUEUED_JOBS = 8  # 排队中的生成任务上限，超出后拒绝新任务
+# 跨请求合批：参数兼容的排队任务合并到同一次去噪调用（MICRO_BATCH_MAX_JOBS=1 关闭合批）
+MICRO_BATCH_WINDOW_MS = int(os.environ.get('MICRO_BATCH_WINDOW_MS', 50))  # 凑批的最长等待时间
+MICRO_BATCH_MAX_JOBS = int(os.environ.get('MICRO_BATCH_MAX_JOBS', 4))  # 一组最多合并的任务数
+ADAPTER_GPU_BUDGET_GB = 2.0  # 常驻GPU的LoRA权重上限，超出后最久未用的移到CPU
+ADAPTER_CPU_BUDGET_GB = 8.0  # 放在CPU内存的LoRA权重上限，超出后从模型删除，需要时从文件重新加载
+model_manager = ModelManager(  # 常驻基础模型和LoRA adapter
+    device,
+    gpu_budget_bytes=int(ADAPTER_GPU_BUDGET_GB * 1024**3),
+    cpu_budget_bytes=int(ADAPTER_CPU_BUDGET_GB * 1024**3),
+    text_encoder_offload=TEXT_ENCODER_OFFLOAD,
+)
+prompt_cache = PromptEmbeddingCache(PROMPT_CACHE_SIZE)
+memory_model = MemoryModel(MEMORY_SAFETY_MARGIN, MAX_BATCH_SIZE)  # 加载模型时标定
+image_store = ImageStore(
+    IMAGE_STORE_MAX_MB * 1024**2,
+    IMAGE_STORE_DIR if MODEL_WORKER_SOCKET else None,
+    max_file_bytes=IMAGE_STORE_DIR_MAX_MB * 1024**2,
+)
+result_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='result-writer')  # 结果图片在GPU生成下一批时写入
 
 
 
@@ -46,69 +100,138 @@ def release_model_memory():
     """释放模型占用的显存"""
     global pipe
     
-    print("正在释放模型显存...")
+    # 先去掉全局引用，模型管理器才能真正释放pipeline
+    pipe = None
+    model_manager.release_base()
+    memory_model.reset()
+
+def calibrate_memory_model(pipe):
+    """用模型输入尺寸跑几组不同batch的短探测，标定生成的显存模型（需持有模型管理器的锁）
     
-    # 删除pipeline
-    if pipe is not None:
-        try:
-            # 将模型移到CPU
-            if hasattr(pipe, 'to'):
-                pipe.to('cpu')
-            
-            # 删除各个组件
-            if hasattr(pipe, 'transformer'):
-                del pipe.transformer
-            if hasattr(pipe, 'vae'):
-                del pipe.vae
-            if hasattr(pipe, 'text_encoder'):
-                del pipe.text_encoder
-            if hasattr(pipe, 'text_encoder_2'):
-                del pipe.text_encoder_2
-            if hasattr(pipe, 'text_encoder_3'):
-                del pipe.text_encoder_3
-            if hasattr(pipe, 'tokenizer'):
-                del pipe.tokenizer
-            if hasattr(pipe, 'tokenizer_2'):
-                del pipe.tokenizer_2
-            if hasattr(pipe, 'tokenizer_3'):
-                del pipe.tokenizer_3
-            
-            del pipe
-            pipe = None
-        except Exception as e:
-            print(f"释放pipeline时出错: {e}")
+    探测用补齐到最大长度的提示词embedding，估算值对长提示词也成立。
+    """
+    with torch.no_grad():
+        prompt_kwargs = encode_prompt_trimmed(pipe, 'defect of crack', '', True, None)
     
-    # 清理GPU缓存
-    if device == "cuda":
-        torch.cuda.empty_cache()
-        torch.cuda.ipc_collect()
+    def run_probe(batch, height, width, steps):
+        image = Image.new('RGB', (width, height), (128, 128, 128))
+        mask = Image.new('L', (width, height), 0)
+        mask.paste(255, (width // 4, height // 4, width * 3 // 4, height * 3 // 4))
+        with torch.no_grad():
+            pipe(
+                image=[image] * batch,
+                mask_image=[mask] * batch,
+                num_images_per_prompt=1,
+                guidance_scale=7.0,
+                num_inference_steps=steps,
+                height=height,
+                width=width,
+                **{key: value.repeat_interleave(batch, dim=0) for key, value in prompt_kwargs.items()}
+            )
+    
+    memory_model.calibrate(run_probe, MODEL_INPUT_SIZE, MODEL_INPUT_SIZE)
+    print(f"显存模型标定完成: {memory_model.status()}")
+
+def _bucketed_length(attention_mask, bucket_size):
+    """批内最长的真实token长度，按bucket_size向上取整"""
+    longest = max(sum(mask) for mask in attention_mask)
+    return min(len(attention_mask[0]), max(1, -(-longest // bucket_size)) * bucket_size)
+
+def encode_prompts_cached(pipe, prompts, negative_prompts, do_classifier_free_guidance):
+    """编码提示词（未裁剪），命中缓存的直接复用，未命中的一起编码后写入缓存
+
+    Returns:
+        tuple: (prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds)，
+            与 pipe.encode_prompt 相同，batch为提示词个数；不使用CFG时negative为None
+    """
+    identity = model_manager.text_encoder_identity()
+    keys = [
+        (identity, prompt, negative_prompt if do_classifier_free_guidance else None, do_classifier_free_guidance, MAX_SEQUENCE_LENGTH)
+        for prompt, negative_prompt in zip(prompts, negative_prompts)
+    ]
+    unique_keys = list(dict.fromkeys(keys))
+    entries = {key: prompt_cache.get(key) for key in unique_keys}
+    missing = [key for key in unique_keys if entries[key] is None]
     
-    # 强制垃圾回收
-    gc.collect()
+    if missing:
+        with model_manager.text_encoders_on_device():
+            encoded = pipe.encode_prompt(
+                prompt=[key[1] for key in missing],
+                prompt_2=None,
+                prompt_3=None,
+                negative_prompt=[key[2] for key in missing] if do_classifier_free_guidance else None,
+                device=pipe._execution_device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=do_classifier_free_guidance,
+                max_sequence_length=MAX_SEQUENCE_LENGTH,
+            )
+        for i, key in enumerate(missing):
+            entries[key] = tuple(None if t is None else t[i:i + 1] for t in encoded)
+            prompt_cache.put(key, entries[key])
     
-    print("显存释放完成")
+    return tuple(
+        None if entries[keys[0]][i] is None else torch.cat([entries[key][i] for key in keys])
+        for i in range(4)
+    )
+
+def encode_prompt_trimmed(pipe, prompt, negative_prompt, do_classifier_free_guidance, bucket_size):
+    """编码提示词，并裁掉CLIP和T5序列末尾的填充token
+
+    SD3的联合注意力会在每个block里处理全部文本token，短提示词（如"defect of crack"）
+    补齐到 77 + 256 个token后大部分都是填充。CLIP是因果注意力、T5完整长度编码后再裁剪，
+    所以真实token的embedding不受影响。正负提示词裁剪到相同长度以便CFG拼接。
+
+    prompt / negative_prompt 可以是字符串，也可以是等长的列表（合批时多个请求的提示词一起编码，
+    裁剪到其中最长的提示词）。bucket_size为None时不裁剪。
+
+    Returns:
+        dict: 可直接传给pipeline的 prompt_embeds / pooled_prompt_embeds（及negative版本），batch为提示词个数
+    """
+    prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+    if isinstance(negative_prompt, (list, tuple)):
+        negative_prompts = [p or "" for p in negative_prompt]
+    else:
+        negative_prompts = [negative_prompt or ""] * len(prompts)
+    prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds = encode_prompts_cached(
+        pipe, prompts, negative_prompts, do_classifier_free_guidance
+    )
+    
+    result = {
+        'prompt_embeds': prompt_embeds,
+        'pooled_prompt_embeds': pooled_prompt_embeds,
+    }
+    if do_classifier_free_guidance:
+        result['negative_prompt_embeds'] = negative_prompt_embeds
+        result['negative_pooled_prompt_embeds'] = negative_pooled_prompt_embeds
+    if bucket_size is None:
+        return result
+    
+    texts = prompts + negative_prompts if do_classifier_free_guidance else prompts
+    clip_max_length = pipe.tokenizer_max_length
+    clip_mask = pipe.tokenizer(texts, padding="max_length", max_length=clip_max_length, truncation=True).attention_mask
+    clip_length = _bucketed_length(clip_mask, bucket_size)
+    if pipe.tokenizer_3 is not None and pipe.text_encoder_3 is not None:
+        t5_mask = pipe.tokenizer_3(
+            texts, padding="max_length", max_length=MAX_SEQUENCE_LENGTH, truncation=True
+        ).attention_mask
+        t5_length = _bucketed_length(t5_mask, bucket_size)
+    else:
+        # 没有T5时pipeline用全零embedding占位，保持原长度
+        t5_length = prompt_embeds.shape[1] - clip_max_length
+    
+    def trim(embeds):
+        return torch.cat([embeds[:, :clip_length], embeds[:, clip_max_length:clip_max_length + t5_length]], dim=1)
+    
+    result['prompt_embeds'] = trim(prompt_embeds)
+    if do_classifier_free_guidance:
+        result['negative_prompt_embeds'] = trim(negative_prompt_embeds)
+    return result
 
 def process_mask_from_base64(original_image, mask_base64):
-    """从base64编码的掩码图像中提取掩码"""
+    """从base64编码的掩码图像中提取掩码（单通道解码、uint8阈值化、最近邻缩放到原图尺寸）"""
     try:
-        # 解码base64图像
-        mask_data = base64.b64decode(mask_base64.split(',')[1])
-        mask_image = Image.open(io.BytesIO(mask_data)).convert("RGB")
-        
-        # 确保尺寸匹配
-        if mask_image.size != original_image.size:
-            mask_image = mask_image.resize(original_image.size, Image.Resampling.LANCZOS)
-        
-        # 将RGB掩码转换为单通道掩码（白色区域=要inpaint的区域）
-        mask_array = np.array(mask_image)
-        # 将非黑色区域转换为白色（掩码）
-        mask_gray = np.mean(mask_array, axis=2)
-        mask = (mask_gray > 10).astype(np.uint8) * 255
-        
-        # 转换为单通道灰度图（Inpaint Pipeline 使用单通道掩码）
-        mask_image = Image.fromarray(mask, mode='L')
-        
-        return mask_image
+        # 非黑色区域为掩码（白色区域=要inpaint的区域），Inpaint Pipeline 使用单通道掩码
+        return decode_mask(mask_base64, original_image.size)
     except Exception as e:
         print(f"处理掩码时出错: {str(e)}")
         traceback.print_exc()
@@ -121,52 +244,11 @@ def calculate_mask_bbox(mask_image):
         tuple: (x, y, width, height) 或 None（如果没有掩码）
     """
     try:
-        mask_array = np.array(mask_image)
-        # 找到所有非零像素的位置
-        coords = np.column_stack(np.where(mask_array > 10))
-        
-        if len(coords) == 0:
-            return None
-        
-        # 计算边界框
-        y_min, x_min = coords.min(axis=0)
-        y_max, x_max = coords.max(axis=0)
-        
-        x = int(x_min)
-        y = int(y_min)
-        width = int(x_max - x_min + 1)
-        height = int(y_max - y_min + 1)
-        
-        return (x, y, width, height)
+        return mask_bbox(mask_image)
     except Exception as e:
         print(f"计算掩码边界框时出错: {str(e)}")
         return None
 
-def calculate_auto_padding(bbox, model_size=512):
-    """根据掩码外接矩形的最长边计算padding大小
-    
-    Args:
-        bbox: (x, y, width, height) 掩码外接矩形
-        model_size: 模型输入尺寸（默认512）
-    
-    Returns:
-        int: padding大小，使得裁剪后的区域最长边等于model_size
-    """
-    if bbox is None:
-        return 0
-    
-    x, y, width, height = bbox
-    max_side = max(width, height)
-    
-    if max_side >= model_size:
-        # 如果最长边已经大于等于模型尺寸，不需要padding
-        return 0
-    
-    # 计算需要的padding，使得最长边等于model_size
-    padding = (model_size - max_side) // 2
-    
-    return padding
-
 @app.route('/')
 def index():
     """主页面"""
@@ -189,7 +271,7 @@ def debug():
         'local_ip': local_ip,
         'flask_host': '0.0.0.0',
         'flask_port': 5000,
-        'model_loaded': pipe is not None,
+        'model_loaded': backend.model_loaded(),
         'static_folder': app.static_folder,
         'template_folder': app.template_folder,
     }
@@ -255,12 +337,8 @@ def debug():
 
 @app.route('/api/load_models', methods=['POST'])
 def load_models():
-    """加载模型API"""
-    global pipe
-    
+    """加载模型API（上传的文件保存在本进程，加载由模型后端执行）"""
     try:
-        # 在加载新模型之前，释放旧的模型和显存
-        release_model_memory()
         data = request.form
         
         # 获取文件路径（优先使用路径输入，否则使用上传的文件）
@@ -296,73 +374,8 @@ def load_models():
         if not sd3_path:
             return jsonify({'success': False, 'message': '请提供SD3模型路径或上传文件'}), 400
         
-        # 加载SD3 Inpaint pipeline
-        print(f"正在加载SD3 Inpaint pipeline: {sd3_path}")
-        pipe = StableDiffusion3InpaintPipeline.from_single_file(
-            sd3_path,
-            torch_dtype=torch.bfloat16 if device == "cuda" else torch.float32
-        )
-        
-        # 加载LoRA权重（如果提供）
-        if lora_path and os.path.exists(lora_path):
-            print(f"正在加载LoRA权重: {lora_path}")
-            pipe.load_lora_weights(lora_path)
-        
-        # 将模型移动到GPU并设置精度
-        if device == "cuda":
-            pipe.text_encoder.to(torch.bfloat16)
-            pipe.text_encoder_2.to(torch.bfloat16)
-            pipe.text_encoder_3.to(torch.bfloat16)
-        
-        # 检查是否需要使用CPU offload（如果显存不足）
-        global use_cpu_offload
-        if device == "cuda":
-            # 检查可用显存
-            total_memory = torch.cuda.get_device_properties(0).total_memory / 1024**3
-            if total_memory < 24:  # 如果GPU显存小于24GB，启用CPU offload
-                try:
-                    # 注意：enable_model_cpu_offload需要模型在CPU上
-                    pipe.enable_model_cpu_offload()
-                    use_cpu_offload = True
-                    print("已启用 CPU offload 以节省显存")
-                except Exception as e:
-                    print(f"启用CPU offload失败: {e}，将使用GPU模式")
-                    pipe = pipe.to(device)
-                    use_cpu_offload = False
-            else:
-                pipe = pipe.to(device)
-                use_cpu_offload = False
-            
-            # 启用attention slicing以减少显存使用
-            try:
-                pipe.enable_attention_slicing()
-                print("已启用 attention slicing")
-            except:
-                pass
-            
-            # 启用VAE slicing以减少VAE显存使用
-            try:
-                pipe.enable_vae_slicing()
-                print("已启用 VAE slicing")
-            except:
-                pass
-        else:
-            pipe = pipe.to(device)
-        
-        # 清理一次缓存，确保显存使用正常
-        memory_info = ""
-        if device == "cuda":
-            torch.cuda.empty_cache()
-            # 显示显存使用情况
-            allocated = torch.cuda.memory_allocated() / 1024**3
-            reserved = torch.cuda.memory_reserved() / 1024**3
-            memory_info = f" (GPU显存: {allocated:.2f} GB)"
-            print(f"GPU显存使用: 已分配 {allocated:.2f} GB, 已保留 {reserved:.2f} GB")
-        
-        return jsonify({
-            'success': True,
-            'message': f'模型加载成功！{memory_info}'
-        })
+        result = backend.load_models(sd3_path, lora_path, (data.get('adapter_name') or '').strip() or None)
+        return jsonify({'success': True, **result})
     
     except Exception as e:
         error_msg = f"加载模型时出错: {str(e)}"
@@ -373,24 +386,139 @@ def load_models():
             'message': error_msg
         }), 500
 
+@app.route('/api/unload_lora', methods=['POST'])
+def unload_lora():
+    """卸载LoRA adapter（不指定名称时卸载当前adapter），基础模型保持加载"""
+    try:
+        data = request.json or {}
+        name = data.get('adapter')
+        if name is None:
+            active = backend.adapter_state()['active']
+            if len(active) == 1:
+                name = next(iter(active))
+        if name is None:
+            return jsonify({'success': False, 'message': '请指定要卸载的LoRA adapter'}), 400
+        status = backend.unload_adapter(name)
+        return jsonify({'success': True, 'message': f'已卸载LoRA: {name}', **status})
+    except KeyError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        error_msg = f"卸载LoRA时出错: {str(e)}"
+        print(error_msg)
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': error_msg}), 500
+
+@app.route('/api/load_adapter', methods=['POST'])
+def load_adapter():
+    """在已加载的基础模型上追加一个LoRA adapter（不改变当前生效的adapter）"""
+    try:
+        data = request.json or {}
+        lora_path = (data.get('lora_path') or '').strip()
+        if not lora_path or not os.path.exists(lora_path):
+            return jsonify({'success': False, 'message': f'LoRA路径不存在: {lora_path}'}), 400
+        if not backend.model_loaded():
+            return jsonify({'success': False, 'message': '请先加载模型！'}), 400
+        name, status = backend.load_adapter(lora_path, (data.get('adapter_name') or '').strip() or None)
+        return jsonify({'success': True, 'message': f'已加载LoRA: {name}', 'adapter': name, **status})
+    except Exception as e:
+        error_msg = f"加载LoRA时出错: {str(e)}"
+        print(error_msg)
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': error_msg}), 500
+
+@app.route('/api/adapters', methods=['GET'])
+def list_adapters():
+    """列出已加载的LoRA adapter及其位置（gpu/cpu/disk）和当前权重"""
+    return jsonify({'success': True, **backend.adapter_status()})
+
+def parse_adapter_selection(data):
+    """解析请求中的adapter选择
+
+    - 'adapter': 单个adapter名称
+    - 'adapters': {名称: 权重} 或 [{'name': 名称, 'weight': 权重}, ...]，按权重混合
+    都没有时返回None，表示沿用当前生效的adapter
+    """
+    if data.get('adapters'):
+        adapters = data['adapters']
+        if isinstance(adapters, dict):
+            return {str(name): float(weight) for name, weight in adapters.items()}
+        return {str(item['name']): float(item.get('weight', 1.0)) for item in adapters}
+    if data.get('adapter'):
+        return {str(data['adapter']): 1.0}
+    return None
+
+@app.route('/api/upload_image', methods=['POST'])
+def upload_image():
+    """上传原图（文件原始字节），解码后按内容哈希缓存，返回图片id"""
+    try:
+        if 'image' in request.files:
+            data = request.files['image'].read()
+        else:
+            data = request.get_data()
+        if not data:
+            return jsonify({'success': False, 'message': '请提供图片文件'}), 400
+        
+        image_id, image = image_store.put_bytes(data)
+        return jsonify({
+            'success': True,
+            'image_id': image_id,
+            'width': image.width,
+            'height': image.height
+        })
+    except Exception as e:
+        error_msg = f"上传图片时出错: {str(e)}"
+        print(error_msg)
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': error_msg}), 500
+
+def image_expired_response():
+    return jsonify({
+        'success': False,
+        'image_expired': True,
+        'message': '图片已过期，请重新上传'
+    }), 404
+
+def get_original_image(data):
+    """从请求中取原始图像：优先使用已上传的 'image_id'，兼容base64的 'original_image'
+    
+    base64传入的图片也放进图片缓存，提交任务时统一只传图片id。
+    
+    Returns:
+        tuple: (图片id, PIL.Image, None) 或 (None, None, 错误响应)；图片id已被淘汰时错误响应带 'image_expired'，前端应重新上传
+    """
+    image_id = data.get('image_id')
+    if image_id:
+        image = image_store.get(image_id)
+        if image is None:
+            return None, None, image_expired_response()
+        return image_id, image, None
+    
+    original_image_base64 = data.get('original_image')
+    if not original_image_base64:
+        return None, None, (jsonify({
+            'success': False,
+            'message': '请提供原始图片和掩码'
+        }), 400)
+    image_id, image = image_store.put_bytes(base64.b64decode(original_image_base64.split(',')[1]))
+    return image_id, image, None
+
 @app.route('/api/calculate_mask_info', methods=['POST'])
 def calculate_mask_info():
     """计算掩码外接矩形和自动padding"""
     try:
         data = request.json
-        original_image_base64 = data.get('original_image')
         mask_image_base64 = data.get('mask_image')
         
-        if not original_image_base64 or not mask_image_base64:
+        # 获取原始图像（已上传的图片id或base64）
+        image_id, original_image, error = get_original_image(data)
+        if error is not None:
+            return error
+        if not mask_image_base64:
             return jsonify({
                 'success': False,
                 'message': '请提供原始图片和掩码'
             }), 400
         
-        # 解码原始图像
-        original_data = base64.b64decode(original_image_base64.split(',')[1])
-        original_image = Image.open(io.BytesIO(original_data)).convert("RGB")
-        
         # 处理掩码
         mask_image = process_mask_from_base64(original_image, mask_image_base64)
         if mask_image is None:
@@ -411,6 +539,7 @@ def calculate_mask_info():
         
         # 计算自动padding
         auto_padding = calculate_auto_padding(bbox, MODEL_INPUT_SIZE)
+        _, regions = split_mask_regions(mask_image, REGION_MERGE_DISTANCE, MAX_MASK_REGIONS)
         
         return jsonify({
             'success': True,
@@ -421,6 +550,10 @@ def calculate_mask_info():
                 'height': height
             },
             'auto_padding': auto_padding,
+            'regions': [
+                {'bbox': region['bbox'], 'auto_padding': calculate_auto_padding(region['bbox'], MODEL_INPUT_SIZE)}
+                for region in regions
+            ],
             'model_input_size': MODEL_INPUT_SIZE
         })
     except Exception as e:
@@ -434,10 +567,12 @@ def calculate_mask_info():
 
 @app.route('/api/generate', methods=['POST'])
 def generate():
-    """生成缺陷图像API"""
-    global pipe
-    
-    if pipe is None:
+    """提交生成缺陷图像任务API
+
+    请求线程只解码图片和掩码并提交任务，立即返回任务id，生成由GPU工作线程执行。
+    传入 'wait': true 时阻塞到任务结束并直接返回结果（供脚本调用）。
+    """
+    if not backend.model_loaded():
         return jsonify({
             'success': False,
             'message': '请先加载模型！'
@@ -447,7 +582,6 @@ def generate():
         data = request.json
         
         # 获取参数
-        original_image_base64 = data.get('original_image')
         mask_image_base64 = data.get('mask_image')
         prompt = data.get('prompt', 'defect of crack')
         negative_prompt = data.get('negative_prompt', '')
@@ -455,17 +589,41 @@ def generate():
         guidance_scale = float(data.get('guidance_scale', 7.0))
         num_inference_steps = int(data.get('num_inference_steps', 28))
         padding_mask_crop = data.get('padding_mask_crop')  # 可以是 None 或数字
+        split_regions = bool(data.get('split_regions', SPLIT_MASK_REGIONS))
+        try:
+            adapter_selection = parse_adapter_selection(data)
+        except (TypeError, ValueError, KeyError) as e:
+            return jsonify({'success': False, 'message': f'adapter参数格式错误: {e}'}), 400
+        adapter_state = backend.adapter_state()
+        if adapter_selection is not None:
+            unknown = [name for name in adapter_selection if name not in adapter_state['names']]
+            if unknown:
+                return jsonify({'success': False, 'message': f"未加载的LoRA adapter: {', '.join(unknown)}"}), 400
+        else:
+            # 未指定时使用提交时生效的LoRA
+            adapter_selection = adapter_state['active']
+        result_format = data.get('result_format') or RESULT_IMAGE_FORMAT
+        if result_format not in RESULT_FORMATS:
+            return jsonify({'success': False, 'message': f'不支持的结果格式: {result_format}'}), 400
+        seed = data.get('seed')
+        seed = int(seed) if seed is not None else int(torch.randint(0, 2**31 - 1, (1,)).item())
+        padding = None
+        if padding_mask_crop is not None:
+            try:
+                padding = int(padding_mask_crop) if int(padding_mask_crop) > 0 else None
+            except (ValueError, TypeError):
+                pass  # 忽略无效的值
         
-        if not original_image_base64 or not mask_image_base64:
+        # 获取原始图像（已上传的图片id或base64）
+        image_id, original_image, error = get_original_image(data)
+        if error is not None:
+            return error
+        if not mask_image_base64:
             return jsonify({
                 'success': False,
                 'message': '请提供原始图片和掩码'
             }), 400
         
-        # 解码原始图像
-        original_data = base64.b64decode(original_image_base64.split(',')[1])
-        original_image = Image.open(io.BytesIO(original_data)).convert("RGB")
-        
         # 处理掩码
         mask_image = process_mask_from_base64(original_image, mask_image_base64)
         if mask_image is None:
@@ -477,172 +635,582 @@ def generate():
         # 计算掩码外接矩形和裁剪区域信息（用于前端显示）
         bbox = calculate_mask_bbox(mask_image)
         crop_info = None
-        if bbox and padding_mask_crop is not None:
-            try:
-                padding = int(padding_mask_crop)
-                if padding > 0:
-                    x, y, width, height = bbox
-                    # 计算裁剪区域（带padding）
-                    crop_x = max(0, x - padding)
-                    crop_y = max(0, y - padding)
-                    crop_width = min(original_image.width - crop_x, width + 2 * padding)
-                    crop_height = min(original_image.height - crop_y, height + 2 * padding)
-                    crop_info = {
-                        'x': crop_x,
-                        'y': crop_y,
-                        'width': crop_width,
-                        'height': crop_height
-                    }
-            except (ValueError, TypeError):
-                pass
+        regions = None
+        if bbox and split_regions:
+            regions = prepare_mask_regions(original_image, mask_image, padding)
+            crop_info = [
+                {'x': x1, 'y': y1, 'width': x2 - x1, 'height': y2 - y1}
+                for _, _, (x1, y1, x2, y2) in regions
+            ]
+        elif bbox and padding:
+            x, y, width, height = bbox
+            # 计算裁剪区域（带padding）
+            crop_x = max(0, x - padding)
+            crop_y = max(0, y - padding)
+            crop_width = min(original_image.width - crop_x, width + 2 * padding)
+            crop_height = min(original_image.height - crop_y, height + 2 * padding)
+            crop_info = {
+                'x': crop_x,
+                'y': crop_y,
+                'width': crop_width,
+                'height': crop_height
+            }
         
-        # 检查显存是否足够（基于每批4张的显存需求）
-        batch_size = 4  # 每批最多生成4张
-        if device == "cuda":
-            # 强制同步，确保所有操作完成
-            torch.cuda.synchronize()
-            # 先清理一次显存
-            torch.cuda.empty_cache()
-            torch.cuda.ipc_collect()
-            gc.collect()
-            
-            allocated = torch.cuda.memory_allocated() / 1024**3
-            reserved = torch.cuda.memory_reserved() / 1024**3
-            total = torch.cuda.get_device_properties(0).total_memory / 1024**3
-            free = total - reserved
-            print(f"生成前显存状态: 已分配 {allocated:.2f} GB, 已保留 {reserved:.2f} GB, 总计 {total:.2f} GB, 空闲 {free:.2f} GB")
-            
-            # 每批4张需要的显存（根据 padding_mask_crop 调整）
-            base_memory_per_batch = 5.0  # 基础显存需求
-            if padding_mask_crop is not None:
-                try:
-                    padding_mask_crop_int = int(padding_mask_crop)
-                    if padding_mask_crop_int > 0:
-                        base_memory_per_batch += 2.0  # padding_mask_crop 需要额外显存
-                except (ValueError, TypeError):
-                    pass
-            
-            # 检查单批是否能生成
-            if free < base_memory_per_batch * 0.7:
-                return jsonify({
-                    'success': False,
-                    'message': f'显存严重不足！需要至少 {base_memory_per_batch:.1f} GB 来生成一批图片，但只有 {free:.2f} GB 可用。建议：1) 重启应用释放显存 2) 使用更小的图片 3) 不使用 padding_mask_crop'
-                }), 400
-        
-        print(f"开始分批生成，总共 {num_images} 张，每批 {batch_size} 张，参数: prompt={prompt}, guidance_scale={guidance_scale}")
-        
-        # 分批生成图像
-        result_images = []
-        total_batches = (num_images + batch_size - 1) // batch_size  # 向上取整
-        
-        for batch_idx in range(total_batches):
-            # 计算当前批次要生成的数量
-            current_batch_size = min(batch_size, num_images - len(result_images))
-            print(f"正在生成第 {batch_idx + 1}/{total_batches} 批，本批生成 {current_batch_size} 张...")
-            
-            # 清理显存缓存
-            if device == "cuda":
-                torch.cuda.synchronize()
-                torch.cuda.empty_cache()
-                gc.collect()
+        # 准入检查：模型加载后的可用显存连一张图都生成不了时直接拒绝，不进入队列
+        needed = backend.admission_shortfall(guidance_scale > 1)
+        if needed is not None:
+            return jsonify({
+                'success': False,
+                'message': f'显存不足！生成一张图片约需要 {needed:.1f} GB。建议：1) 卸载不用的LoRA 2) 启用文本编码器offload 3) 重启应用释放显存'
+            }), 503
+        
+        try:
+            job = backend.submit({
+                'original_image_id': image_id,
+                'mask_image': mask_image,
+                'prompt': prompt,
+                'negative_prompt': negative_prompt,
+                'num_images': num_images,
+                'guidance_scale': guidance_scale,
+                'num_inference_steps': num_inference_steps,
+                'padding': padding,
+                'regions': regions,
+                'seed': seed,
+                'result_format': result_format,
+                'adapter_selection': adapter_selection,
+                'crop_info': crop_info,
+                'bbox': bbox,
+            })
+        except QueueFullError as e:
+            return jsonify({'success': False, 'message': str(e)}), 429
+        except ImageExpiredError:
+            return image_expired_response()
+        
+        if data.get('wait'):
+            version = -1
+            while True:
+                state = backend.wait_for_update(job['job_id'], version, SSE_KEEPALIVE_SECONDS)
+                if state is None or state['done']:
+                    break
+                version = state['version']
+            return job_result(job['job_id'])
+        
+        return jsonify({
+            'success': True,
+            'message': '任务已提交',
+            'job_id': job['job_id'],
+            'status': job['status'],
+            'queue_position': job['queue_position'],
+            'crop_info': crop_info,  # 裁剪区域信息（如果有）
+            'bbox': bbox  # 掩码外接矩形信息（如果有）
+        })
+    
+    except Exception as e:
+        error_msg = f"提交生成任务时出错: {str(e)}"
+        print(error_msg)
+        traceback.print_exc()
+        return jsonify({
+            'success': False,
+            'message': error_msg
+        }), 500
+
+def generation_batch_key(job):
+    """可以合并到同一次去噪调用的任务：引导强度、推理步数和LoRA选择相同（模型输入尺寸是全局的）"""
+    params = job.params
+    return (
+        params['guidance_scale'],
+        params['num_inference_steps'],
+        tuple(sorted(params['adapter_selection'].items())),
+    )
+
+def prepare_inpaint_input(pipe, image, mask_image, padding):
+    """按 padding_mask_crop 的规则裁剪原图和掩码
+    
+    与pipeline内部的处理一致：掩码外接矩形外扩padding，并扩展到模型输入的宽高比。
+    在pipeline外裁剪后，不同请求（裁剪区域各不相同）的图像就可以放进同一批。
+    
+    Returns:
+        tuple: (裁剪后的原图, 裁剪后的掩码, crops_coords)，不裁剪时crops_coords为None
+    """
+    if not padding:
+        return image, mask_image, None
+    crops_coords = pipe.mask_processor.get_crop_region(mask_image, MODEL_INPUT_SIZE, MODEL_INPUT_SIZE, pad=padding)
+    return image.crop(crops_coords), mask_image.crop(crops_coords), crops_coords
+
+def prepare_mask_regions(image, mask_image, padding=None):
+    """按连通区域拆分掩码并裁剪每个区域的模型输入
+    
+    每个区域的padding为 padding（指定时）或按该区域外接矩形计算的自动padding。
+    
+    Returns:
+        list: [(裁剪后的原图, 裁剪框内只属于该区域的掩码, crops_coords), ...]
+    """
+    labels, regions = split_mask_regions(mask_image, REGION_MERGE_DISTANCE, MAX_MASK_REGIONS)
+    inputs = []
+    for region in regions:
+        pad = padding if padding else calculate_auto_padding(region['bbox'], MODEL_INPUT_SIZE)
+        crops_coords = crop_region_box(
+            region['bbox'], pad, image.width, image.height, MODEL_INPUT_SIZE, MODEL_INPUT_SIZE
+        )
+        inputs.append((image.crop(crops_coords), region_mask_crop(labels, region, crops_coords), crops_coords))
+    return inputs
+
+def save_result_images(batch_outputs):
+    """在写入线程中保存一批结果图片，写完后追加到对应任务的 result_ids 并通知订阅者
+    
+    Args:
+        batch_outputs: [(任务, PIL.Image, 不带扩展名的文件名), ...]
+    """
+    for job, img, filename in batch_outputs:
+        image_format, extension, save_kwargs = RESULT_FORMATS[job.params['result_format']]
+        result_id = filename + extension
+        img.save(os.path.join(app.config['OUTPUT_FOLDER'], result_id), format=image_format, **save_kwargs)
+        job.result_ids.append(result_id)
+        job.progress['images_done'] = len(job.result_ids)
+        job.notify()
+
+def run_generation(jobs):
+    """在GPU工作线程中执行一组兼容的生成任务
+    
+    所有任务要生成的图像展开成槽位后统一分批，一次去噪调用可以包含来自不同请求的图像，
+    每张图带着自己的原图、掩码、提示词embedding和随机数生成器，结果再按任务拆分。
+    按连通区域拆分的任务，每张图的每个区域各占一个槽位，全部区域贴回原图后才输出这张图。
+    执行期间持有模型管理器的锁，加载/切换模型不会和生成交错。
+    每个去噪步结束时更新任务进度，批内所有任务都被取消时中断pipeline。
+    每批结果交给写入线程保存（只编码一次），写完即追加到任务的 result_ids，订阅者可以立即取到。
+    """
+    guidance_scale = jobs[0].params['guidance_scale']
+    num_inference_steps = jobs[0].params['num_inference_steps']
+    outputs = [0] * len(jobs)  # 每个任务已生成的图片数
+    running = []  # 当前批次包含的任务
+    writes = []
+    # 任务id前缀避免同一秒内的任务互相覆盖
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    
+    def on_step_end(pipeline, step, timestep, callback_kwargs):
+        for job in running:
+            job.progress['step'] = step + 1
+            job.progress['total_steps'] = pipeline.num_timesteps
+            job.notify()
+        if all(job.cancel_requested.is_set() for job in running):
+            pipeline._interrupt = True
+        return callback_kwargs
+    
+    with model_manager.lock:
+        pipe = model_manager.pipe
+        if pipe is None:
+            raise RuntimeError('请先加载模型！')
+        
+        # 切换到这组任务选择的LoRA（已常驻的adapter只调用set_adapters，不重新加载）
+        model_manager.activate(jobs[0].params['adapter_selection'])
+        
+        # 每个任务的裁剪输入：按区域拆分的任务每个区域一份，否则整体一份
+        inputs = [
+            job.params['regions'] or [
+                prepare_inpaint_input(pipe, job.params['original_image'], job.params['mask_image'], job.params['padding'])
+            ]
+            for job in jobs
+        ]
+        # 裁剪的模型输入（等比缩放到模型尺寸，与贴回时的缩放互逆）；贴回仍用裁剪框大小的掩码
+        model_inputs = [
+            [
+                fill_model_input(pipe, image, mask, MODEL_INPUT_SIZE, MODEL_INPUT_SIZE) if crops_coords else (image, mask)
+                for image, mask, crops_coords in job_inputs
+            ]
+            for job_inputs in inputs
+        ]
+        
+        # 所有任务的提示词一起编码一次，各批次按任务索引取用
+        with torch.no_grad():
+            prompt_kwargs = encode_prompt_trimmed(
+                pipe,
+                [job.params['prompt'] for job in jobs],
+                [job.params['negative_prompt'] for job in jobs],
+                guidance_scale > 1,
+                TEXT_SEQ_BUCKET_SIZE,
+            )
+        
+        # 展开成 (任务索引, 图像序号, 区域序号) 槽位并统一分批，同一张图的各区域在同一次或相邻的去噪调用里生成
+        slots = [
+            (j, i, r)
+            for j, job in enumerate(jobs)
+            for i in range(job.params['num_images'])
+            for r in range(len(inputs[j]))
+        ]
+        composites = {}  # (任务索引, 图像序号) -> [正在拼合的结果图, 还没贴回的区域数]
+        
+        # 按显存模型和当前可用显存（已含提示词embedding和LoRA）选择最大的安全batch
+        cfg = guidance_scale > 1
+        if memory_model.calibrated:
+            batch_size = memory_model.max_batch(MODEL_INPUT_SIZE, MODEL_INPUT_SIZE, cfg, limit=len(slots))
+            if batch_size < 1:
+                needed = memory_model.estimate(1, MODEL_INPUT_SIZE, MODEL_INPUT_SIZE, cfg) / 1024**3
+                raise RuntimeError(
+                    f'显存不足！生成一张图片约需要 {needed:.1f} GB，当前只有 {available_bytes() / 1024**3:.2f} GB 可用。建议：1) 卸载不用的LoRA 2) 启用文本编码器offload 3) 重启应用释放显存'
+                )
+        else:
+            batch_size = DEFAULT_BATCH_SIZE
+        
+        def update_total_batches():
+            # 剩余槽位按当前batch大小重新估算各任务的总批次数
+            for j, job in enumerate(jobs):
+                remaining = len({k // batch_size for k, slot in enumerate(slots) if slot[0] == j})
+                job.progress['total_batches'] = job.progress['batch'] + remaining
+        
+        for job in jobs:
+            job.progress['total_images'] = job.params['num_images']
+        update_total_batches()
+        print(f"开始分批生成，{len(jobs)} 个任务共 {len(slots)} 个裁剪，每批 {batch_size} 个，参数: guidance_scale={guidance_scale}")
+        
+        batch_idx = 0
+        while True:
+            # 跳过已取消任务的剩余槽位
+            slots = [slot for slot in slots if not jobs[slot[0]].cancel_requested.is_set()]
+            if not slots:
+                break
+            batch, slots = slots[:batch_size], slots[batch_size:]
+            batch_idx += 1
+            running[:] = [jobs[j] for j in sorted({j for j, _, _ in batch})]
+            for job in running:
+                job.progress['batch'] += 1
+                job.progress['step'] = 0
+            print(f"正在生成第 {batch_idx} 批，本批生成 {len(batch)} 个裁剪（{len(running)} 个任务）...")
             
             # 生成当前批次图像（使用torch.no_grad避免保留梯度）
             with torch.no_grad():
+                index = torch.tensor([j for j, _, _ in batch], device=prompt_kwargs['prompt_embeds'].device)
                 generate_kwargs = {
-                    'prompt': prompt,
-                    'image': original_image,
-                    'mask_image': mask_image,
-                    'negative_prompt': negative_prompt if negative_prompt else None,
-                    'num_images_per_prompt': current_batch_size,
+                    'image': [model_inputs[j][r][0] for j, _, r in batch],
+                    'mask_image': [model_inputs[j][r][1] for j, _, r in batch],
+                    'num_images_per_prompt': 1,
                     'guidance_scale': guidance_scale,
                     'num_inference_steps': num_inference_steps,
                     'height': MODEL_INPUT_SIZE,  # 设置模型输入高度
                     'width': MODEL_INPUT_SIZE,   # 设置模型输入宽度
+                    # 同一张图的各区域使用同一个种子
+                    'generator': [torch.Generator().manual_seed(jobs[j].params['seed'] + i) for j, i, _ in batch],
+                    'callback_on_step_end': on_step_end,
                 }
+                for key, value in prompt_kwargs.items():
+                    generate_kwargs[key] = value.index_select(0, index)
                 
-                # 如果提供了 padding_mask_crop，添加到参数中
-                if padding_mask_crop is not None:
-                    try:
-                        padding_mask_crop_int = int(padding_mask_crop)
-                        if padding_mask_crop_int > 0:
-                            generate_kwargs['padding_mask_crop'] = padding_mask_crop_int
-                    except (ValueError, TypeError):
-                        pass  # 忽略无效的值
-                
-                # 调用pipeline生成图像（会自动贴回原图）
-                result = pipe(**generate_kwargs)
-                
-                # 获取生成结果
-                if hasattr(result, 'images'):
-                    batch_images = result.images
-                else:
-                    batch_images = result
+                # 调用pipeline生成图像；显存模型低估导致OOM时缩小batch重试本批
+                # （每个槽位的随机数生成器按种子重建，重试结果不变）
+                available = available_bytes() if memory_model.calibrated else None
+                try:
+                    result = pipe(**generate_kwargs)
+                except torch.cuda.OutOfMemoryError:
+                    if len(batch) == 1:
+                        raise
+                    del generate_kwargs
+                    torch.cuda.empty_cache()
+                    if available is not None:
+                        memory_model.record_oom(len(batch), MODEL_INPUT_SIZE, MODEL_INPUT_SIZE, cfg, available)
+                    batch_size = len(batch) // 2
+                    slots = batch + slots
+                    for job in running:
+                        job.progress['batch'] -= 1
+                    update_total_batches()
+                    print(f"第 {batch_idx} 批显存不足，缩小到每批 {batch_size} 张重试")
+                    batch_idx -= 1
+                    continue
                 
-                # 添加到总结果中
-                result_images.extend(batch_images)
+                # 按槽位拆回各任务，裁剪生成的结果贴回原图；被取消的任务丢弃本批结果
+                batch_outputs = []
+                for (j, i, r), img in zip(batch, result.images):
+                    job = jobs[j]
+                    if job.cancel_requested.is_set():
+                        continue
+                    crops_coords = inputs[j][r][2]
+                    if job.params['regions']:
+                        # 各区域按自己的掩码贴到同一张结果图上，全部区域贴完后才输出
+                        x1, y1, x2, y2 = crops_coords
+                        img = pipe.image_processor.resize(img, height=y2 - y1, width=x2 - x1, resize_mode="crop")
+                        composite = composites.setdefault((j, i), [job.params['original_image'].copy(), len(inputs[j])])
+                        paste_region(composite[0], img, crops_coords, inputs[j][r][1], REGION_FEATHER_RADIUS)
+                        composite[1] -= 1
+                        if composite[1] > 0:
+                            continue
+                        img = composites.pop((j, i))[0]
+                    elif crops_coords is not None:
+                        img = pipe.image_processor.apply_overlay(
+                            job.params['mask_image'], job.params['original_image'], img, crops_coords
+                        )
+                    filename = f"sd3_inpaint_{timestamp}_{job.id[:8]}_{outputs[j]:02d}"
+                    batch_outputs.append((job, img, filename))
+                    outputs[j] += 1
+                # 单个写入线程按提交顺序保存，各任务的 result_ids 保持图片序号顺序
+                if batch_outputs:
+                    writes.append(result_writer.submit(save_result_images, batch_outputs))
                 
                 # 清理当前批次的结果对象
-                del result, batch_images
-            
-            # 每批生成后清理显存
-            if device == "cuda":
-                torch.cuda.empty_cache()
-                gc.collect()
-                if batch_idx < total_batches - 1:  # 不是最后一批，显示显存状态
-                    allocated = torch.cuda.memory_allocated() / 1024**3
-                    print(f"第 {batch_idx + 1} 批完成，已生成 {len(result_images)} 张，显存: {allocated:.2f} GB")
-        
-        # 清理临时变量和显存
-        del original_image, mask_image
-        if device == "cuda":
-            torch.cuda.empty_cache()
+                del result
+    
+    # 清理临时变量（显存块留在缓存分配器里给下一组任务复用，不逐批清空）
+    del inputs, model_inputs
+    for job in jobs:
+        job.params.pop('original_image')
+        job.params.pop('mask_image')
+        job.params.pop('regions')
+    if device == "cuda":
+        allocated = torch.cuda.memory_allocated() / 1024**3
+        print(f"生成后显存: 已分配 {allocated:.2f} GB")
+    
+    # 等待所有结果写完
+    for write in writes:
+        write.result()
+    
+    results = []
+    for job in jobs:
+        if job.cancel_requested.is_set():
+            results.append(JobCancelled())
+            continue
         
-        # 保存结果并转换为base64
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        results.append({
+            'message': f'成功生成 {len(job.result_ids)} 张图片！',
+            'result_ids': list(job.result_ids),
+            'images': [f"/api/results/{result_id}" for result_id in job.result_ids],
+            'seed': job.params['seed'],  # 第i张图的随机种子为 seed + i
+            'output_dir': app.config['OUTPUT_FOLDER'],
+            'crop_info': job.params['crop_info'],  # 裁剪区域信息（如果有）
+            'bbox': job.params['bbox']  # 掩码外接矩形信息（如果有）
+        })
+    return results
+
+job_queue = JobQueue(
+    run_generation,
+    max_backlog=MAX_QUEUED_JOBS,
+    batch_key=generation_batch_key,
+    batch_window=MICRO_BATCH_WINDOW_MS / 1000,
+    max_batch_jobs=MICRO_BATCH_MAX_JOBS,
+)
+
+class LocalBackend:
+    """模型后端：所有涉及pipeline、LoRA、显存模型和生成任务队列的操作
+    
+    开发模式下Flask进程直接调用；生产模式下只在模型工作进程（model_worker.py）里使用，
+    HTTP工作进程通过 `RemoteBackend` 调用同名方法，参数和返回值都是可pickle的普通对象。
+    """
+    
+    def ping(self):
+        return os.getpid()
+    
+    def model_loaded(self):
+        return pipe is not None
+    
+    def load_models(self, sd3_path, lora_path=None, adapter_name=None):
+        """加载（或复用）基础模型并切换LoRA，返回提示信息"""
+        global pipe
+        global use_cpu_offload
         
-        for i, img in enumerate(result_images):
-            # 保存到文件
-            filename = f"sd3_inpaint_{timestamp}_{i:02d}.png"
-            filepath = os.path.join(app.config['OUTPUT_FOLDER'], filename)
-            img.save(filepath)
-            
-            # 转换为base64用于前端显示
-            buffered = io.BytesIO()
-            img.save(buffered, format="PNG")
-            img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-            result_images[i] = f"data:image/png;base64,{img_base64}"
+        start = datetime.now()
+        
+        # 加载SD3 Inpaint pipeline（同一模型已加载时直接复用，不再重新转换权重）
+        # 换模型时旧的pipeline由模型管理器释放，这里先去掉全局引用
+        pipe = None
+        reused = model_manager.load_base(sd3_path)
+        if not reused:
+            prompt_cache.clear()
+        
+        # 加载或切换LoRA权重（按adapter名称切换，不触碰基础权重）
+        if lora_path and os.path.exists(lora_path):
+            adapter_name = model_manager.load_adapter(lora_path, adapter_name)
+        else:
+            adapter_name = None
+            model_manager.activate(None)
+        
+        pipe = model_manager.pipe
+        use_cpu_offload = model_manager.use_cpu_offload
         
-        # 最终清理显存
+        # 换了基础模型时重新标定显存模型；标定失败时退回到固定batch
+        if device == "cuda" and (not reused or not memory_model.calibrated):
+            memory_model.reset()
+            try:
+                with model_manager.lock:
+                    calibrate_memory_model(pipe)
+            except Exception as e:
+                print(f"显存模型标定失败，使用固定batch {DEFAULT_BATCH_SIZE}: {e}")
+                memory_model.reset()
+        elapsed = (datetime.now() - start).total_seconds()
+        
+        # 显示显存使用情况
+        memory_info = ""
         if device == "cuda":
-            torch.cuda.empty_cache()
             allocated = torch.cuda.memory_allocated() / 1024**3
-            print(f"生成后显存: 已分配 {allocated:.2f} GB")
+            reserved = torch.cuda.memory_reserved() / 1024**3
+            memory_info = f" (GPU显存: {allocated:.2f} GB)"
+            print(f"GPU显存使用: 已分配 {allocated:.2f} GB, 已保留 {reserved:.2f} GB")
         
-        return jsonify({
-            'success': True,
-            'message': f'成功生成 {len(result_images)} 张图片！',
-            'images': result_images,
-            'output_dir': app.config['OUTPUT_FOLDER'],
-            'crop_info': crop_info,  # 裁剪区域信息（如果有）
-            'bbox': bbox  # 掩码外接矩形信息（如果有）
-        })
+        action = '已复用基础模型' if reused else '模型加载成功'
+        return {
+            'message': f'{action}！耗时 {elapsed:.1f} 秒{memory_info}',
+            'reused_base': reused,
+            'adapter': adapter_name
+        }
     
-    except Exception as e:
-        error_msg = f"生成过程中出错: {str(e)}"
-        print(error_msg)
-        traceback.print_exc()
-        return jsonify({
-            'success': False,
-            'message': error_msg
-        }), 500
+    def adapter_state(self):
+        return {'names': list(model_manager.adapters), 'active': dict(model_manager.active_adapters)}
+    
+    def adapter_status(self):
+        return model_manager.status()
+    
+    def load_adapter(self, lora_path, adapter_name=None):
+        name = model_manager.load_adapter(lora_path, adapter_name, activate=False)
+        return name, model_manager.status()
+    
+    def unload_adapter(self, name):
+        model_manager.unload_adapter(name)
+        return model_manager.status()
+    
+    def admission_shortfall(self, cfg):
+        """模型加载后的可用显存连一张图都生成不了时，返回一张图约需要的显存（GB），否则返回None"""
+        if memory_model.calibrated and memory_model.max_batch(MODEL_INPUT_SIZE, MODEL_INPUT_SIZE, cfg, memory_model.capacity_bytes) < 1:
+            return memory_model.estimate(1, MODEL_INPUT_SIZE, MODEL_INPUT_SIZE, cfg) / 1024**3
+        return None
+    
+    def submit(self, params):
+        """提交生成任务，原图按 'original_image_id' 从图片缓存（或共享目录）取出"""
+        image_id = params.pop('original_image_id')
+        image = image_store.get(image_id)
+        if image is None:
+            raise ImageExpiredError(image_id)
+        return self._state(job_queue.submit({**params, 'original_image': image}))
+    
+    def _state(self, job):
+        version = job.version  # 先取版本号，之后的变化会让下一次等待立即返回
+        return {
+            **job.to_dict(),
+            'queue_position': job_queue.position(job),
+            'version': version,
+            'done': job.done.is_set(),
+            'result': job.result,
+        }
+    
+    def job_state(self, job_id):
+        job = job_queue.get(job_id)
+        return None if job is None else self._state(job)
+    
+    def wait_for_update(self, job_id, version, timeout):
+        """等待任务的版本号超过version（或超时）后返回任务状态，任务不存在时返回None"""
+        job = job_queue.get(job_id)
+        if job is None:
+            return None
+        job.wait_for_update(version, timeout=timeout)
+        return self._state(job)
+    
+    def cancel(self, job_id):
+        job = job_queue.cancel(job_id)
+        return None if job is None else self._state(job)
+    
+    def check_model(self):
+        return {
+            'loaded': pipe is not None,
+            'prompt_cache': prompt_cache.stats(),
+            'memory_model': memory_model.status(),
+            'model_worker_pid': os.getpid(),
+            **model_manager.status()
+        }
+
+# 生产模式下通过Unix socket调用模型工作进程，否则在本进程内执行
+backend = RemoteBackend(MODEL_WORKER_SOCKET, MODEL_WORKER_AUTHKEY) if MODEL_WORKER_SOCKET else LocalBackend()
+
+@app.errorhandler(ModelWorkerUnavailable)
+def model_worker_unavailable(e):
+    return jsonify({'success': False, 'message': str(e)}), 503
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """查询任务状态和进度"""
+    state = backend.job_state(job_id)
+    if state is None:
+        return jsonify({'success': False, 'message': '任务不存在或已过期'}), 404
+    state.pop('result', None)
+    return jsonify({'success': True, **state})
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """以Server-Sent Events推送任务进度，每批结果写完就推送其结果id，不必等全部批次结束
+    
+    事件类型：
+    - progress: 任务状态和进度
+    - images: 新完成的结果 {'start': 起始序号, 'result_ids': [...], 'images': [URL, ...]}
+    - done: 任务完成，数据与 /api/jobs/<id>/result 相同
+    - failed / cancelled: 任务失败或被取消（已推送的结果仍然保留在输出目录）
+    """
+    if backend.job_state(job_id) is None:
+        return jsonify({'success': False, 'message': '任务不存在或已过期'}), 404
+    
+    def event(name, data):
+        return f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    
+    def stream():
+        version = -1
+        sent = 0
+        while True:
+            state = backend.wait_for_update(job_id, version, SSE_KEEPALIVE_SECONDS)
+            if state is None:
+                return
+            version = state.pop('version')
+            done = state.pop('done')
+            result = state.pop('result')
+            new_ids = state['result_ids'][sent:]
+            if new_ids:
+                yield event('images', {
+                    'start': sent,
+                    'result_ids': new_ids,
+                    'images': [f"/api/results/{result_id}" for result_id in new_ids]
+                })
+                sent += len(new_ids)
+            if done:
+                if state['status'] == 'done':
+                    yield event('done', {'success': True, 'job_id': job_id, **result})
+                else:
+                    yield event(state['status'], {'success': False, **state})
+                return
+            yield event('progress', state)
+    
+    return Response(
+        stream_with_context(stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """取消任务（排队中的立即取消，执行中的在当前去噪步结束后中断）"""
+    state = backend.cancel(job_id)
+    if state is None:
+        return jsonify({'success': False, 'message': '任务不存在或已过期'}), 404
+    state.pop('result', None)
+    return jsonify({'success': True, **state})
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """获取任务结果，任务未结束时返回202"""
+    state = backend.job_state(job_id)
+    if state is None:
+        return jsonify({'success': False, 'message': '任务不存在或已过期'}), 404
+    result = state.pop('result', None)
+    if state['status'] == 'done':
+        return jsonify({'success': True, 'job_id': job_id, **result})
+    if state['status'] in ('failed', 'cancelled'):
+        return jsonify({'success': False, **state}), 500 if state['status'] == 'failed' else 200
+    return jsonify({'success': False, **state}), 202
+
+@app.route('/api/results/<result_id>', methods=['GET'])
+def get_result(result_id):
+    """以二进制流返回已保存的结果图片（不重新编码），支持条件请求和浏览器缓存"""
+    return send_from_directory(app.config['OUTPUT_FOLDER'], result_id, conditional=True, max_age=3600)
 
 @app.route('/api/check_model', methods=['GET'])
 def check_model():
     """检查模型是否已加载"""
-    return jsonify({
-        'loaded': pipe is not None
-    })
+    return jsonify(backend.check_model())
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=6008, debug=True)
+    if MODEL_WORKER_SOCKET:
+        # 生产模式下没有gunicorn时的单进程HTTP服务，不启用调试和自动重载
+        app.run(host='0.0.0.0', port=6008, threaded=True)
+    else:
+        app.run(host='0.0.0.0', port=6008, debug=True)
 
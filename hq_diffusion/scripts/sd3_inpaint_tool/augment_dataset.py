@@ -0,0 +1,410 @@
+"""
+合成缺陷数据增强
+在 hq_det 训练用的COCO数据集（generate_dataset.py 读取的同一份 `_annotations.coco.json`）中，
+在没有标注的区域随机选框，按 padding_mask_crop 的方式裁剪后用inpaint pipeline生成缺陷，
+输出增强后的图片和加入新标注框的 `_annotations.coco.json`，可以直接作为 hq_det.dataset.CocoDetection 的数据集。
+
+- 选框只用标注文件里的图片尺寸和已有标注，不解码图片；框的大小从同类别已有标注的宽高中抽样
+- 每张原图只解码一次，裁剪出所有新缺陷的模型输入和掩码（掩码直接按裁剪框大小构造）；
+  --output_mode crop 只输出裁剪区域，裁剪后立即释放整图，预取队列和写入线程里只有裁剪
+- 所有图片的缺陷裁剪一起按显存上限组批生成（batch_inpaint.BatchInpainter）
+- 输出按分片写入 `shard-XXX-of-NNN/`，每个分片一个目录（图片 + progress.jsonl），多张卡各跑一个分片；
+  分片完成后写出该分片的 `_annotations.coco.json`，所有分片都完成后合并到输出目录。
+  选框由 (seed, 图片id, 增强序号) 决定，中断后用同样的命令重跑即可续跑。
+  读取失败的原图记入 progress.jsonl（带 'error'，没有输出图片），不阻塞分片完成，结束时列出
+
+    python augment_dataset.py data/train out --sd3 sd3.safetensors --lora crack.safetensors \\
+        --category_prompts "裂纹=defect of crack" --augmentations_per_image 2
+    # 两张卡各跑一半
+    CUDA_VISIBLE_DEVICES=0 python augment_dataset.py data/train out ... --num_shards 2 --shard_index 0
+    CUDA_VISIBLE_DEVICES=1 python augment_dataset.py data/train out ... --num_shards 2 --shard_index 1
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+from batch_inpaint import (
+    MODEL_INPUT_SIZE, OUTPUT_FORMATS, SEED_STRIDE, BatchInpainter, OutputWriter,
+    add_generation_args, bboxes_to_mask, load_models, prefetch, resize_to_crop,
+)
+from mask_regions import calculate_auto_padding, crop_region_box, fill_model_input, paste_region
+
+ANNOTATIONS_FILE = '_annotations.coco.json'
+PROGRESS_FILE = 'progress.jsonl'
+SAMPLING_FILE = 'sampling.json'
+MAX_PLACEMENT_TRIES = 50
+MIN_VISIBLE_FRACTION = 0.5  # crop模式下原有标注框被裁剪后至少保留这个比例的面积才保留
+
+
+def parse_category_prompts(values):
+    """解析 ["类别名=提示词", ...]"""
+    prompts = {}
+    for value in values:
+        name, sep, prompt = value.partition('=')
+        if not sep or not name or not prompt:
+            raise SystemExit(f"--category_prompts 格式应为 类别名=提示词: {value}")
+        prompts[name] = prompt
+    return prompts
+
+
+def _boxes_intersect(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+def _expand(box, margin):
+    x, y, w, h = box
+    return (x - margin, y - margin, w + 2 * margin, h + 2 * margin)
+
+
+def place_box(rng, width, height, image_width, image_height, occupied):
+    """在图中随机放置一个不与occupied中任何框相交的框，放不下时返回None"""
+    for _ in range(MAX_PLACEMENT_TRIES):
+        x = int(rng.integers(0, image_width - width + 1))
+        y = int(rng.integers(0, image_height - height + 1))
+        box = (x, y, width, height)
+        if not any(_boxes_intersect(box, other) for other in occupied):
+            return box
+    return None
+
+
+def image_size(image, image_path):
+    """标注文件里的图片尺寸，缺失时只读取文件头"""
+    if image.get('width') and image.get('height'):
+        return image['width'], image['height']
+    with Image.open(image_path) as f:
+        return f.size
+
+
+def plan_targets(coco, input_path, category_prompts, args):
+    """为每张图片的每次增强选出新缺陷的位置
+
+    Returns:
+        list: [{'key', 'image_id', 'image', 'width', 'height', 'seed', 'regions': [{'category', 'category_id', 'bbox', 'prompt'}, ...]}, ...]，
+            顺序和内容只由数据集和参数决定，续跑和不同分片的进程得到相同的结果
+    """
+    category_ids = {category['name']: category['id'] for category in coco['categories']}
+    unknown = [name for name in category_prompts if name not in category_ids]
+    if unknown:
+        raise SystemExit(f"数据集中没有这些类别: {', '.join(unknown)}")
+
+    sizes = {name: [] for name in category_prompts}
+    annotations = {}
+    names_by_id = {category_id: name for name, category_id in category_ids.items()}
+    for ann in coco['annotations']:
+        annotations.setdefault(ann['image_id'], []).append(ann['bbox'])
+        name = names_by_id.get(ann['category_id'])
+        if name in sizes:
+            sizes[name].append(ann['bbox'][2:])
+    empty = [name for name, values in sizes.items() if not values]
+    if empty:
+        raise SystemExit(f"这些类别没有标注，无法确定缺陷大小: {', '.join(empty)}")
+    names = sorted(category_prompts)
+
+    images = sorted(coco['images'], key=lambda image: image['id'])
+    if args.max_images:
+        images = images[:args.max_images]
+    targets = []
+    for image in images:
+        image_path = os.path.join(input_path, image['file_name'])
+        image_width, image_height = image_size(image, image_path)
+        existing = [_expand(bbox, args.margin) for bbox in annotations.get(image['id'], [])]
+        for augmentation in range(args.augmentations_per_image):
+            rng = np.random.default_rng([args.seed, image['id'], augmentation])
+            occupied = list(existing)
+            regions = []
+            for _ in range(args.defects_per_image):
+                name = names[int(rng.integers(len(names)))]
+                w, h = sizes[name][int(rng.integers(len(sizes[name])))]
+                scale = rng.uniform(1 - args.size_jitter, 1 + args.size_jitter)
+                w = int(np.clip(round(w * scale), args.min_size, image_width))
+                h = int(np.clip(round(h * scale), args.min_size, image_height))
+                box = place_box(rng, w, h, image_width, image_height, occupied)
+                if box is None:
+                    continue
+                occupied.append(_expand(box, args.margin))
+                regions.append({
+                    'category': name,
+                    'category_id': category_ids[name],
+                    'bbox': box,
+                    'prompt': category_prompts[name],
+                })
+            if regions:
+                targets.append({
+                    'key': f"{image['id']}_{augmentation}",
+                    'image_id': image['id'],
+                    'image': image_path,
+                    'width': image_width,
+                    'height': image_height,
+                    'seed': args.seed + (image['id'] * args.augmentations_per_image + augmentation) * SEED_STRIDE,
+                    'regions': regions,
+                })
+    return targets
+
+
+def load_target(target, pipe, args):
+    """在预取线程中解码原图一次，裁剪出每个新缺陷的模型输入"""
+    image = Image.open(target['image']).convert('RGB')
+    loaded = {**target, 'original': image if args.output_mode == 'full' else None, 'outputs': {}}
+    items = []
+    for index, region in enumerate(target['regions']):
+        bbox = region['bbox']
+        pad = args.padding if args.padding is not None else calculate_auto_padding(bbox, MODEL_INPUT_SIZE)
+        crop_box = crop_region_box(bbox, pad, image.width, image.height, MODEL_INPUT_SIZE, MODEL_INPUT_SIZE)
+        x1, y1, x2, y2 = crop_box
+        image_crop = image.crop(crop_box)
+        mask_crop = bboxes_to_mask((x2 - x1, y2 - y1), [(bbox[0] - x1, bbox[1] - y1, bbox[2], bbox[3])])
+        model_image, model_mask = fill_model_input(pipe, image_crop, mask_crop, MODEL_INPUT_SIZE, MODEL_INPUT_SIZE)
+        items.append({
+            'target': loaded,
+            'index': index,
+            'image_crop': image_crop if args.output_mode == 'crop' else None,  # crop模式贴回用
+            'mask_crop': mask_crop,
+            'model_image': model_image,
+            'model_mask': model_mask,
+            'crop_box': crop_box,
+            'prompt': region['prompt'],
+            'negative_prompt': args.negative_prompt,
+            'seed': target['seed'] + index,
+            'variants': [0],
+        })
+    loaded['items'] = items
+    return loaded
+
+
+def failed_target(target):
+    """原图读取失败时的进度记录：没有输出图片，不进入标注，续跑时也不再重试"""
+    return {
+        'key': target['key'], 'source_image_id': target['image_id'], 'seed': target['seed'],
+        'image': target['image'], 'error': target['error'], 'images': [],
+    }
+
+
+def save_target(pipe, target, shard_dir, args):
+    """写入线程：把一张原图上所有新缺陷的生成结果贴回并保存，返回进度记录"""
+    image_format, extension, save_kwargs = OUTPUT_FORMATS[args.format]
+    entries = []
+    if args.output_mode == 'full':
+        image = target['original']
+        for item in target['items']:
+            generated = resize_to_crop(pipe, target['outputs'][item['index']], item['crop_box'])
+            paste_region(image, generated, item['crop_box'], item['mask_crop'], args.feather)
+        file_name = f"{target['key']}{extension}"
+        image.save(os.path.join(shard_dir, file_name), format=image_format, **save_kwargs)
+        entries.append({
+            'file_name': file_name,
+            'width': image.width,
+            'height': image.height,
+            'offset': [0, 0],
+            'annotations': [
+                {'bbox': list(region['bbox']), 'category_id': region['category_id']} for region in target['regions']
+            ],
+        })
+    else:
+        for item in target['items']:
+            x1, y1, x2, y2 = item['crop_box']
+            generated = resize_to_crop(pipe, target['outputs'][item['index']], item['crop_box'])
+            crop = paste_region(item['image_crop'], generated, (0, 0, x2 - x1, y2 - y1), item['mask_crop'], args.feather)
+            file_name = f"{target['key']}_{item['index']}{extension}"
+            crop.save(os.path.join(shard_dir, file_name), format=image_format, **save_kwargs)
+            x, y, w, h = target['regions'][item['index']]['bbox']
+            entries.append({
+                'file_name': file_name,
+                'width': x2 - x1,
+                'height': y2 - y1,
+                'offset': [x1, y1],
+                'annotations': [{
+                    'bbox': [x - x1, y - y1, w, h],
+                    'category_id': target['regions'][item['index']]['category_id'],
+                }],
+            })
+    return {'key': target['key'], 'source_image_id': target['image_id'], 'seed': target['seed'], 'images': entries}
+
+
+def _clip_bbox(bbox, offset, width, height):
+    """原图坐标的标注框移到输出图片坐标并裁剪，可见部分太少时返回None"""
+    x, y, w, h = bbox
+    x1, y1 = max(x - offset[0], 0), max(y - offset[1], 0)
+    x2, y2 = min(x + w - offset[0], width), min(y + h - offset[1], height)
+    if x2 <= x1 or y2 <= y1 or (x2 - x1) * (y2 - y1) < MIN_VISIBLE_FRACTION * w * h:
+        return None
+    return [x1, y1, x2 - x1, y2 - y1]
+
+
+def build_annotations(coco, records):
+    """由进度记录生成COCO标注：原图已有的标注（移到输出图片坐标）加上新缺陷的标注"""
+    source_annotations = {}
+    for ann in coco['annotations']:
+        source_annotations.setdefault(ann['image_id'], []).append(ann)
+
+    images, annotations = [], []
+    for record in records:
+        for entry in record['images']:
+            image_id = len(images) + 1
+            images.append({
+                'id': image_id,
+                'file_name': entry['file_name'],
+                'width': entry['width'],
+                'height': entry['height'],
+                'source_image_id': record['source_image_id'],
+            })
+            boxes = []
+            for ann in source_annotations.get(record['source_image_id'], []):
+                bbox = _clip_bbox(ann['bbox'], entry['offset'], entry['width'], entry['height'])
+                if bbox is not None:
+                    boxes.append((bbox, ann['category_id'], False))
+            boxes.extend((ann['bbox'], ann['category_id'], True) for ann in entry['annotations'])
+            for bbox, category_id, synthetic in boxes:
+                annotations.append({
+                    'id': len(annotations) + 1,
+                    'image_id': image_id,
+                    'category_id': category_id,
+                    'bbox': bbox,
+                    'area': bbox[2] * bbox[3],
+                    'iscrowd': 0,
+                    'synthetic': synthetic,
+                })
+    return {'images': images, 'annotations': annotations, 'categories': coco['categories']}
+
+
+def write_json(path, data):
+    """先写临时文件再替换，读取方不会看到写了一半的标注文件"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"  # 各分片进程可能同时写合并后的标注
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def merge_shards(output_dir, shard_names):
+    """所有分片都完成时把各分片的标注合并到输出目录（file_name 加上分片目录前缀）"""
+    merged = {'images': [], 'annotations': [], 'categories': None}
+    for shard_name in shard_names:
+        path = os.path.join(output_dir, shard_name, ANNOTATIONS_FILE)
+        if not os.path.exists(path):
+            return False
+        with open(path, encoding='utf-8') as f:
+            shard = json.load(f)
+        image_ids = {}
+        for image in shard['images']:
+            image_ids[image['id']] = len(merged['images']) + 1
+            merged['images'].append({
+                **image, 'id': image_ids[image['id']], 'file_name': f"{shard_name}/{image['file_name']}"
+            })
+        for ann in shard['annotations']:
+            merged['annotations'].append({
+                **ann, 'id': len(merged['annotations']) + 1, 'image_id': image_ids[ann['image_id']]
+            })
+        merged['categories'] = shard['categories']
+    write_json(os.path.join(output_dir, ANNOTATIONS_FILE), merged)
+    return True
+
+
+def check_sampling(shard_dir, sampling):
+    """续跑时选框参数必须与第一次运行相同，否则已完成的记录对应的是另一组缺陷位置"""
+    path = os.path.join(shard_dir, SAMPLING_FILE)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            previous = json.load(f)
+        if previous != sampling:
+            changed = sorted(key for key in set(previous) | set(sampling) if previous.get(key) != sampling.get(key))
+            raise SystemExit(f"{shard_dir} 是用不同的选框参数生成的（{', '.join(changed)}），请换一个输出目录")
+    else:
+        write_json(path, sampling)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='在COCO检测数据集上合成缺陷并生成新的标注')
+    parser.add_argument('input_path', type=str, help='数据集目录（包含图片和 _annotations.coco.json）')
+    parser.add_argument('output_path', type=str)
+    parser.add_argument('--category_prompts', type=str, nargs='+', required=True,
+                        help='要合成的类别及其提示词，如 "裂纹=defect of crack"')
+    parser.add_argument('--augmentations_per_image', type=int, default=1, help='每张原图生成几张增强图')
+    parser.add_argument('--defects_per_image', type=int, default=1, help='每张增强图合成几个缺陷')
+    parser.add_argument('--output_mode', type=str, default='full', choices=['full', 'crop'],
+                        help='full: 输出整张增强图；crop: 只输出每个缺陷的裁剪区域（与 generate_dataset.py 的original模式类似）')
+    parser.add_argument('--margin', type=int, default=32, help='新缺陷与已有标注框、与其他新缺陷的最小间距')
+    parser.add_argument('--size_jitter', type=float, default=0.2, help='抽样得到的缺陷宽高的随机缩放范围')
+    parser.add_argument('--min_size', type=int, default=16, help='新缺陷框的最小边长')
+    parser.add_argument('--padding', type=int, default=None, help='掩码裁剪padding，默认按缺陷框自动计算')
+    parser.add_argument('--max_images', type=int, default=None, help='只使用前N张原图（按图片id）')
+    parser.add_argument('--num_shards', type=int, default=1)
+    parser.add_argument('--shard_index', type=int, default=0)
+    add_generation_args(parser)
+    args = parser.parse_args()
+    if not 0 <= args.shard_index < args.num_shards:
+        raise SystemExit('--shard_index 应在 [0, num_shards) 内')
+
+    category_prompts = parse_category_prompts(args.category_prompts)
+    with open(os.path.join(args.input_path, ANNOTATIONS_FILE), encoding='utf-8') as f:
+        coco = json.load(f)
+
+    shard_names = [f"shard-{i:03d}-of-{args.num_shards:03d}" for i in range(args.num_shards)]
+    shard_dir = os.path.join(args.output_path, shard_names[args.shard_index])
+    os.makedirs(shard_dir, exist_ok=True)
+    check_sampling(shard_dir, {
+        'input_path': os.path.abspath(args.input_path),
+        'category_prompts': category_prompts,
+        **{key: getattr(args, key) for key in (
+            'seed', 'augmentations_per_image', 'defects_per_image', 'output_mode', 'margin',
+            'size_jitter', 'min_size', 'padding', 'max_images', 'num_shards',
+        )},
+    })
+
+    targets = plan_targets(coco, args.input_path, category_prompts, args)[args.shard_index::args.num_shards]
+    progress_path = os.path.join(shard_dir, PROGRESS_FILE)
+    done = OutputWriter.completed(progress_path, key=lambda record: record['key'])
+    todo = [target for target in targets if target['key'] not in done]
+    print(f"分片 {args.shard_index + 1}/{args.num_shards}: {len(targets)} 张增强图，已完成 {len(targets) - len(todo)} 张，"
+          f"待合成 {sum(len(target['regions']) for target in todo)} 个缺陷")
+
+    if todo:
+        model_manager = load_models(args)
+        pipe = model_manager.pipe
+        inpainter = BatchInpainter(
+            model_manager, args.num_inference_steps, args.guidance_scale, args.batch_size,
+            args.max_batch_size, args.max_sequence_length,
+        )
+        writer = OutputWriter(progress_path, args.write_workers)
+
+        def on_output(item, variant, image):
+            target = item['target']
+            target['outputs'][item['index']] = image
+            if len(target['outputs']) == len(target['items']):
+                writer.submit(save_target, pipe, target, shard_dir, args)
+
+        def load(target):
+            try:
+                return load_target(target, pipe, args)
+            except Exception as e:
+                print(f"跳过原图 {target['image']}: {e}")
+                return {**target, 'error': f"{type(e).__name__}: {e}", 'items': []}
+
+        def generation_items():
+            for target in prefetch(todo, load, args.prefetch_workers, args.prefetch):
+                if 'error' in target:
+                    writer.submit(failed_target, target)
+                yield from target['items']
+
+        try:
+            inpainter.run(generation_items(), on_output)
+        finally:
+            writer.close()
+
+    records = {record['key']: record for record in OutputWriter.records(progress_path)}
+    missing = [target['key'] for target in targets if target['key'] not in records]
+    if missing:
+        print(f"分片还有 {len(missing)} 张增强图未完成，重新运行同样的命令继续")
+        raise SystemExit(1)
+    completed = [records[target['key']] for target in targets if 'error' not in records[target['key']]]
+    write_json(os.path.join(shard_dir, ANNOTATIONS_FILE), build_annotations(coco, completed))
+    print(f"分片完成: {shard_dir}")
+    failed = [records[target['key']] for target in targets if 'error' in records[target['key']]]
+    if failed:
+        print(f"{len(failed)} 张增强图因原图读取失败而跳过（已记入 {progress_path}，修复原图后删除对应记录可重新生成）:")
+        for record in failed:
+            print(f"  {record['image']}: {record['error']}")
+    if merge_shards(args.output_path, shard_names):
+        print(f"所有分片已完成，合并标注: {os.path.join(args.output_path, ANNOTATIONS_FILE)}")
@@ -0,0 +1,466 @@
+"""
+批量修复命令行工具
+从jsonl或COCO清单批量生成缺陷图：模型和LoRA只加载一次，后台线程预取、解码输入并裁剪，
+按显存上限把所有条目的变体组批去噪，写入线程池贴回原图、保存结果并追加输出清单。
+输出清单里已有的 (条目id, 变体) 会被跳过，中断后用同样的命令重跑即可续跑。
+
+jsonl清单每行一个条目（路径相对于清单所在目录，或 --image_root）:
+    {"image": "a.jpg", "bbox": [x, y, w, h], "prompt": "defect of crack", "n": 4, "seed": 0}
+    {"image": "b.jpg", "mask": "b_mask.png", "prompt": "defect of scratch"}
+  mask 与 bbox 至少有一个，bbox 也可以是多个矩形的列表；
+  可选字段: id（默认为行号）, negative_prompt, padding（默认按掩码外接矩形自动计算）
+COCO清单（*.json，如 _annotations.coco.json）中每个标注框作为一个条目，提示词为 --prompt_template 填入类别名。
+使用同一张原图的条目按原图分组预取，原图只解码一次，各条目共享同一份解码结果。
+
+    python batch_inpaint.py --sd3 sd3.safetensors --lora lora.safetensors --manifest items.jsonl --output_dir out
+    python batch_inpaint.py --sd3 sd3.safetensors --manifest data/_annotations.coco.json --categories 裂纹 --num_variants 2 --output_dir out
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from PIL import Image, ImageDraw
+
+from mask_regions import calculate_auto_padding, crop_region_box, fill_model_input, paste_region
+from mask_utils import binarize_mask, mask_bbox
+from memory_model import MemoryModel
+from model_manager import ModelManager
+
+MODEL_INPUT_SIZE = 512
+SEED_STRIDE = 1000  # 未指定种子时第k个条目的种子为 seed + k * SEED_STRIDE，第v个变体再加v
+OUTPUT_FORMATS = {
+    'png': ('PNG', '.png', {'compress_level': 1}),
+    'jpg': ('JPEG', '.jpg', {'quality': 95}),
+    'webp': ('WEBP', '.webp', {'lossless': True, 'method': 0}),
+}
+
+
+def read_jsonl_manifest(path, root, args):
+    items = []
+    with open(path, encoding='utf-8') as f:
+        for line_no, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            bboxes = entry.get('bbox')
+            if bboxes is not None and not isinstance(bboxes[0], (list, tuple)):
+                bboxes = [bboxes]
+            if bboxes is None and not entry.get('mask'):
+                raise ValueError(f"{path}:{line_no + 1} 缺少 mask 或 bbox")
+            items.append({
+                'id': str(entry.get('id', line_no)),
+                'image': os.path.join(root, entry['image']),
+                'mask': os.path.join(root, entry['mask']) if entry.get('mask') else None,
+                'bboxes': bboxes,
+                'prompt': entry.get('prompt', args.prompt),
+                'negative_prompt': entry.get('negative_prompt', args.negative_prompt),
+                'n': int(entry.get('n', entry.get('num_variants', args.num_variants))),
+                'seed': int(entry['seed']) if entry.get('seed') is not None else args.seed + len(items) * SEED_STRIDE,
+                'padding': entry.get('padding', args.padding),
+            })
+    return items
+
+
+def read_coco_manifest(path, root, args):
+    with open(path, encoding='utf-8') as f:
+        coco = json.load(f)
+    images = {image['id']: image for image in coco['images']}
+    categories = {category['id']: category['name'] for category in coco['categories']}
+    items = []
+    for ann in coco['annotations']:
+        name = categories[ann['category_id']]
+        if args.categories and name not in args.categories:
+            continue
+        items.append({
+            'id': f"ann{ann['id']}",
+            'image': os.path.join(root, images[ann['image_id']]['file_name']),
+            'mask': None,
+            'bboxes': [ann['bbox']],
+            'prompt': args.prompt_template.format(category=name),
+            'negative_prompt': args.negative_prompt,
+            'n': args.num_variants,
+            'seed': args.seed + len(items) * SEED_STRIDE,
+            'padding': args.padding,
+        })
+    return items
+
+
+def read_manifest(path, args):
+    """读取清单，返回条目列表 [{'id', 'image', 'mask', 'bboxes', 'prompt', 'negative_prompt', 'n', 'seed', 'padding'}, ...]"""
+    root = args.image_root or os.path.dirname(os.path.abspath(path))
+    if path.endswith('.json'):
+        return read_coco_manifest(path, root, args)
+    return read_jsonl_manifest(path, root, args)
+
+
+def bboxes_to_mask(size, bboxes):
+    """把 [x, y, w, h] 矩形（可以是浮点，如COCO标注）画成单通道掩码"""
+    mask = Image.new('L', size, 0)
+    draw = ImageDraw.Draw(mask)
+    for x, y, w, h in bboxes:
+        draw.rectangle([int(x), int(y), int(round(x + w)) - 1, int(round(y + h)) - 1], fill=255)
+    return mask
+
+
+def group_by_image(items):
+    """按原图路径分组（保持首次出现的顺序），如COCO清单中同一张图片的多个标注框"""
+    groups = {}
+    for item in items:
+        groups.setdefault(item['image'], []).append(item)
+    return list(groups.values())
+
+
+def load_image_items(items, pipe):
+    """在预取线程中解码一次原图，为使用它的每个条目裁剪出模型输入；读取失败的原图或条目打印后跳过"""
+    try:
+        image = Image.open(items[0]['image']).convert('RGB')
+    except Exception as e:
+        print(f"跳过原图 {items[0]['image']}（条目 {', '.join(item['id'] for item in items)}）: {e}")
+        return []
+    loaded = []
+    for item in items:
+        try:
+            loaded.append(load_item(item, pipe, image))
+        except Exception as e:
+            print(f"跳过条目 {item['id']}: {e}")
+    return loaded
+
+
+def load_item(item, pipe, image):
+    """构造掩码并从已解码的原图中裁剪、缩放出模型输入（'original' 与同一原图的其他条目共享）"""
+    if item['mask']:
+        mask = binarize_mask(Image.open(item['mask']), image.size)
+    else:
+        mask = bboxes_to_mask(image.size, item['bboxes'])
+    bbox = mask_bbox(mask)
+    if bbox is None:
+        raise ValueError('掩码为空')
+    pad = item['padding'] if item['padding'] is not None else calculate_auto_padding(bbox, MODEL_INPUT_SIZE)
+    crop_box = crop_region_box(bbox, pad, image.width, image.height, MODEL_INPUT_SIZE, MODEL_INPUT_SIZE)
+    mask_crop = mask.crop(crop_box)
+    model_image, model_mask = fill_model_input(
+        pipe, image.crop(crop_box), mask_crop, MODEL_INPUT_SIZE, MODEL_INPUT_SIZE
+    )
+    return {
+        **item,
+        'original': image,
+        'model_image': model_image,
+        'model_mask': model_mask,
+        'mask_crop': mask_crop,
+        'crop_box': crop_box,
+    }
+
+
+def prefetch(items, load_fn, num_workers=4, depth=16):
+    """按顺序产出 load_fn(item) 的结果，后台线程最多提前加载depth个；加载失败的条目打印后跳过"""
+    with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='prefetch') as pool:
+        items = iter(items)
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.submit(load_fn, item)))
+            if len(pending) >= depth:
+                break
+        while pending:
+            item, future = pending.popleft()
+            next_item = next(items, None)
+            if next_item is not None:
+                pending.append((next_item, pool.submit(load_fn, next_item)))
+            try:
+                yield future.result()
+            except Exception as e:
+                print(f"跳过条目 {item.get('id')}: {e}")
+
+
+class OutputWriter:
+    """写入线程池：保存结果并追加输出清单（jsonl，每行写完即flush）
+
+    未完成的写入超过 max_pending 时提交方阻塞，避免GPU比磁盘快时结果堆积在内存里。
+    """
+
+    def __init__(self, manifest_path, num_workers=4, max_pending=64):
+        self.manifest_path = manifest_path
+        self.pool = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='writer')
+        self.pending = deque()
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.manifest = open(manifest_path, 'a', encoding='utf-8')
+        if self.manifest.tell() > 0:
+            with open(manifest_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    # 上次中断时最后一行只写了一半，另起一行，避免和新记录粘在一起
+                    self.manifest.write('\n')
+        self.written = 0
+
+    @staticmethod
+    def records(manifest_path):
+        """读取输出清单中已写入的记录（跳过上次中断时写了一半的行）"""
+        records = []
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        pass
+        return records
+
+    @staticmethod
+    def completed(manifest_path, key=lambda record: (record['id'], record['variant'])):
+        """已写入输出清单的记录键（续跑时跳过）"""
+        return {key(record) for record in OutputWriter.records(manifest_path)}
+
+    def _run(self, fn, args):
+        record = fn(*args)
+        if record is not None:
+            with self.lock:
+                self.manifest.write(json.dumps(record, ensure_ascii=False) + '\n')
+                self.manifest.flush()
+                self.written += 1
+
+    def submit(self, fn, *args):
+        """在写入线程中执行 fn(*args)，返回的记录（dict）追加到输出清单"""
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.pool.submit(self._run, fn, args))
+
+    def close(self):
+        while self.pending:
+            self.pending.popleft().result()
+        self.pool.shutdown()
+        self.manifest.close()
+
+
+class BatchInpainter:
+    """把多个条目的 (条目, 变体) 槽位按显存上限组批调用inpaint pipeline
+
+    条目需要 'model_image'、'model_mask'（`fill_model_input` 缩放到模型尺寸的裁剪）、'prompt'、'negative_prompt'、'seed' 和 'variants'（要生成的变体序号）。
+    batch_size为0时在CUDA上标定显存模型后按可用显存选择（与Web工具相同），否则固定；
+    去噪时显存不足会把batch减半重试本批。提示词embedding按 (提示词, 负面提示词) 缓存。
+    """
+
+    def __init__(self, model_manager, num_inference_steps=28, guidance_scale=7.0, batch_size=0,
+                 max_batch_size=16, max_sequence_length=256):
+        self.model_manager = model_manager
+        self.pipe = model_manager.pipe
+        self.num_inference_steps = num_inference_steps
+        self.guidance_scale = guidance_scale
+        self.cfg = guidance_scale > 1
+        self.max_sequence_length = max_sequence_length
+        self.prompt_cache = {}
+        self.batch_size = batch_size
+        if not batch_size:
+            self.batch_size = 4
+            if model_manager.device == "cuda":
+                memory_model = MemoryModel(max_batch_size=max_batch_size)
+                memory_model.calibrate(self._run_probe, MODEL_INPUT_SIZE, MODEL_INPUT_SIZE, cfg=self.cfg)
+                self.batch_size = max(1, memory_model.max_batch(MODEL_INPUT_SIZE, MODEL_INPUT_SIZE, self.cfg))
+                print(f"显存模型: {memory_model.status()}")
+        print(f"每批生成 {self.batch_size} 张")
+
+    def _run_probe(self, batch, height, width, steps):
+        image = Image.new('RGB', (width, height), (128, 128, 128))
+        mask = bboxes_to_mask((width, height), [(width // 4, height // 4, width // 2, height // 2)])
+        with torch.no_grad():
+            self.pipe(
+                image=[image] * batch,
+                mask_image=[mask] * batch,
+                guidance_scale=self.guidance_scale,
+                num_inference_steps=steps,
+                height=height,
+                width=width,
+                **self.encode([('defect of crack', '')] * batch),
+            )
+
+    def encode(self, prompt_pairs):
+        """编码 [(提示词, 负面提示词), ...]，返回可直接传给pipeline的embedding参数"""
+        missing = [pair for pair in dict.fromkeys(prompt_pairs) if pair not in self.prompt_cache]
+        if missing:
+            with torch.no_grad(), self.model_manager.text_encoders_on_device():
+                encoded = self.pipe.encode_prompt(
+                    prompt=[prompt for prompt, _ in missing],
+                    prompt_2=None,
+                    prompt_3=None,
+                    negative_prompt=[negative for _, negative in missing] if self.cfg else None,
+                    device=self.pipe._execution_device,
+                    do_classifier_free_guidance=self.cfg,
+                    max_sequence_length=self.max_sequence_length,
+                )
+            for i, pair in enumerate(missing):
+                self.prompt_cache[pair] = tuple(None if t is None else t[i:i + 1] for t in encoded)
+
+        names = ('prompt_embeds', 'negative_prompt_embeds', 'pooled_prompt_embeds', 'negative_pooled_prompt_embeds')
+        return {
+            name: torch.cat([self.prompt_cache[pair][i] for pair in prompt_pairs])
+            for i, name in enumerate(names)
+            if self.prompt_cache[prompt_pairs[0]][i] is not None
+        }
+
+    def run(self, loaded_items, on_output):
+        """生成所有条目的变体，每张结果调用 on_output(条目, 变体序号, 512分辨率的生成结果)
+
+        on_output在GPU线程中调用，应当只把耗时的贴回、编码交给写入线程。
+
+        Returns:
+            int: 生成的图片数
+        """
+        slots = deque()
+        loaded_items = iter(loaded_items)
+        exhausted = False
+        generated = 0
+        start = time.perf_counter()
+        while True:
+            # 从预取队列补足一批槽位
+            while not exhausted and len(slots) < self.batch_size:
+                item = next(loaded_items, None)
+                if item is None:
+                    exhausted = True
+                else:
+                    slots.extend((item, variant) for variant in item['variants'])
+            if not slots:
+                return generated
+
+            batch = [slots.popleft() for _ in range(min(self.batch_size, len(slots)))]
+            try:
+                with torch.no_grad():
+                    images = self.pipe(
+                        image=[item['model_image'] for item, _ in batch],
+                        mask_image=[item['model_mask'] for item, _ in batch],
+                        guidance_scale=self.guidance_scale,
+                        num_inference_steps=self.num_inference_steps,
+                        height=MODEL_INPUT_SIZE,
+                        width=MODEL_INPUT_SIZE,
+                        generator=[torch.Generator().manual_seed(item['seed'] + variant) for item, variant in batch],
+                        **self.encode([(item['prompt'], item['negative_prompt']) for item, _ in batch]),
+                    ).images
+            except torch.cuda.OutOfMemoryError:
+                if len(batch) == 1:
+                    raise
+                torch.cuda.empty_cache()
+                self.batch_size = len(batch) // 2
+                slots.extendleft(reversed(batch))
+                print(f"显存不足，缩小到每批 {self.batch_size} 张重试")
+                continue
+
+            for (item, variant), image in zip(batch, images):
+                on_output(item, variant, image)
+            generated += len(batch)
+            elapsed = time.perf_counter() - start
+            print(f"已生成 {generated} 张，{generated / elapsed:.2f} 张/秒")
+
+
+def resize_to_crop(pipe, image, crop_box):
+    """把512分辨率的生成结果缩放到裁剪框大小（与pipeline的 padding_mask_crop 后处理一致）"""
+    x1, y1, x2, y2 = crop_box
+    return pipe.image_processor.resize(image, height=y2 - y1, width=x2 - x1, resize_mode="crop")
+
+
+def paste_back(pipe, item, image, feather=0):
+    """把生成结果缩放到裁剪框大小，按掩码贴回原图的副本"""
+    image = resize_to_crop(pipe, image, item['crop_box'])
+    return paste_region(item['original'].copy(), image, item['crop_box'], item['mask_crop'], feather)
+
+
+def save_output(pipe, item, variant, image, args):
+    """写入线程：贴回原图、保存并返回输出清单记录"""
+    image_format, extension, save_kwargs = OUTPUT_FORMATS[args.format]
+    filename = f"{item['id']}_{variant:02d}{extension}"
+    paste_back(pipe, item, image, args.feather).save(
+        os.path.join(args.output_dir, 'images', filename), format=image_format, **save_kwargs
+    )
+    return {
+        'id': item['id'],
+        'variant': variant,
+        'seed': item['seed'] + variant,
+        'source_image': item['image'],
+        'output': os.path.join('images', filename),
+        'prompt': item['prompt'],
+        'crop_box': list(item['crop_box']),
+        'bboxes': item['bboxes'],
+    }
+
+
+def load_models(args):
+    """加载基础模型和LoRA（多个LoRA按 --lora_weights 混合）"""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model_manager = ModelManager(
+        device, gpu_budget_bytes=float('inf'), text_encoder_offload=args.text_encoder_offload
+    )
+    model_manager.load_base(args.sd3)
+    weights = args.lora_weights or [1.0] * len(args.lora)
+    names = [model_manager.load_adapter(path, activate=False) for path in args.lora]
+    model_manager.activate(dict(zip(names, weights)))
+    return model_manager
+
+
+def add_generation_args(parser):
+    """模型和生成参数（合成缺陷数据集的脚本共用）"""
+    parser.add_argument('--sd3', type=str, required=True, help='SD3模型文件')
+    parser.add_argument('--lora', type=str, nargs='*', default=[], help='LoRA权重文件，可以多个')
+    parser.add_argument('--lora_weights', type=float, nargs='*', default=None, help='多个LoRA的混合权重')
+    parser.add_argument('--text_encoder_offload', type=str, default=None, choices=['t5', 'all'],
+                        help='文本编码器平时放在CPU，只在编码新提示词时移到GPU')
+    parser.add_argument('--num_inference_steps', type=int, default=28)
+    parser.add_argument('--guidance_scale', type=float, default=7.0)
+    parser.add_argument('--batch_size', type=int, default=0, help='每批生成张数，0表示按显存自动选择')
+    parser.add_argument('--max_batch_size', type=int, default=16)
+    parser.add_argument('--max_sequence_length', type=int, default=256, help='T5最大token长度，短提示词可以调小')
+    parser.add_argument('--negative_prompt', type=str, default='')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--format', type=str, default='png', choices=sorted(OUTPUT_FORMATS))
+    parser.add_argument('--feather', type=float, default=0, help='贴回原图时的掩码羽化半径')
+    parser.add_argument('--prefetch_workers', type=int, default=4, help='解码输入的线程数')
+    parser.add_argument('--prefetch', type=int, default=32, help='最多提前加载的原图数')
+    parser.add_argument('--write_workers', type=int, default=4, help='贴回、编码和保存结果的线程数')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='按清单批量生成缺陷图')
+    parser.add_argument('--manifest', type=str, required=True, help='jsonl清单或COCO标注文件')
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--image_root', type=str, default=None, help='图片路径的根目录，默认为清单所在目录')
+    parser.add_argument('--prompt', type=str, default='defect of crack', help='jsonl条目未指定提示词时使用')
+    parser.add_argument('--prompt_template', type=str, default='defect of {category}', help='COCO清单的提示词模板')
+    parser.add_argument('--categories', type=str, nargs='*', default=None, help='COCO清单只使用这些类别的标注')
+    parser.add_argument('--num_variants', type=int, default=4, help='条目未指定n时每个条目生成的张数')
+    parser.add_argument('--padding', type=int, default=None, help='掩码裁剪padding，默认按外接矩形自动计算')
+    add_generation_args(parser)
+    args = parser.parse_args()
+
+    os.makedirs(os.path.join(args.output_dir, 'images'), exist_ok=True)
+    manifest_path = os.path.join(args.output_dir, 'manifest.jsonl')
+
+    items = read_manifest(args.manifest, args)
+    done = OutputWriter.completed(manifest_path)
+    for item in items:
+        item['variants'] = [v for v in range(item['n']) if (item['id'], v) not in done]
+    todo = [item for item in items if item['variants']]
+    print(f"清单共 {len(items)} 个条目，已完成 {len(done)} 张，待生成 {sum(len(item['variants']) for item in todo)} 张")
+    if not todo:
+        raise SystemExit(0)
+
+    model_manager = load_models(args)
+    pipe = model_manager.pipe
+    inpainter = BatchInpainter(
+        model_manager, args.num_inference_steps, args.guidance_scale, args.batch_size,
+        args.max_batch_size, args.max_sequence_length,
+    )
+    writer = OutputWriter(manifest_path, args.write_workers)
+    try:
+        loaded = prefetch(
+            group_by_image(todo), lambda items: load_image_items(items, pipe), args.prefetch_workers, args.prefetch
+        )
+        inpainter.run(
+            (item for items in loaded for item in items),
+            lambda item, variant, image: writer.submit(save_output, pipe, item, variant, image, args),
+        )
+    finally:
+        writer.close()
+    print(f"完成，本次写入 {writer.written} 张，输出清单: {manifest_path}")
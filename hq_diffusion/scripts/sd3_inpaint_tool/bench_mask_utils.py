@@ -0,0 +1,118 @@
+"""
+掩码处理微基准：mask_utils 与原来的 process_mask_from_base64 / calculate_mask_bbox 实现对比延迟和峰值内存
+
+每个用例在fork出的子进程里运行，峰值内存为子进程最大RSS相对运行前RSS的增量（包含PIL内部缓冲区）。
+
+    python bench_mask_utils.py --width 7680 --height 4320
+    python bench_mask_utils.py --width 7680 --height 4320 --mask_scale 0.5   # 画布比原图小，需要缩放
+"""
+
+import argparse
+import base64
+import io
+import multiprocessing
+import resource
+import statistics
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from mask_utils import decode_mask, dilate_mask, mask_bbox, rle_encode
+
+
+def legacy_process_mask(original_size, mask_base64):
+    """原来的 process_mask_from_base64：RGB解码、LANCZOS缩放、float64通道均值阈值化"""
+    mask_data = base64.b64decode(mask_base64.split(',')[1])
+    mask_image = Image.open(io.BytesIO(mask_data)).convert("RGB")
+    if mask_image.size != original_size:
+        mask_image = mask_image.resize(original_size, Image.Resampling.LANCZOS)
+    mask_array = np.array(mask_image)
+    mask_gray = np.mean(mask_array, axis=2)
+    mask = (mask_gray > 10).astype(np.uint8) * 255
+    return Image.fromarray(mask, mode='L')
+
+
+def legacy_mask_bbox(mask_image):
+    """原来的 calculate_mask_bbox：np.where构造N×2坐标数组求最小、最大值"""
+    mask_array = np.array(mask_image)
+    coords = np.column_stack(np.where(mask_array > 10))
+    if len(coords) == 0:
+        return None
+    y_min, x_min = coords.min(axis=0)
+    y_max, x_max = coords.max(axis=0)
+    return (int(x_min), int(y_min), int(x_max - x_min + 1), int(y_max - y_min + 1))
+
+
+def make_mask_base64(width, height, scale, num_strokes, stroke_width):
+    """模拟前端画布导出的掩码：黑色背景上的白色笔画，RGBA PNG的data URL"""
+    w, h = max(1, int(width * scale)), max(1, int(height * scale))
+    mask = Image.new('RGBA', (w, h), (0, 0, 0, 255))
+    draw = ImageDraw.Draw(mask)
+    rng = np.random.default_rng(0)
+    for _ in range(num_strokes):
+        points = [tuple(p) for p in (rng.random((8, 2)) * (w, h)).astype(int).tolist()]
+        draw.line(points, fill=(255, 255, 255, 255), width=max(1, int(stroke_width * scale)))
+    buffered = io.BytesIO()
+    mask.save(buffered, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffered.getvalue()).decode('utf-8')
+
+
+def _measure(fn, repeats, queue):
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    queue.put((statistics.median(times), peak))
+
+
+def measure(fn, repeats):
+    """在子进程中运行，返回 (中位数耗时秒, 峰值RSS增量KB)"""
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_measure, args=(fn, repeats, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=7680)
+    parser.add_argument('--height', type=int, default=4320)
+    parser.add_argument('--mask_scale', type=float, default=1.0, help='画布掩码相对原图的缩放，不为1时需要缩放到原图尺寸')
+    parser.add_argument('--num_strokes', type=int, default=6)
+    parser.add_argument('--stroke_width', type=int, default=60)
+    parser.add_argument('--dilate_radius', type=int, default=16)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    size = (args.width, args.height)
+    mask_base64 = make_mask_base64(args.width, args.height, args.mask_scale, args.num_strokes, args.stroke_width)
+    mask = decode_mask(mask_base64, size)
+
+    # 新旧实现的结果应当一致（需要缩放时边缘像素可能因插值方式不同略有差异）
+    legacy = np.asarray(legacy_process_mask(size, mask_base64))
+    differing = int(np.count_nonzero(legacy != np.asarray(mask)))
+    print(f"掩码 {args.width}x{args.height}（画布缩放 {args.mask_scale}），掩码像素 {np.count_nonzero(np.asarray(mask))}，"
+          f"新旧解码结果不同的像素 {differing}")
+    assert legacy_mask_bbox(mask) == mask_bbox(mask)
+
+    cases = [
+        ('解码掩码', lambda: legacy_process_mask(size, mask_base64), lambda: decode_mask(mask_base64, size)),
+        ('外接矩形', lambda: legacy_mask_bbox(mask), lambda: mask_bbox(mask)),
+        ('RLE编码', None, lambda: rle_encode(mask)),
+        (f'膨胀 r={args.dilate_radius}', None, lambda: dilate_mask(mask, args.dilate_radius)),
+    ]
+    print(f"{'操作':<12}{'原实现 ms':>12}{'原实现 MB':>12}{'mask_utils ms':>16}{'mask_utils MB':>16}")
+    for name, legacy_fn, new_fn in cases:
+        legacy_cols = ('-', '-')
+        if legacy_fn is not None:
+            seconds, peak_kb = measure(legacy_fn, args.repeats)
+            legacy_cols = (f"{seconds * 1000:.1f}", f"{peak_kb / 1024:.1f}")
+        seconds, peak_kb = measure(new_fn, args.repeats)
+        print(f"{name:<12}{legacy_cols[0]:>12}{legacy_cols[1]:>12}{seconds * 1000:>16.1f}{peak_kb / 1024:>16.1f}")
@@ -0,0 +1,136 @@
+"""
+上传图片缓存
+原图只上传、解码一次，按文件内容的sha256保存解码后的RGB图像，
+之后计算掩码信息和生成时只需要传图片id和掩码，不再每次传输、解码整张大图。
+按解码后的像素字节数做LRU淘汰，被淘汰的id再次使用时前端需要重新上传。
+指定目录时原始文件同时写入该目录，缓存未命中时从文件重新解码，多个进程（HTTP工作进程和模型工作进程）
+可以通过同一个目录共享上传的图片。目录中的文件按修改时间做LRU淘汰（读取时更新修改时间），
+总大小不超过 `max_file_bytes`，文件也被淘汰的id同样需要重新上传。
+"""
+
+import hashlib
+import io
+import os
+import string
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+
+class ImageExpiredError(KeyError):
+    """图片id不在缓存中（已被淘汰），需要重新上传"""
+
+
+class ImageStore:
+    def __init__(self, max_bytes=2 * 1024**3, directory=None, max_file_bytes=10 * 1024**3):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_file_bytes = max_file_bytes
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.images = OrderedDict()  # 图片id -> PIL.Image（RGB）
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _image_bytes(image):
+        return image.width * image.height * len(image.getbands())
+
+    def put_bytes(self, data):
+        """解码上传的图片文件并保存，内容相同的图片只解码一次
+
+        Returns:
+            tuple: (图片id, PIL.Image)
+        """
+        image_id = hashlib.sha256(data).hexdigest()
+        image = self._cached(image_id)
+        if self.directory:
+            # 内存命中时也要确认文件还在：其他进程可能已把它从目录中淘汰
+            self._write_file(image_id, data)
+        if image is not None:
+            return image_id, image
+
+        image = Image.open(io.BytesIO(data))
+        # 浏览器按EXIF方向显示图片并在此坐标系下绘制掩码，这里保持一致
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        with self.lock:
+            if image_id not in self.images:
+                self.images[image_id] = image
+                self.total_bytes += self._image_bytes(image)
+            self.images.move_to_end(image_id)
+            # 至少保留刚上传的这张
+            while self.total_bytes > self.max_bytes and len(self.images) > 1:
+                _, evicted = self.images.popitem(last=False)
+                self.total_bytes -= self._image_bytes(evicted)
+        return image_id, image
+
+    def _write_file(self, image_id, data):
+        path = os.path.join(self.directory, image_id)
+        if self._touch(path):
+            return
+        # 先写临时文件再改名，其他进程不会读到写了一半的文件
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._prune_files(keep=image_id)
+
+    @staticmethod
+    def _touch(path):
+        """更新文件的修改时间（淘汰顺序按修改时间），文件不存在时返回False"""
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _prune_files(self, keep):
+        """目录总大小超过 max_file_bytes 时，按修改时间从旧到新删除文件（保留刚写入的 `keep`）"""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp') or entry.name == keep:
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # 已被其他进程删除
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files) + os.path.getsize(os.path.join(self.directory, keep))
+        for _, size, path in sorted(files):
+            if total <= self.max_file_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _cached(self, image_id):
+        with self.lock:
+            image = self.images.get(image_id)
+            if image is not None:
+                self.images.move_to_end(image_id)
+            return image
+
+    def get(self, image_id):
+        image = self._cached(image_id)
+        if self.directory and len(image_id) == 64 and all(c in string.hexdigits for c in image_id):
+            path = os.path.join(self.directory, image_id)
+            if image is not None:
+                self._touch(path)
+            else:
+                try:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                except FileNotFoundError:  # 从未上传过，或已从目录中淘汰
+                    return None
+                image = self.put_bytes(data)[1]
+        return image
+
+    def stats(self):
+        return {
+            'images': len(self.images),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+        }
@@ -0,0 +1,223 @@
+"""
+生成任务队列
+/api/generate 只负责解析请求并提交任务，由单个GPU工作线程按提交顺序执行，
+前端通过任务id查询状态、进度和结果，也可以取消任务。
+排队任务数有上限，积压过多时直接拒绝新任务，而不是让请求排到代理超时才失败。
+
+跨请求合批：工作线程取出一个任务后，最多再等待 `batch_window` 秒，把排队中参数兼容
+（`batch_key` 相同）的任务一起交给处理函数，由它合并成批量去噪调用。
+"""
+
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+
+
+class QueueFullError(Exception):
+    """排队任务数已达上限"""
+
+
+class JobCancelled(Exception):
+    """任务在执行过程中被取消"""
+
+
+class Job:
+    """一次生成请求
+
+    状态: queued -> running -> done / failed / cancelled
+    """
+
+    def __init__(self, params):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.status = 'queued'
+        self.message = ''
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.progress = {
+            'batch': 0,  # 当前批次（从1开始）
+            'total_batches': 0,
+            'step': 0,  # 当前批次已完成的去噪步数
+            'total_steps': 0,  # 当前批次的去噪总步数
+            'images_done': 0,
+            'total_images': 0,
+        }
+        self.result_ids = []  # 已写入的结果图片id，按图片序号追加（流式返回每批结果）
+        self.cancel_requested = threading.Event()
+        self.done = threading.Event()
+        self.version = 0  # 状态、进度或结果每变化一次加1
+        self.updated = threading.Condition()
+
+    def notify(self):
+        """状态、进度或结果有变化时调用，唤醒等待更新的订阅者"""
+        with self.updated:
+            self.version += 1
+            self.updated.notify_all()
+
+    def wait_for_update(self, version, timeout=None):
+        """等待版本号超过 `version`（或超时），返回当前版本号"""
+        with self.updated:
+            self.updated.wait_for(lambda: self.version > version, timeout=timeout)
+            return self.version
+
+    def progress_fraction(self):
+        p = self.progress
+        if self.status == 'done':
+            return 1.0
+        if not p['total_batches']:
+            return 0.0
+        batch_fraction = p['step'] / p['total_steps'] if p['total_steps'] else 0.0
+        return min(1.0, (max(p['batch'] - 1, 0) + batch_fraction) / p['total_batches'])
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'message': self.message,
+            'progress': {**self.progress, 'fraction': round(self.progress_fraction(), 4)},
+            'result_ids': list(self.result_ids),
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class JobQueue:
+    """单工作线程的有界任务队列
+
+    Args:
+        handler: 在工作线程里执行一组任务的函数 `handler(jobs) -> results`，results与jobs一一对应，
+            元素为任务结果，或表示该任务失败/取消的异常对象（`JobCancelled` 表示已取消）。
+            处理函数本身抛出异常时整组任务失败
+        max_backlog: 允许排队（未开始执行）的任务数上限
+        max_finished: 保留结果的已结束任务数，超出后丢弃最早结束的任务
+        batch_key: `batch_key(job)` 返回可合批的兼容键，None表示不合批
+        batch_window: 凑批的最长等待时间（秒）
+        max_batch_jobs: 一组最多合并的任务数
+    """
+
+    def __init__(self, handler, max_backlog=8, max_finished=100, batch_key=None, batch_window=0.0, max_batch_jobs=1):
+        self.handler = handler
+        self.max_backlog = max_backlog
+        self.max_finished = max_finished
+        self.batch_key = batch_key
+        self.batch_window = batch_window
+        self.max_batch_jobs = max_batch_jobs
+        self.jobs = OrderedDict()
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.worker = None
+
+    def submit(self, params):
+        """提交任务，队列已满时抛出 QueueFullError"""
+        with self.condition:
+            if len(self.pending) >= self.max_backlog:
+                raise QueueFullError(f"排队任务已达上限 ({self.max_backlog})，请稍后再试")
+            job = Job(params)
+            self.jobs[job.id] = job
+            self.pending.append(job)
+            self._prune()
+            # 工作线程在第一次提交时启动（Flask调试模式的重载父进程不会启动它）
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._run, name='gpu-worker', daemon=True)
+                self.worker.start()
+            self.condition.notify()
+            return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def position(self, job):
+        """任务在队列中的位置（0表示下一个执行），不在排队中返回None"""
+        with self.condition:
+            for i, pending in enumerate(self.pending):
+                if pending is job:
+                    return i
+        return None
+
+    def cancel(self, job_id):
+        """取消任务：排队中的直接移出队列，执行中的在下一个去噪步结束时中断"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            job.cancel_requested.set()
+            if job.status == 'queued':
+                # 工作线程凑批时已取出、还在等待窗口内的任务不在队列里，由 _next_group 丢弃
+                if job in self.pending:
+                    self.pending.remove(job)
+                self._finish(job, 'cancelled', '任务已取消')
+            return job
+
+    def _finish(self, job, status, message):
+        job.status = status
+        job.message = message
+        job.finished_at = time.time()
+        # 已结束的任务只保留状态和结果；请求参数里可能有解码后的原图和掩码，
+        # 不等 _prune 丢弃任务就释放（排队时取消、处理失败的任务也一样）
+        job.params = None
+        job.done.set()
+        job.notify()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done.is_set()]
+        for job_id in finished[: max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def _take_compatible(self, key):
+        """从队列中取出第一个兼容的任务（不兼容的任务保持原有顺序）"""
+        for job in self.pending:
+            if self.batch_key(job) == key:
+                self.pending.remove(job)
+                return job
+        return None
+
+    def _next_group(self):
+        """取出下一组任务：队首任务 + 等待窗口内到达的兼容任务"""
+        with self.condition:
+            group = []
+            while not group:
+                while not self.pending:
+                    self.condition.wait()
+                group = [self.pending.popleft()]
+                if self.batch_key is not None and self.max_batch_jobs > 1:
+                    key = self.batch_key(group[0])
+                    deadline = time.monotonic() + self.batch_window
+                    while len(group) < self.max_batch_jobs:
+                        job = self._take_compatible(key)
+                        if job is not None:
+                            group.append(job)
+                            continue
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+                # 丢弃在等待窗口内被取消的任务
+                group = [job for job in group if not job.done.is_set()]
+            for job in group:
+                job.status = 'running'
+                job.started_at = time.time()
+                job.notify()
+            return group
+
+    def _run(self):
+        while True:
+            group = self._next_group()
+            try:
+                results = self.handler(group)
+            except Exception as e:
+                traceback.print_exc()
+                results = [e] * len(group)
+
+            for job, result in zip(group, results):
+                if isinstance(result, JobCancelled):
+                    self._finish(job, 'cancelled', '任务已取消')
+                elif isinstance(result, Exception):
+                    self._finish(job, 'failed', f"生成过程中出错: {str(result)}")
+                else:
+                    job.result = result
+                    self._finish(job, 'done', result.get('message', '') if isinstance(result, dict) else '')
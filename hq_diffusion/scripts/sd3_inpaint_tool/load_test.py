@@ -0,0 +1,109 @@
+"""
+生成接口本地压测：多个并发客户端向 /api/generate 提交参数兼容的任务，统计吞吐量和延迟
+
+对比跨请求合批的收益（服务端需已加载模型）：
+    MICRO_BATCH_MAX_JOBS=1 python app.py      # 关闭合批
+    python load_test.py --requests 16 --concurrency 8
+    python app.py                             # 默认合批
+    python load_test.py --requests 16 --concurrency 8
+
+已有的实测（`--requests 16 --concurrency 8 --num_inference_steps 4 --padding_mask_crop 32`，
+单核CPU上的随机初始化小模型，各跑两轮，只验证了端到端流程，不代表GPU上的收益）：
+    MICRO_BATCH_MAX_JOBS=1: 1.380 / 1.611 张/秒，延迟中位数 4.9 / 4.7 秒，p95 6.5 / 5.4 秒
+    默认（最多4个任务合批）: 1.561 / 1.561 张/秒，延迟中位数 4.9 / 4.5 秒，p95 5.4 / 5.9 秒
+CPU上算力已被单个请求占满，合批没有可利用的并行度，两者差距在噪声范围内；
+合批的收益要在GPU和真实SD3权重上用同样的命令复测。
+"""
+
+import argparse
+import base64
+import io
+import json
+import statistics
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+
+def encode_png(image):
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffered.getvalue()).decode('utf-8')
+
+
+def make_inputs(args):
+    """读取或生成测试图片，并在中间画一个矩形掩码"""
+    if args.image:
+        image = Image.open(args.image).convert("RGB")
+    else:
+        rng = np.random.default_rng(0)
+        image = Image.fromarray(rng.integers(0, 255, (args.size, args.size, 3), dtype=np.uint8))
+    mask = np.zeros((image.height, image.width, 3), dtype=np.uint8)
+    h, w = image.height // 4, image.width // 4
+    mask[image.height // 2 - h // 2:image.height // 2 + h // 2, image.width // 2 - w // 2:image.width // 2 + w // 2] = 255
+    return encode_png(image), encode_png(Image.fromarray(mask))
+
+
+def post_json(url, payload, timeout):
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode(), headers={'Content-Type': 'application/json'}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return json.loads(e.read())
+
+
+def run_request(args, payload, index):
+    start = time.perf_counter()
+    result = post_json(f"{args.url}/api/generate", {**payload, 'seed': index, 'wait': True}, args.timeout)
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:6008')
+    parser.add_argument('--requests', type=int, default=16, help='总请求数')
+    parser.add_argument('--concurrency', type=int, default=8, help='并发客户端数')
+    parser.add_argument('--num_images', type=int, default=1, help='每个请求生成的图片数')
+    parser.add_argument('--num_inference_steps', type=int, default=28)
+    parser.add_argument('--guidance_scale', type=float, default=7.0)
+    parser.add_argument('--padding_mask_crop', type=int, default=None)
+    parser.add_argument('--prompt', type=str, default='defect of crack')
+    parser.add_argument('--image', type=str, default=None, help='测试图片，不指定时生成随机图片')
+    parser.add_argument('--size', type=int, default=1024, help='随机测试图片的边长')
+    parser.add_argument('--timeout', type=float, default=3600)
+    args = parser.parse_args()
+
+    original_image, mask_image = make_inputs(args)
+    payload = {
+        'original_image': original_image,
+        'mask_image': mask_image,
+        'prompt': args.prompt,
+        'num_images': args.num_images,
+        'guidance_scale': args.guidance_scale,
+        'num_inference_steps': args.num_inference_steps,
+        'padding_mask_crop': args.padding_mask_crop,
+    }
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda i: run_request(args, payload, i), range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, result in results if result.get('success'))
+    failures = [result.get('message') for _, result in results if not result.get('success')]
+    images = sum(len(result.get('images', [])) for _, result in results)
+
+    print(f"{args.requests} 个请求（并发 {args.concurrency}），成功 {len(latencies)}，失败 {len(failures)}")
+    print(f"总耗时 {elapsed:.1f} 秒，吞吐量 {images / elapsed:.3f} 张/秒，{len(latencies) / elapsed:.3f} 请求/秒")
+    if latencies:
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"延迟: 中位数 {statistics.median(latencies):.1f} 秒, p95 {p95:.1f} 秒, 最大 {latencies[-1]:.1f} 秒")
+    for message in sorted(set(failures)):
+        print(f"失败原因: {message}")
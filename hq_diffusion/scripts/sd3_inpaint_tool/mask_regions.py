@@ -0,0 +1,175 @@
+"""
+多区域修复
+操作员在一张图上画了几处分开的缺陷时，按连通区域拆分掩码，每个区域按自己的外接矩形和padding
+单独裁剪成模型输入（各区域的细节都保留在512分辨率上，不用一个覆盖所有笔画的大裁剪框），
+所有区域的裁剪放进同一批去噪，结果再按各自的掩码贴回原图。
+"""
+
+import numpy as np
+from PIL import Image
+from scipy import ndimage
+
+from mask_utils import feather_mask
+
+EIGHT_CONNECTIVITY = np.ones((3, 3), dtype=bool)
+
+
+def _merge_close_boxes(boxes, distance):
+    """把外接矩形间距不超过distance的连通区域合并成一组
+
+    Args:
+        boxes: [(x1, y1, x2, y2), ...] 每个连通区域的外接矩形（右下角不含）
+
+    Returns:
+        list: [[连通区域序号, ...], ...]
+    """
+    parent = list(range(len(boxes)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, a in enumerate(boxes):
+        for j in range(i + 1, len(boxes)):
+            b = boxes[j]
+            if a[0] - distance < b[2] and b[0] - distance < a[2] and a[1] - distance < b[3] and b[1] - distance < a[3]:
+                parent[find(j)] = find(i)
+
+    groups = {}
+    for i in range(len(boxes)):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+
+def split_mask_regions(mask_image, merge_distance=32, max_regions=16):
+    """按8连通区域拆分掩码，相距很近的区域合并（裁剪框会大面积重叠，合在一起修复上下文更完整）
+
+    区域数超过max_regions时合并成一个区域，退回到整体裁剪。
+
+    Returns:
+        tuple: (标签图 np.ndarray[int32]，[{'labels': [标签, ...], 'bbox': (x, y, width, height)}, ...])，
+            区域按从上到下、从左到右排序；掩码为空时区域列表为空
+    """
+    mask = np.asarray(mask_image.convert("L")) > 127
+    labels, count = ndimage.label(mask, structure=EIGHT_CONNECTIVITY)
+    if count == 0:
+        return labels, []
+
+    slices = ndimage.find_objects(labels)
+    boxes = [(s[1].start, s[0].start, s[1].stop, s[0].stop) for s in slices]
+    groups = _merge_close_boxes(boxes, merge_distance)
+    if len(groups) > max_regions:
+        groups = [list(range(count))]
+
+    regions = []
+    for group in groups:
+        x1 = min(boxes[i][0] for i in group)
+        y1 = min(boxes[i][1] for i in group)
+        x2 = max(boxes[i][2] for i in group)
+        y2 = max(boxes[i][3] for i in group)
+        regions.append({'labels': [i + 1 for i in group], 'bbox': (x1, y1, x2 - x1, y2 - y1)})
+    regions.sort(key=lambda region: (region['bbox'][1], region['bbox'][0]))
+    return labels, regions
+
+
+def calculate_auto_padding(bbox, model_size=512):
+    """根据掩码外接矩形的最长边计算padding大小
+
+    Args:
+        bbox: (x, y, width, height) 掩码外接矩形
+        model_size: 模型输入尺寸（默认512）
+
+    Returns:
+        int: padding大小，使得裁剪后的区域最长边等于model_size
+    """
+    if bbox is None:
+        return 0
+
+    x, y, width, height = bbox
+    max_side = max(width, height)
+
+    if max_side >= model_size:
+        # 如果最长边已经大于等于模型尺寸，不需要padding
+        return 0
+
+    # 计算需要的padding，使得最长边等于model_size
+    padding = (model_size - max_side) // 2
+
+    return padding
+
+
+def crop_region_box(bbox, pad, image_width, image_height, width, height):
+    """外接矩形外扩pad后扩展到模型输入的宽高比，超出图像时向内平移
+
+    与 `VaeImageProcessor.get_crop_region` 的规则一致，只是直接从外接矩形计算，
+    不需要为每个区域构造整图大小的掩码再逐列扫描。
+
+    Returns:
+        tuple: (x1, y1, x2, y2)
+    """
+    x, y, w, h = bbox
+    x1, y1 = max(x - pad, 0), max(y - pad, 0)
+    x2, y2 = min(x + w + pad, image_width), min(y + h + pad, image_height)
+
+    ratio_crop_region = (x2 - x1) / (y2 - y1)
+    ratio_processing = width / height
+    if ratio_crop_region > ratio_processing:
+        desired_height_diff = int((x2 - x1) / ratio_processing - (y2 - y1))
+        y1 -= desired_height_diff // 2
+        y2 += desired_height_diff - desired_height_diff // 2
+        if y2 >= image_height:
+            y1 -= y2 - image_height
+            y2 = image_height
+        if y1 < 0:
+            y2 -= y1
+            y1 = 0
+        y2 = min(y2, image_height)
+    else:
+        desired_width_diff = int((y2 - y1) * ratio_processing - (x2 - x1))
+        x1 -= desired_width_diff // 2
+        x2 += desired_width_diff - desired_width_diff // 2
+        if x2 >= image_width:
+            x1 -= x2 - image_width
+            x2 = image_width
+        if x1 < 0:
+            x2 -= x1
+            x1 = 0
+        x2 = min(x2, image_width)
+    return x1, y1, x2, y2
+
+
+def fill_model_input(pipe, image_crop, mask_crop, width, height):
+    """把裁剪后的原图和掩码按 padding_mask_crop 的方式缩放到模型输入尺寸
+
+    pipeline收到其他尺寸的输入时直接拉伸到 width x height，而生成结果是按 resize_mode="crop"
+    缩放回裁剪框的（`resize_to_crop`、`apply_overlay` 都是如此），只有 "fill"（等比缩放、边缘填充）
+    是它的逆变换；裁剪框在图像边缘被截断成非正方形时，拉伸会让贴回的结果和掩码错位。
+    """
+    return (
+        pipe.image_processor.resize(image_crop, height=height, width=width, resize_mode="fill"),
+        pipe.mask_processor.resize(mask_crop, height=height, width=width, resize_mode="fill"),
+    )
+
+
+def region_mask_crop(labels, region, crop_box):
+    """裁剪框内只属于该区域的掩码（其他区域的笔画在这个裁剪里作为上下文保留原样）"""
+    x1, y1, x2, y2 = crop_box
+    crop = labels[y1:y2, x1:x2]
+    return Image.fromarray(np.isin(crop, region['labels']).astype(np.uint8) * 255, mode='L')
+
+
+def paste_region(base, generated, crop_box, mask_crop, feather=0):
+    """把一个区域的生成结果按该区域的掩码贴回base（原地修改）
+
+    Args:
+        generated: 已缩放到裁剪框大小的生成结果
+        feather: 掩码边缘羽化半径（像素），0为硬边，与pipeline的 `apply_overlay` 一致
+    """
+    x1, y1, x2, y2 = crop_box
+    if feather > 0:
+        mask_crop = feather_mask(mask_crop, feather)
+    blended = Image.composite(generated.convert(base.mode), base.crop(crop_box), mask_crop)
+    base.paste(blended, (x1, y1))
+    return base
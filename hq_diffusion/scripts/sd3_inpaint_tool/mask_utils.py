@@ -0,0 +1,134 @@
+"""
+掩码处理工具
+8K原图的掩码有3千多万像素，按RGB解码、LANCZOS缩放、float64求通道均值再阈值化，
+或用 np.where 构造 N×2 坐标数组求外接矩形，都会产生数百MB的临时数组。
+这里的实现全程只用单通道uint8：
+- 解码后直接转成单通道，用查找表阈值化（PIL的point），不经过float
+- 尺寸不一致时阈值化后再做最近邻缩放，结果仍然是二值掩码
+- 外接矩形按行、列做uint8最大值归约，只产生长度为高、宽的向量
+- 膨胀用可分离的一维最大值滤波（耗时与半径无关），并且只处理外接矩形附近的窗口
+"""
+
+import base64
+import io
+
+import numpy as np
+from PIL import Image, ImageFilter
+from scipy import ndimage
+
+MASK_THRESHOLD = 10  # 灰度大于此值的像素视为掩码（与画布上白色笔画、黑色背景的约定一致）
+
+
+def _threshold_lut(threshold):
+    return [255 if v > threshold else 0 for v in range(256)]
+
+
+def decode_mask(mask_base64, size=None, threshold=MASK_THRESHOLD):
+    """解码base64（data URL或纯base64）掩码图片为二值单通道掩码
+
+    Args:
+        size: 目标尺寸 (width, height)，通常为原图尺寸；与掩码尺寸不同时最近邻缩放
+
+    Returns:
+        PIL.Image: 'L' 模式，掩码区域为255，其他为0
+    """
+    if ',' in mask_base64[:100]:
+        mask_base64 = mask_base64.split(',', 1)[1]
+    mask = Image.open(io.BytesIO(base64.b64decode(mask_base64)))
+    return binarize_mask(mask, size, threshold)
+
+
+def binarize_mask(mask, size=None, threshold=MASK_THRESHOLD):
+    """任意模式的掩码图片转成二值单通道掩码，需要时最近邻缩放到size"""
+    if mask.mode != 'L':
+        mask = mask.convert('L')
+    mask = mask.point(_threshold_lut(threshold))
+    if size is not None and mask.size != tuple(size):
+        mask = mask.resize(size, Image.Resampling.NEAREST)
+    return mask
+
+
+def mask_bbox(mask, threshold=MASK_THRESHOLD):
+    """掩码的外接矩形
+
+    Args:
+        mask: PIL.Image 或 2维uint8数组
+
+    Returns:
+        tuple: (x, y, width, height)，掩码为空时返回None
+    """
+    array = np.asarray(mask)
+    rows = np.flatnonzero(array.max(axis=1) > threshold)
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(array.max(axis=0) > threshold)
+    x, y = int(cols[0]), int(rows[0])
+    return (x, y, int(cols[-1]) - x + 1, int(rows[-1]) - y + 1)
+
+
+def rle_encode(mask, threshold=MASK_THRESHOLD):
+    """二值掩码编码为COCO格式的未压缩RLE（按列优先展开，counts从0的游程开始）
+
+    Returns:
+        dict: {'size': [height, width], 'counts': [int, ...]}
+    """
+    array = np.asarray(mask)
+    height, width = array.shape
+    flat = (array.T > threshold).ravel()
+    # 值发生变化的位置即游程边界
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [flat.size]))
+    counts = np.diff(bounds).tolist()
+    if flat.size and flat[0]:
+        counts.insert(0, 0)
+    return {'size': [height, width], 'counts': counts}
+
+
+def rle_decode(rle):
+    """COCO未压缩RLE解码为二值单通道掩码（PIL.Image，'L' 模式）"""
+    height, width = rle['size']
+    counts = np.asarray(rle['counts'], dtype=np.int64)
+    values = np.zeros(counts.size, dtype=np.uint8)
+    values[1::2] = 255
+    flat = np.repeat(values, counts)
+    return Image.fromarray(np.ascontiguousarray(flat.reshape(width, height).T), mode='L')
+
+
+def dilate_mask(mask, radius, threshold=MASK_THRESHOLD):
+    """用 (2*radius+1) 的方形结构元膨胀掩码
+
+    两次一维最大值滤波实现，耗时与半径无关；只处理外接矩形外扩radius的窗口，窗口外保持为0。
+    """
+    if radius <= 0:
+        return mask
+    bbox = mask_bbox(mask, threshold)
+    if bbox is None:
+        return mask
+    x, y, w, h = bbox
+    x1, y1 = max(x - radius, 0), max(y - radius, 0)
+    x2, y2 = min(x + w + radius, mask.width), min(y + h + radius, mask.height)
+
+    window = np.asarray(mask.crop((x1, y1, x2, y2)))
+    size = 2 * radius + 1
+    window = ndimage.maximum_filter1d(window, size, axis=0, mode='constant')
+    window = ndimage.maximum_filter1d(window, size, axis=1, mode='constant')
+
+    result = Image.new('L', mask.size, 0)
+    result.paste(Image.fromarray(window, mode='L'), (x1, y1))
+    return result
+
+
+def feather_mask(mask, radius, threshold=MASK_THRESHOLD):
+    """高斯羽化掩码边缘（用于贴回结果时的软过渡），只处理外接矩形外扩3倍半径的窗口"""
+    if radius <= 0:
+        return mask
+    bbox = mask_bbox(mask, threshold)
+    if bbox is None:
+        return mask
+    x, y, w, h = bbox
+    margin = int(np.ceil(3 * radius))
+    box = (max(x - margin, 0), max(y - margin, 0), min(x + w + margin, mask.width), min(y + h + margin, mask.height))
+
+    result = Image.new('L', mask.size, 0)
+    result.paste(mask.crop(box).filter(ImageFilter.GaussianBlur(radius)), box[:2])
+    return result
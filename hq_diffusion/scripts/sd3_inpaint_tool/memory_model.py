@@ -0,0 +1,150 @@
+"""
+生成显存模型
+加载模型后用几组 (batch, 分辨率, 步数) 探测实际跑一遍pipeline，记录每组相对生成前的显存峰值，
+拟合成 峰值 ≈ 固定开销 + 每像素开销 × batch × CFG倍数 × 高 × 宽。
+生成时按当前可用显存选择最大的安全batch，而不是固定每批4张、按经验值估算显存。
+
+去噪步数不影响峰值（每一步的激活在下一步开始前已释放），探测只跑很少的步数；
+SD3默认用SDPA注意力，激活显存近似随token数线性增长，所以按像素数缩放。
+"""
+
+import threading
+import time
+
+import torch
+
+DEFAULT_PROBE_BATCHES = (1, 2, 4)
+DEFAULT_PROBE_STEPS = 2
+
+
+def available_bytes():
+    """当前可用于生成的显存：驱动报告的空闲显存 + PyTorch缓存分配器中已保留但未使用的部分"""
+    free, _ = torch.cuda.mem_get_info()
+    return free + torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+
+
+class MemoryModel:
+    """生成峰值显存的线性模型
+
+    Args:
+        safety_margin: 只使用可用显存的 (1 - safety_margin)，留给碎片和其他组件
+        max_batch_size: batch上限（显存再多也不超过，避免单批太长影响进度反馈和取消）
+    """
+
+    def __init__(self, safety_margin=0.1, max_batch_size=16):
+        self.safety_margin = safety_margin
+        self.max_batch_size = max_batch_size
+        self.fixed_bytes = None  # 与batch无关的开销（如VAE解码的工作区）
+        self.pixel_bytes = None  # 每个有效像素（含CFG的负样本）的开销
+        self.capacity_bytes = None  # 标定时（模型已加载）的可用显存，用于提交任务时的准入检查
+        self.probes = []  # [{'batch', 'height', 'width', 'steps', 'cfg', 'peak_bytes', 'seconds'}, ...]
+        self.oom_count = 0
+        self.calibrated_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def calibrated(self):
+        return self.pixel_bytes is not None
+
+    @staticmethod
+    def _units(batch, height, width, cfg):
+        return batch * (2 if cfg else 1) * height * width
+
+    def reset(self):
+        with self.lock:
+            self.fixed_bytes = None
+            self.pixel_bytes = None
+            self.capacity_bytes = None
+            self.probes = []
+            self.oom_count = 0
+            self.calibrated_at = None
+
+    def calibrate(self, run_probe, height, width, cfg=True, batches=DEFAULT_PROBE_BATCHES, steps=DEFAULT_PROBE_STEPS):
+        """依次运行探测并拟合模型，某个batch显存不足时停止（已完成的探测仍然用于拟合）
+
+        Args:
+            run_probe: `run_probe(batch, height, width, steps)`，用给定参数调用一次pipeline
+        """
+        probes = []
+        for batch in batches:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            baseline = torch.cuda.memory_allocated()
+            start = time.perf_counter()
+            try:
+                run_probe(batch, height, width, steps)
+            except torch.cuda.OutOfMemoryError:
+                torch.cuda.empty_cache()
+                break
+            torch.cuda.synchronize()
+            probes.append({
+                'batch': batch,
+                'height': height,
+                'width': width,
+                'steps': steps,
+                'cfg': cfg,
+                'peak_bytes': torch.cuda.max_memory_allocated() - baseline,
+                'seconds': round(time.perf_counter() - start, 3),
+            })
+        if not probes:
+            raise RuntimeError('显存不足，无法完成batch为1的显存探测')
+
+        self.fit(probes)
+        with self.lock:
+            self.capacity_bytes = available_bytes()
+            self.calibrated_at = time.time()
+
+    def fit(self, probes):
+        """最小二乘拟合 峰值 = fixed + pixel × units；只有一组探测时固定开销记为0"""
+        xs = [self._units(p['batch'], p['height'], p['width'], p['cfg']) for p in probes]
+        ys = [p['peak_bytes'] for p in probes]
+        n = len(xs)
+        mean_x, mean_y = sum(xs) / n, sum(ys) / n
+        var_x = sum((x - mean_x) ** 2 for x in xs)
+        if var_x > 0:
+            pixel = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+            fixed = mean_y - pixel * mean_x
+        else:
+            pixel, fixed = mean_y / mean_x, 0.0
+        # 两个参数都不能低于实测值能推出的下限，否则小batch会被低估
+        pixel = max(pixel, 0.0)
+        fixed = max(fixed, max(y - pixel * x for x, y in zip(xs, ys)))
+        with self.lock:
+            self.probes = probes
+            self.pixel_bytes = pixel
+            self.fixed_bytes = fixed
+
+    def estimate(self, batch, height, width, cfg):
+        """估算生成一批的显存峰值（字节），未标定时返回None"""
+        if not self.calibrated:
+            return None
+        return self.fixed_bytes + self.pixel_bytes * self._units(batch, height, width, cfg)
+
+    def max_batch(self, height, width, cfg, available=None, limit=None):
+        """给定可用显存下最大的安全batch，连1张都放不下时返回0"""
+        if available is None:
+            available = available_bytes()
+        budget = available * (1 - self.safety_margin) - self.fixed_bytes
+        per_image = self.pixel_bytes * self._units(1, height, width, cfg)
+        batch = int(budget // per_image) if per_image > 0 else self.max_batch_size
+        return max(0, min(batch, self.max_batch_size, limit or self.max_batch_size))
+
+    def record_oom(self, batch, height, width, cfg, available):
+        """实际生成时仍然显存不足：调高每像素开销，使这个batch在同样的可用显存下不再被选中"""
+        with self.lock:
+            self.oom_count += 1
+            units = self._units(batch, height, width, cfg)
+            needed = (available * (1 - self.safety_margin) - self.fixed_bytes) / units
+            self.pixel_bytes = max(self.pixel_bytes * 1.1, needed * 1.05)
+
+    def status(self):
+        return {
+            'calibrated': self.calibrated,
+            'fixed_gb': None if self.fixed_bytes is None else round(self.fixed_bytes / 1024**3, 3),
+            'per_image_gb': None if not self.probes else round(
+                self.pixel_bytes * self._units(1, self.probes[0]['height'], self.probes[0]['width'], self.probes[0]['cfg']) / 1024**3, 3
+            ),
+            'capacity_gb': None if self.capacity_bytes is None else round(self.capacity_bytes / 1024**3, 2),
+            'probes': self.probes,
+            'oom_count': self.oom_count,
+        }
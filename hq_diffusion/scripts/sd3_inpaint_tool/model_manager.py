@@ -0,0 +1,351 @@
+"""
+模型管理器
+常驻缓存SD3 Inpaint基础pipeline（按文件内容指纹索引），LoRA通过PEFT adapter名称加载、卸载和切换，
+切换LoRA时不重新加载、不重新转换基础权重。多个LoRA可以同时挂在基础模型上，每个请求选择一个或按权重混合多个，
+adapter权重放在按显存预算管理的LRU池里，超出预算时最久未用的adapter先移到CPU内存，再超出则从模型上删除（回落到磁盘文件）
+"""
+
+import contextlib
+import gc
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+from diffusers.pipelines import StableDiffusion3InpaintPipeline
+
+FINGERPRINT_CHUNK_SIZE = 16 * 1024 * 1024  # 指纹采样的首尾块大小
+LORA_COMPONENTS = ('transformer', 'text_encoder', 'text_encoder_2')  # 可能挂LoRA的pipeline组件
+TEXT_ENCODER_OFFLOAD_COMPONENTS = {
+    't5': ('text_encoder_3',),
+    'all': ('text_encoder', 'text_encoder_2', 'text_encoder_3'),
+}
+
+
+def file_fingerprint(path):
+    """文件内容指纹：文件大小 + 首尾各16MB的sha256
+
+    完整哈希十几GB的checkpoint需要几十秒，首尾采样足以区分不同的权重文件。
+    目录（如save_lora_weights的输出目录）按文件名排序后逐个计入。
+    """
+    h = hashlib.sha256()
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(path, name) for name in os.listdir(path) if os.path.isfile(os.path.join(path, name))
+        )
+    else:
+        files = [path]
+
+    for file in files:
+        size = os.path.getsize(file)
+        h.update(f"{os.path.basename(file)}:{size}".encode())
+        with open(file, 'rb') as f:
+            h.update(f.read(FINGERPRINT_CHUNK_SIZE))
+            if size > FINGERPRINT_CHUNK_SIZE:
+                f.seek(max(FINGERPRINT_CHUNK_SIZE, size - FINGERPRINT_CHUNK_SIZE))
+                h.update(f.read(FINGERPRINT_CHUNK_SIZE))
+    return h.hexdigest()
+
+
+class ModelManager:
+    """持有基础pipeline和已加载的LoRA adapter
+
+    - 基础模型按内容指纹缓存：再次加载同一个checkpoint（包括不同路径下的相同文件）直接复用
+    - 每个LoRA作为一个PEFT adapter加载到同一个transformer上，名称由调用方指定，
+      默认为 `lora_<指纹前12位>`；切换和混合只调用 `set_adapters`，基础权重保持不变
+    - adapter按LRU顺序管理，位置为 'gpu'、'cpu' 或 'disk'（已从模型删除，需要时从原文件重新加载）。
+      GPU上的adapter超过 `gpu_budget_bytes` 时，最久未用的移到CPU；CPU上的超过 `cpu_budget_bytes` 时删除。
+      启用CPU offload时整个模型由hook搬运，adapter不单独放CPU，超出预算直接删除
+    """
+
+    def __init__(self, device, gpu_budget_bytes=2 * 1024**3, cpu_budget_bytes=8 * 1024**3, text_encoder_offload=None):
+        self.device = device
+        # 提示词embedding有缓存时文本编码器只在缓存未命中时才用：'t5' 平时把T5放在CPU，'all' 三个编码器都放CPU
+        self.text_encoder_offload = text_encoder_offload
+        self.pipe = None
+        self.base_path = None
+        self.base_fingerprint = None
+        self.use_cpu_offload = False
+        self.gpu_budget_bytes = gpu_budget_bytes
+        self.cpu_budget_bytes = cpu_budget_bytes
+        # adapter名称 -> {'path', 'fingerprint', 'bytes', 'location'}，顺序即LRU顺序（最近使用的在末尾）
+        self.adapters = OrderedDict()
+        self.active_adapters = {}  # 当前生效的adapter名称 -> 权重
+        self.adapters_changed = False  # 新加载的adapter会被PEFT设为生效，需要重新设置生效的adapter
+        self.lock = threading.RLock()
+
+    def load_base(self, sd3_path):
+        """加载基础pipeline，内容相同则复用已加载的模型
+
+        Returns:
+            bool: 是否复用了已加载的模型
+        """
+        with self.lock:
+            fingerprint = file_fingerprint(sd3_path)
+            if self.pipe is not None and fingerprint == self.base_fingerprint:
+                self.base_path = sd3_path
+                print(f"复用已加载的SD3模型: {sd3_path}")
+                return True
+
+            # 换了基础模型，旧模型和挂在上面的LoRA一起释放
+            self.release_base()
+            print(f"正在加载SD3 Inpaint pipeline: {sd3_path}")
+            start = time.perf_counter()
+            self.pipe = StableDiffusion3InpaintPipeline.from_single_file(
+                sd3_path,
+                torch_dtype=torch.bfloat16 if self.device == "cuda" else torch.float32
+            )
+            self._place_pipeline()
+            for name in self._offloadable_text_encoders():
+                getattr(self.pipe, name).to('cpu')
+            self.base_path = sd3_path
+            self.base_fingerprint = fingerprint
+            print(f"SD3模型加载完成，耗时 {time.perf_counter() - start:.1f} 秒")
+            return False
+
+    def _place_pipeline(self):
+        """将模型移动到GPU并设置精度、offload和slicing"""
+        pipe = self.pipe
+        if self.device != "cuda":
+            self.pipe = pipe.to(self.device)
+            self.use_cpu_offload = False
+            return
+
+        pipe.text_encoder.to(torch.bfloat16)
+        pipe.text_encoder_2.to(torch.bfloat16)
+        pipe.text_encoder_3.to(torch.bfloat16)
+
+        # 检查可用显存，GPU显存小于24GB时启用CPU offload
+        total_memory = torch.cuda.get_device_properties(0).total_memory / 1024**3
+        if total_memory < 24:
+            try:
+                # 注意：enable_model_cpu_offload需要模型在CPU上
+                pipe.enable_model_cpu_offload()
+                self.use_cpu_offload = True
+                print("已启用 CPU offload 以节省显存")
+            except Exception as e:
+                print(f"启用CPU offload失败: {e}，将使用GPU模式")
+                pipe = pipe.to(self.device)
+                self.use_cpu_offload = False
+        else:
+            pipe = pipe.to(self.device)
+            self.use_cpu_offload = False
+
+        # 启用attention slicing以减少显存使用
+        try:
+            pipe.enable_attention_slicing()
+            print("已启用 attention slicing")
+        except Exception:
+            pass
+
+        # 启用VAE slicing以减少VAE显存使用
+        try:
+            pipe.enable_vae_slicing()
+            print("已启用 VAE slicing")
+        except Exception:
+            pass
+
+        self.pipe = pipe
+
+    def release_base(self):
+        """释放基础pipeline和所有LoRA占用的显存"""
+        with self.lock:
+            if self.pipe is None:
+                return
+            print("正在释放模型显存...")
+            try:
+                # 将模型移到CPU
+                self.pipe.to('cpu')
+            except Exception as e:
+                print(f"释放pipeline时出错: {e}")
+            self.pipe = None
+            self.base_path = None
+            self.base_fingerprint = None
+            self.adapters = OrderedDict()
+            self.active_adapters = {}
+
+            # 清理GPU缓存并强制垃圾回收
+            gc.collect()
+            if self.device == "cuda":
+                torch.cuda.empty_cache()
+                torch.cuda.ipc_collect()
+            print("显存释放完成")
+
+    def _offloadable_text_encoders(self):
+        """平时放在CPU的文本编码器（CPU offload模式下由hook管理，不单独移动）"""
+        if self.text_encoder_offload is None or self.use_cpu_offload or self.device != "cuda" or self.pipe is None:
+            return []
+        names = TEXT_ENCODER_OFFLOAD_COMPONENTS[self.text_encoder_offload]
+        return [name for name in names if getattr(self.pipe, name, None) is not None]
+
+    @contextlib.contextmanager
+    def text_encoders_on_device(self):
+        """编码提示词期间把放在CPU的文本编码器临时移到GPU，结束后移回并释放显存"""
+        names = self._offloadable_text_encoders()
+        for name in names:
+            getattr(self.pipe, name).to(self.device)
+        try:
+            yield
+        finally:
+            for name in names:
+                getattr(self.pipe, name).to('cpu')
+            if names:
+                torch.cuda.empty_cache()
+
+    def text_encoder_identity(self):
+        """文本编码器的标识：基础模型指纹 + 生效的、带文本编码器LoRA的adapter及其权重"""
+        text_encoder_adapters = tuple(sorted(
+            (name, weight) for name, weight in self.active_adapters.items() if self.adapters[name]['text_encoder']
+        ))
+        return self.base_fingerprint, text_encoder_adapters
+
+    def load_adapter(self, lora_path, adapter_name=None, activate=True):
+        """加载LoRA（内容相同且已加载则跳过），可选地设为当前唯一生效的adapter
+
+        Returns:
+            str: adapter名称
+        """
+        with self.lock:
+            if self.pipe is None:
+                raise RuntimeError("请先加载SD3模型")
+            fingerprint = file_fingerprint(lora_path)
+            name = adapter_name or f"lora_{fingerprint[:12]}"
+            info = self.adapters.get(name)
+            if info is not None and info['fingerprint'] != fingerprint:
+                # 同名adapter换了权重文件，先删掉旧的
+                self.unload_adapter(name)
+                info = None
+            if info is None:
+                self.adapters[name] = {
+                    'path': lora_path,
+                    'fingerprint': fingerprint,
+                    'bytes': 0,
+                    'location': 'disk',
+                    'text_encoder': False,  # 是否带文本编码器的LoRA（影响提示词embedding）
+                }
+            self._make_resident(name)
+            self.activate({name: 1.0} if activate else self.active_adapters)
+            return name
+
+    def activate(self, selection):
+        """设置生效的adapter
+
+        Args:
+            selection: None/空表示只使用基础模型；字符串为单个adapter名称；
+                字典 {名称: 权重} 为多个adapter的加权混合
+        """
+        if isinstance(selection, str):
+            selection = {selection: 1.0}
+        selection = dict(selection or {})
+        with self.lock:
+            unknown = [name for name in selection if name not in self.adapters]
+            if unknown:
+                raise KeyError(f"未加载的LoRA adapter: {', '.join(unknown)}")
+            if selection == self.active_adapters and not self.adapters_changed:
+                for name in selection:
+                    self.adapters.move_to_end(name)
+                return
+
+            for name in selection:
+                self._make_resident(name)
+            if selection:
+                self.pipe.enable_lora()
+                self.pipe.set_adapters(list(selection), adapter_weights=list(selection.values()))
+            elif any(info['location'] != 'disk' for info in self.adapters.values()):
+                self.pipe.disable_lora()
+            self.active_adapters = selection
+            self.adapters_changed = False
+            self._enforce_budget(keep=set(selection))
+
+    def unload_adapter(self, name):
+        """从transformer上删除adapter并忘记它"""
+        with self.lock:
+            if name not in self.adapters:
+                raise KeyError(f"未加载的LoRA adapter: {name}")
+            if self.adapters[name]['location'] != 'disk':
+                self.pipe.delete_adapters(name)
+            del self.adapters[name]
+            if name in self.active_adapters:
+                self.activate({k: v for k, v in self.active_adapters.items() if k != name})
+
+    def _adapter_layers(self, name):
+        """adapter在各组件上的LoRA子模块（lora_A / lora_B）"""
+        for component in LORA_COMPONENTS:
+            model = getattr(self.pipe, component, None)
+            if model is None:
+                continue
+            for module in model.modules():
+                for attr in ('lora_A', 'lora_B'):
+                    layers = getattr(module, attr, None)
+                    if isinstance(layers, torch.nn.ModuleDict) and name in layers:
+                        yield layers[name]
+
+    def _make_resident(self, name):
+        """确保adapter在推理设备上，并标记为最近使用"""
+        info = self.adapters[name]
+        if info['location'] == 'disk':
+            start = time.perf_counter()
+            print(f"正在加载LoRA权重: {info['path']} (adapter: {name})")
+            self.pipe.load_lora_weights(info['path'], adapter_name=name)
+            self.adapters_changed = True
+            info['bytes'] = sum(
+                p.numel() * p.element_size() for layer in self._adapter_layers(name) for p in layer.parameters()
+            )
+            info['text_encoder'] = any(
+                name in getattr(module, 'lora_A', {})
+                for component in ('text_encoder', 'text_encoder_2')
+                if getattr(self.pipe, component, None) is not None
+                for module in getattr(self.pipe, component).modules()
+            )
+            print(f"LoRA加载完成，耗时 {time.perf_counter() - start:.2f} 秒，{info['bytes'] / 1024**2:.1f} MB")
+        elif info['location'] == 'cpu':
+            for layer in self._adapter_layers(name):
+                layer.to(self.device)
+        info['location'] = 'gpu'
+        self.adapters.move_to_end(name)
+
+    def _enforce_budget(self, keep):
+        """按LRU顺序把超出显存预算的adapter移到CPU，超出内存预算的删除；`keep` 中的adapter不动"""
+        def total(location):
+            return sum(info['bytes'] for info in self.adapters.values() if info['location'] == location)
+
+        for name, info in list(self.adapters.items()):
+            if total('gpu') <= self.gpu_budget_bytes:
+                break
+            if name in keep or info['location'] != 'gpu':
+                continue
+            if self.use_cpu_offload or self.device != "cuda":
+                self._evict_to_disk(name)
+            else:
+                for layer in self._adapter_layers(name):
+                    layer.to('cpu')
+                info['location'] = 'cpu'
+                print(f"LoRA adapter {name} 已移到CPU内存")
+
+        for name, info in list(self.adapters.items()):
+            if total('cpu') <= self.cpu_budget_bytes:
+                break
+            if name not in keep and info['location'] == 'cpu':
+                self._evict_to_disk(name)
+
+    def _evict_to_disk(self, name):
+        self.pipe.delete_adapters(name)
+        self.adapters[name]['location'] = 'disk'
+        print(f"LoRA adapter {name} 已从模型删除，需要时从 {self.adapters[name]['path']} 重新加载")
+
+    def status(self):
+        return {
+            'base_path': self.base_path,
+            'adapters': [
+                {
+                    'name': name,
+                    'path': info['path'],
+                    'location': info['location'],
+                    'size_mb': round(info['bytes'] / 1024**2, 1),
+                    'weight': self.active_adapters.get(name),
+                }
+                for name, info in self.adapters.items()
+            ],
+        }
@@ -0,0 +1,101 @@
+"""
+模型工作进程（生产模式）
+长期运行的单个进程持有SD3 pipeline、LoRA、显存模型和生成任务队列，独占GPU；
+HTTP工作进程（gunicorn的多个worker，或 `python app.py`）只负责解析请求、解码图片和掩码、返回结果文件，
+通过本地Unix socket上的 multiprocessing manager 调用这里的 `LocalBackend`。
+重启或扩容HTTP层不会重新加载模型，请求解析和编码也不再和GIL下的生成循环争抢。
+
+    SD3_MODEL_WORKER_SOCKET=/tmp/sd3_inpaint_model.sock python model_worker.py
+    SD3_MODEL_WORKER_SOCKET=/tmp/sd3_inpaint_model.sock gunicorn -w 4 -k gthread --threads 16 -b 0.0.0.0:6008 app:app
+
+（serve.sh 会按这个顺序启动两者，模型工作进程已在运行时只重启HTTP层）
+"""
+
+import os
+import threading
+from multiprocessing.managers import BaseManager
+
+DEFAULT_SOCKET = '/tmp/sd3_inpaint_model.sock'
+DEFAULT_AUTHKEY = 'sd3-inpaint'
+
+
+class ModelWorkerUnavailable(RuntimeError):
+    """连接不上模型工作进程（未启动或正在重启）"""
+
+
+class ModelWorkerManager(BaseManager):
+    pass
+
+
+ModelWorkerManager.register('backend')
+
+
+class RemoteBackend:
+    """HTTP工作进程一侧的模型后端，方法与 `app.LocalBackend` 相同，调用转发到模型工作进程
+
+    首次调用时才连接；连接断开（模型工作进程重启）时抛出 ModelWorkerUnavailable，下一次调用重新连接。
+    代理对象为每个线程建立自己的连接，可以在多个请求线程中共用。
+    """
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self.proxy = None
+        self.lock = threading.Lock()
+
+    def _get_proxy(self):
+        with self.lock:
+            if self.proxy is None:
+                manager = ModelWorkerManager(address=self.address, authkey=self.authkey)
+                try:
+                    manager.connect()
+                except (ConnectionError, FileNotFoundError) as e:
+                    raise ModelWorkerUnavailable(f"无法连接模型工作进程 ({self.address}): {e}") from e
+                self.proxy = manager.backend()
+            return self.proxy
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            proxy = self._get_proxy()
+            try:
+                return getattr(proxy, name)(*args, **kwargs)
+            except (ConnectionError, EOFError) as e:
+                with self.lock:
+                    self.proxy = None
+                raise ModelWorkerUnavailable(f"与模型工作进程的连接已断开: {e}") from e
+
+        return call
+
+
+def serve(address, authkey):
+    """在address（Unix socket路径）上提供模型后端，直到进程退出"""
+    # 延迟导入：HTTP工作进程导入本模块时不需要构造模型工作进程的状态
+    import app as inpaint_app
+
+    # 与HTTP进程共享上传原图的目录，不依赖本进程是否设置了 SD3_MODEL_WORKER_SOCKET
+    os.makedirs(inpaint_app.IMAGE_STORE_DIR, exist_ok=True)
+    inpaint_app.image_store.directory = inpaint_app.IMAGE_STORE_DIR
+
+    backend = inpaint_app.LocalBackend()
+    inpaint_app.backend = backend
+
+    class ServerManager(BaseManager):
+        pass
+
+    ServerManager.register('backend', callable=lambda: backend)
+
+    if os.path.exists(address):
+        os.remove(address)  # 上次异常退出留下的socket文件
+    server = ServerManager(address=address, authkey=authkey).get_server()
+    print(f"模型工作进程已启动 (pid {os.getpid()})，监听 {address}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    serve(
+        os.environ.get('SD3_MODEL_WORKER_SOCKET', DEFAULT_SOCKET),
+        os.environ.get('SD3_MODEL_WORKER_AUTHKEY', DEFAULT_AUTHKEY).encode(),
+    )
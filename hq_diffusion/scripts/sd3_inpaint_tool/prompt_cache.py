@@ -0,0 +1,51 @@
+"""
+提示词embedding缓存
+操作员实际只用少数几个提示词，每批都让CLIP-L、CLIP-G和T5-XXL重新编码是浪费。
+缓存按 (文本编码器标识, 提示词, 负面提示词, 是否CFG, 最大token长度) 索引，
+保存未裁剪的 prompt_embeds / pooled_prompt_embeds（及negative版本），batch为1。
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class PromptEmbeddingCache:
+    """LRU缓存，max_entries为0时不缓存"""
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -1,6 +1,7 @@
 #!/bin/bash
 
-# 重启Flask应用脚本
+# 重启Flask应用脚本（开发模式，模型随进程一起重新加载）
+# 生产模式请使用 serve.sh：只重启HTTP层，模型工作进程保留已加载的模型
 
 cd "$(dirname "$0")"
 
@@ -0,0 +1,44 @@
+#!/bin/bash
+
+# 生产模式启动脚本
+# 模型工作进程（model_worker.py）持有模型和GPU，已在运行时直接复用（已加载的模型不会丢失）；
+# HTTP层（gunicorn多worker，没有gunicorn时为单进程Flask）每次都重启。
+# 需要连模型一起重启时先执行: pkill -f "python.*model_worker.py"
+
+cd "$(dirname "$0")"
+
+export SD3_MODEL_WORKER_SOCKET=${SD3_MODEL_WORKER_SOCKET:-/tmp/sd3_inpaint_model.sock}
+HTTP_WORKERS=${HTTP_WORKERS:-4}
+PORT=${PORT:-6008}
+
+echo "==================================="
+echo "SD3 Inpainting 工具（生产模式）"
+echo "==================================="
+
+if pgrep -f "python.*model_worker.py" > /dev/null; then
+    echo "模型工作进程已在运行，复用已加载的模型"
+else
+    echo "正在启动模型工作进程..."
+    nohup python model_worker.py > model_worker.log 2>&1 &
+    # 等待socket就绪
+    for i in $(seq 1 60); do
+        [ -S "$SD3_MODEL_WORKER_SOCKET" ] && break
+        sleep 1
+    done
+fi
+
+echo "正在重启HTTP工作进程..."
+pkill -f "gunicorn.*app:app" 2>/dev/null
+pkill -f "python.*app.py" 2>/dev/null
+sleep 1
+
+echo "访问地址: http://0.0.0.0:$PORT"
+echo ""
+
+if command -v gunicorn > /dev/null; then
+    # gthread worker：SSE长连接和等待生成的请求只占用线程
+    exec gunicorn -w "$HTTP_WORKERS" -k gthread --threads 16 -b "0.0.0.0:$PORT" app:app
+else
+    echo "未安装gunicorn，使用单进程HTTP服务"
+    exec python app.py
+fi
@@ -1,5 +1,7 @@
 // 全局变量
 let originalImage = null;
+let originalImageFile = null; // 上传的原图文件（原始字节只上传一次）
+let originalImageUpload = null; // 上传原图的Promise，结果为服务端图片id
 let currentTool = 'brush'; // 'brush' or 'rect'
 let brushSize = 20;
 let isDrawing = false;
@@ -10,7 +12,7 @@ let lastY = 0;
 let maskDrawn = false;
 
 // 图片查看器相关
-let generatedImages = []; // 存储生成的图片数据
+let generatedImages = []; // 生成的图片URL（/api/results/<结果id>）
 let currentImageIndex = 0;
 let maskOverlayCanvas = null;
 let maskOverlayCtx = null;
@@ -19,6 +21,8 @@ let showCropOverlay = false;
 let currentMaskImageData = null;
 let currentCropInfo = null; // 裁剪区域信息
 let currentBbox = null; // 掩码外接矩形信息
+let currentJobId = null; // 正在执行的生成任务id
+const JOB_POLL_INTERVAL_MS = 1000; // 任务状态轮询间隔
 
 // Canvas元素和Context（延迟初始化）
 let originalCanvas, maskCanvas, drawCanvas;
@@ -115,6 +119,11 @@ async function loadModels() {
         }
     }
     
+    const adapterName = document.getElementById('adapter_name').value.trim();
+    if (adapterName) {
+        formData.append('adapter_name', adapterName);
+    }
+    
     try {
         const response = await fetch('/api/load_models', {
             method: 'POST',
@@ -129,6 +138,7 @@ async function loadModels() {
             
             // 启用生成按钮
             document.getElementById('generate-btn').disabled = false;
+            refreshAdapterList();
         } else {
             loadStatus.textContent = '错误: ' + data.message;
             loadStatus.className = 'status-message error';
@@ -141,11 +151,45 @@ async function loadModels() {
     }
 }
 
+// 刷新已加载的LoRA列表（用于LoRA输入框的候选项）
+function refreshAdapterList() {
+    fetch('/api/adapters')
+        .then(response => response.json())
+        .then(data => {
+            const list = document.getElementById('adapter-list');
+            if (!list || !data.adapters) return;
+            list.innerHTML = '';
+            data.adapters.forEach(adapter => {
+                const option = document.createElement('option');
+                option.value = adapter.name;
+                list.appendChild(option);
+            });
+        })
+        .catch(error => {
+            console.error('获取LoRA列表失败:', error);
+        });
+}
+
+// 解析LoRA输入："crack" 或 "crack:0.7, stain:0.3"，留空返回null（沿用当前LoRA）
+function parseAdapterSelection(text) {
+    const adapters = {};
+    text.split(',').map(item => item.trim()).filter(item => item).forEach(item => {
+        const [name, weight] = item.split(':').map(part => part.trim());
+        adapters[name] = weight ? parseFloat(weight) : 1.0;
+    });
+    return Object.keys(adapters).length > 0 ? adapters : null;
+}
+
 // 处理图片上传
 function handleImageUpload(event) {
     const file = event.target.files[0];
     if (!file) return;
     
+    // 原图只上传一次，之后的请求只传图片id和掩码
+    originalImageFile = file;
+    originalImageUpload = null;
+    ensureImageUploaded().catch(error => console.error('上传原图失败:', error));
+    
     const reader = new FileReader();
     reader.onload = function(e) {
         const img = new Image();
@@ -435,6 +479,49 @@ function initCanvasEvents() {
 }
 
 
+// 上传原图（force为true时重新上传），返回服务端图片id
+function ensureImageUploaded(force = false) {
+    if (originalImageUpload && !force) {
+        return originalImageUpload;
+    }
+    const formData = new FormData();
+    formData.append('image', originalImageFile);
+    originalImageUpload = fetch('/api/upload_image', {
+        method: 'POST',
+        body: formData
+    })
+        .then(response => response.json())
+        .then(result => {
+            if (!result.success) {
+                throw new Error(result.message);
+            }
+            return result.image_id;
+        });
+    // 上传失败时下次重新上传
+    originalImageUpload.catch(() => { originalImageUpload = null; });
+    return originalImageUpload;
+}
+
+// 发送带原图id的JSON请求；服务端图片已被淘汰时重新上传后重试一次
+async function postWithImage(url, payload) {
+    let result = null;
+    for (let attempt = 0; attempt < 2; attempt++) {
+        const imageId = await ensureImageUploaded(attempt > 0);
+        const response = await fetch(url, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ ...payload, image_id: imageId })
+        });
+        result = await response.json();
+        if (!result.image_expired) {
+            break;
+        }
+    }
+    return result;
+}
+
 // 计算自动padding
 async function calculateAutoPadding() {
     if (!originalImage || !maskDrawn) {
@@ -447,28 +534,18 @@ async function calculateAutoPadding() {
     autoPaddingBtn.textContent = '计算中...';
     
     try {
-        const originalImageData = originalCanvas.toDataURL('image/png');
         const maskImageData = maskCanvas.toDataURL('image/png');
         
-        const response = await fetch('/api/calculate_mask_info', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                original_image: originalImageData,
-                mask_image: maskImageData
-            })
+        const result = await postWithImage('/api/calculate_mask_info', {
+            mask_image: maskImageData
         });
         
-        const result = await response.json();
-        
         if (result.success) {
             // 设置自动计算的padding
             document.getElementById('padding_mask_crop').value = result.auto_padding;
             
             // 更新掩码信息显示
-            updateMaskInfoDisplay(result.bbox, result.auto_padding);
+            updateMaskInfoDisplay(result.bbox, result.auto_padding, result.regions);
         } else {
             alert('计算失败: ' + result.message);
         }
@@ -487,24 +564,15 @@ function updateMaskInfo() {
         return;
     }
     
-    // 调用API计算掩码信息
-    const originalImageData = originalCanvas.toDataURL('image/png');
+    // 调用API计算掩码信息（只传掩码，原图用已上传的id）
     const maskImageData = maskCanvas.toDataURL('image/png');
     
-    fetch('/api/calculate_mask_info', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json'
-        },
-        body: JSON.stringify({
-            original_image: originalImageData,
-            mask_image: maskImageData
-        })
+    postWithImage('/api/calculate_mask_info', {
+        mask_image: maskImageData
     })
-    .then(response => response.json())
     .then(result => {
         if (result.success) {
-            updateMaskInfoDisplay(result.bbox, result.auto_padding);
+            updateMaskInfoDisplay(result.bbox, result.auto_padding, result.regions);
         }
     })
     .catch(error => {
@@ -513,7 +581,7 @@ function updateMaskInfo() {
 }
 
 // 更新掩码信息显示
-function updateMaskInfoDisplay(bbox, autoPadding) {
+function updateMaskInfoDisplay(bbox, autoPadding, regions) {
     if (!bbox) {
         document.getElementById('mask-info-section').style.display = 'none';
         return;
@@ -521,6 +589,7 @@ function updateMaskInfoDisplay(bbox, autoPadding) {
     
     document.getElementById('mask-info-section').style.display = 'block';
     document.getElementById('bbox-info').textContent = `位置: (${bbox.x}, ${bbox.y}), 尺寸: ${bbox.width} x ${bbox.height}`;
+    document.getElementById('region-info').textContent = regions ? `${regions.length} 个` : '-';
     document.getElementById('model-size-info').textContent = '512 x 512';
 }
 
@@ -544,8 +613,7 @@ async function generateDefects() {
     generateStatus.className = 'status-message info';
     
     try {
-        // 获取原始图片和掩码的base64
-        const originalImageData = originalCanvas.toDataURL('image/png');
+        // 获取掩码的base64（原图用已上传的id）
         const maskImageData = maskCanvas.toDataURL('image/png');
         
         // 获取参数
@@ -554,51 +622,45 @@ async function generateDefects() {
         const paddingMaskCrop = paddingMaskCropValue ? parseInt(paddingMaskCropValue) : null;
         
         const data = {
-            original_image: originalImageData,
             mask_image: maskImageData,
             prompt: document.getElementById('prompt').value || 'defect of crack',
             negative_prompt: document.getElementById('negative_prompt').value,
             num_images: parseInt(document.getElementById('num_images').value) || 4,
             guidance_scale: parseFloat(document.getElementById('guidance_scale').value) || 7.0,
             num_inference_steps: parseInt(document.getElementById('num_inference_steps').value) || 28,
-            padding_mask_crop: paddingMaskCrop
+            padding_mask_crop: paddingMaskCrop,
+            split_regions: document.getElementById('split_regions').checked
         };
+        const adapters = parseAdapterSelection(document.getElementById('adapters').value);
+        if (adapters) {
+            data.adapters = adapters;
+        }
         
-        const response = await fetch('/api/generate', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify(data)
-        });
+        // 提交任务，立即返回任务id
+        const submitted = await postWithImage('/api/generate', data);
+        if (!submitted.success) {
+            throw new Error(submitted.message);
+        }
         
-        const result = await response.json();
+        // 保存当前掩码、裁剪区域和边界框信息用于显示，结果图片每批生成完就追加显示
+        currentJobId = submitted.job_id;
+        document.getElementById('cancel-btn').style.display = '';
+        generatedImages = [];
+        currentImageIndex = 0;
+        if (maskCanvas) {
+            currentMaskImageData = maskCanvas.toDataURL('image/png');
+        }
+        currentCropInfo = submitted.crop_info || null;
+        currentBbox = submitted.bbox || null;
+        
+        const result = await waitForJobEvents(currentJobId, generateStatus, appendGeneratedImages);
         
         if (result.success) {
             generateStatus.textContent = result.message + ' (保存路径: ' + result.output_dir + ')';
             generateStatus.className = 'status-message success';
             
-            // 保存生成的图片数据
-            generatedImages = result.images;
-            currentImageIndex = 0;
-            
-            // 保存当前掩码数据用于显示
-            if (maskCanvas) {
-                currentMaskImageData = maskCanvas.toDataURL('image/png');
-            }
-            
-            // 保存裁剪区域和边界框信息
-            currentCropInfo = result.crop_info || null;
-            currentBbox = result.bbox || null;
-            
-            // 初始化图片查看器
-            initializeImageViewer();
-            
-            // 显示第一张图片
-            displayImage(0);
-            
-            // 滚动到结果区域
-            document.querySelector('.results-section').scrollIntoView({ behavior: 'smooth' });
+            // 以最终结果为准（轮询模式下图片只在这里返回）
+            appendGeneratedImages(0, result.images);
         } else {
             generateStatus.textContent = '错误: ' + result.message;
             generateStatus.className = 'status-message error';
@@ -608,6 +670,105 @@ async function generateDefects() {
         generateStatus.className = 'status-message error';
     } finally {
         generateBtn.disabled = false;
+        currentJobId = null;
+        document.getElementById('cancel-btn').style.display = 'none';
+    }
+}
+
+// 追加显示新生成的图片（start为这批图片的起始序号），第一批到达时初始化查看器
+function appendGeneratedImages(start, images) {
+    if (!images || images.length === 0) return;
+    const firstBatch = generatedImages.length === 0;
+    images.forEach((url, i) => {
+        generatedImages[start + i] = url;
+    });
+    
+    if (firstBatch) {
+        initializeImageViewer();
+        displayImage(0);
+        document.querySelector('.results-section').scrollIntoView({ behavior: 'smooth' });
+    } else {
+        updateImageCounter();
+        document.getElementById('next-btn').disabled = (currentImageIndex === generatedImages.length - 1);
+    }
+}
+
+// 显示任务进度
+function showJobProgress(job, statusElement) {
+    if (job.status === 'queued') {
+        statusElement.textContent = `排队中，前面还有 ${job.queue_position} 个任务...`;
+    } else if (job.status === 'running') {
+        const p = job.progress;
+        const percent = Math.round(p.fraction * 100);
+        statusElement.textContent = `正在生成: 第 ${p.batch}/${p.total_batches} 批，步数 ${p.step}/${p.total_steps}，已完成 ${p.images_done}/${p.total_images} 张 (${percent}%)`;
+    }
+}
+
+// 通过Server-Sent Events接收任务进度和每批结果，任务结束后返回结果；
+// 浏览器不支持或连接失败时退回到轮询
+function waitForJobEvents(jobId, statusElement, onImages) {
+    if (!window.EventSource) {
+        return waitForJob(jobId, statusElement);
+    }
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(`/api/jobs/${jobId}/events`);
+        const finish = (result) => {
+            source.close();
+            resolve(result);
+        };
+        
+        source.addEventListener('progress', (event) => {
+            showJobProgress(JSON.parse(event.data), statusElement);
+        });
+        source.addEventListener('images', (event) => {
+            const data = JSON.parse(event.data);
+            onImages(data.start, data.images);
+        });
+        source.addEventListener('done', (event) => finish(JSON.parse(event.data)));
+        source.addEventListener('failed', (event) => finish(JSON.parse(event.data)));
+        source.addEventListener('cancelled', (event) => {
+            // 已生成的图片保留显示
+            finish({ ...JSON.parse(event.data), message: '任务已取消' });
+        });
+        source.onerror = () => {
+            source.close();
+            waitForJob(jobId, statusElement).then(resolve, reject);
+        };
+    });
+}
+
+// 轮询任务状态并显示进度，任务结束后返回结果
+async function waitForJob(jobId, statusElement) {
+    while (true) {
+        const response = await fetch(`/api/jobs/${jobId}`);
+        const job = await response.json();
+        if (!job.success) {
+            throw new Error(job.message);
+        }
+        
+        if (job.status === 'queued' || job.status === 'running') {
+            showJobProgress(job, statusElement);
+        } else {
+            const resultResponse = await fetch(`/api/jobs/${jobId}/result`);
+            const result = await resultResponse.json();
+            if (job.status === 'cancelled') {
+                result.message = '任务已取消';
+            }
+            return result;
+        }
+        
+        await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+    }
+}
+
+// 取消当前生成任务
+async function cancelGeneration() {
+    if (!currentJobId) return;
+    try {
+        await fetch(`/api/jobs/${currentJobId}/cancel`, { method: 'POST' });
+        document.getElementById('generate-status').textContent = '正在取消...';
+    } catch (error) {
+        console.error('取消任务失败:', error);
     }
 }
 
@@ -857,11 +1018,18 @@ function updateCropOverlay() {
         const scaleX = imgRect.width / originalWidth;
         const scaleY = imgRect.height / originalHeight;
         
-        // 计算裁剪区域在显示图片中的位置和尺寸
-        const cropX = currentCropInfo.x * scaleX + imgLeft;
-        const cropY = currentCropInfo.y * scaleY + imgTop;
-        const cropWidth = currentCropInfo.width * scaleX;
-        const cropHeight = currentCropInfo.height * scaleY;
+        // 计算裁剪区域在显示图片中的位置和尺寸（按连通区域分别修复时有多个裁剪区域）
+        const crops = (Array.isArray(currentCropInfo) ? currentCropInfo : [currentCropInfo]).map(crop => ({
+            x: crop.x * scaleX + imgLeft,
+            y: crop.y * scaleY + imgTop,
+            width: crop.width * scaleX,
+            height: crop.height * scaleY
+        }));
+        const strokeCrops = () => {
+            maskOverlayCtx.strokeStyle = 'rgba(0, 150, 255, 0.8)';
+            maskOverlayCtx.lineWidth = 3;
+            crops.forEach(crop => maskOverlayCtx.strokeRect(crop.x, crop.y, crop.width, crop.height));
+        };
         
         // 如果同时显示掩码，先绘制掩码overlay
         if (showMaskOverlay && currentMaskImageData) {
@@ -910,9 +1078,7 @@ function updateCropOverlay() {
                 );
                 
                 // 然后绘制裁剪区域边框
-                maskOverlayCtx.strokeStyle = 'rgba(0, 150, 255, 0.8)';
-                maskOverlayCtx.lineWidth = 3;
-                maskOverlayCtx.strokeRect(cropX, cropY, cropWidth, cropHeight);
+                strokeCrops();
             };
             maskImg.src = currentMaskImageData;
         } else {
@@ -922,12 +1088,10 @@ function updateCropOverlay() {
             maskOverlayCtx.fillRect(0, 0, maskOverlayCanvas.width, maskOverlayCanvas.height);
             
             // 清除裁剪区域内的遮罩（显示裁剪区域）
-            maskOverlayCtx.clearRect(cropX, cropY, cropWidth, cropHeight);
+            crops.forEach(crop => maskOverlayCtx.clearRect(crop.x, crop.y, crop.width, crop.height));
             
             // 绘制裁剪区域的边框（蓝色）
-            maskOverlayCtx.strokeStyle = 'rgba(0, 150, 255, 0.8)';
-            maskOverlayCtx.lineWidth = 3;
-            maskOverlayCtx.strokeRect(cropX, cropY, cropWidth, cropHeight);
+            strokeCrops();
         }
     };
     
@@ -948,7 +1112,8 @@ function downloadAllImages() {
     generatedImages.forEach((imgData, index) => {
         const link = document.createElement('a');
         link.href = imgData;
-        link.download = `sd3_inpaint_${currentImageIndex}_${index + 1}.png`;
+        const extension = imgData.substring(imgData.lastIndexOf('.'));
+        link.download = `sd3_inpaint_${currentImageIndex}_${index + 1}${extension}`;
         document.body.appendChild(link);
         link.click();
         document.body.removeChild(link);
@@ -996,6 +1161,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 if (generateBtn && data.loaded) {
                     generateBtn.disabled = false;
                     console.log('模型已加载，生成按钮已启用');
+                    refreshAdapterList();
                 }
             })
             .catch(error => {
@@ -0,0 +1,79 @@
+"""Activation checkpointing for a chosen subset of transformer blocks.
+
+`transformer.enable_gradient_checkpointing()` recomputes every block. Here only the selected blocks
+are recomputed, either given explicitly or picked so that the activations kept by the remaining
+blocks fit in a memory budget. Per-block activation sizes are measured once with a probe forward
+pass by counting the tensors autograd saves for backward.
+"""
+
+import functools
+
+import torch
+import torch.utils.checkpoint
+
+
+def _checkpointed_forward(forward):
+    @functools.wraps(forward)
+    def wrapper(*args, **kwargs):
+        if torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(forward, *args, use_reentrant=False, **kwargs)
+        return forward(*args, **kwargs)
+
+    return wrapper
+
+
+def enable_block_checkpointing(blocks, indices):
+    """Recompute the forward of `blocks[i]` for every `i` in `indices` during backward.
+
+    The block's `forward` is wrapped in place so module names (and LoRA state dict keys) are unchanged.
+    """
+    for index in indices:
+        block = blocks[index]
+        block.forward = _checkpointed_forward(block.forward)
+
+
+def measure_block_activation_bytes(model, blocks, run_forward):
+    """Return the bytes autograd saves for backward inside each block during `run_forward()`.
+
+    Storages owned by model parameters are not counted, and storages shared by several saved
+    tensors are counted once.
+    """
+    sizes = [0] * len(blocks)
+    current = [None]
+    seen = {p.untyped_storage().data_ptr() for p in model.parameters()}
+
+    def pack(tensor):
+        index = current[0]
+        if index is not None:
+            storage = tensor.untyped_storage()
+            if storage.data_ptr() not in seen:
+                seen.add(storage.data_ptr())
+                sizes[index] += storage.nbytes()
+        return tensor
+
+    handles = []
+    for index, block in enumerate(blocks):
+        handles.append(block.register_forward_pre_hook(lambda module, args, index=index: current.__setitem__(0, index)))
+        handles.append(block.register_forward_hook(lambda module, args, output: current.__setitem__(0, None)))
+    try:
+        with torch.enable_grad(), torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            run_forward()
+    finally:
+        for handle in handles:
+            handle.remove()
+    return sizes
+
+
+def select_blocks_for_budget(block_bytes, budget_bytes):
+    """Pick the fewest blocks to checkpoint so the activations of the others fit in `budget_bytes`.
+
+    The largest blocks are checkpointed first. Returns the sorted block indices.
+    """
+    total = sum(block_bytes)
+    selected = []
+    for index in sorted(range(len(block_bytes)), key=lambda i: block_bytes[i], reverse=True):
+        if total <= budget_bytes:
+            break
+        selected.append(index)
+        total -= block_bytes[index]
+    return sorted(selected)
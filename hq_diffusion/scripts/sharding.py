@@ -0,0 +1,82 @@
+"""Shard the frozen transformer across ranks with FSDP while the LoRA parameters stay replicated.
+
+Every transformer block becomes its own FSDP unit (FULL_SHARD), so each rank holds only a
+`1 / world_size` slice of the frozen base weights and gathers one block at a time during forward
+and backward. The LoRA parameters are passed to FSDP as ignored states: they are kept whole on
+every rank and their gradients are averaged with `all_reduce_gradients`, one coalesced
+collective per step. The model is not wrapped in DDP, so there is no unused-parameter search.
+
+Works with NCCL on GPUs and with gloo on CPU.
+"""
+
+import torch
+import torch.distributed as dist
+from torch.distributed.fsdp import FullyShardedDataParallel, ShardingStrategy
+from torch.distributed.fsdp.wrap import ModuleWrapPolicy
+
+
+FSDP_PREFIX = "_fsdp_wrapped_module."
+
+
+def shard_frozen_base(transformer, device):
+    """Wrap `transformer` in FSDP, sharding its frozen weights and ignoring (replicating) the trainable ones."""
+    trainable_params = [p for p in transformer.parameters() if p.requires_grad]
+    # Without a shared seed the adapters are initialized differently on every rank.
+    for param in trainable_params:
+        dist.broadcast(param.data, src=0)
+
+    block_classes = {type(block) for block in transformer.transformer_blocks}
+    return FullyShardedDataParallel(
+        transformer,
+        auto_wrap_policy=ModuleWrapPolicy(block_classes),
+        sharding_strategy=ShardingStrategy.FULL_SHARD,
+        ignored_states=trainable_params,
+        use_orig_params=True,
+        limit_all_gathers=True,
+        device_id=device if device.type == "cuda" else None,
+    )
+
+
+def all_reduce_gradients(params):
+    """Average the gradients of `params` over all ranks with a single coalesced all-reduce per dtype."""
+    grads_by_dtype = {}
+    for param in params:
+        if param.grad is not None:
+            grads_by_dtype.setdefault(param.grad.dtype, []).append(param.grad)
+
+    world_size = dist.get_world_size()
+    for grads in grads_by_dtype.values():
+        flat = torch._utils._flatten_dense_tensors(grads)
+        dist.all_reduce(flat)
+        flat.div_(world_size)
+        for grad, reduced in zip(grads, torch._utils._unflatten_dense_tensors(flat, grads)):
+            grad.copy_(reduced)
+
+
+def _peft_key(name, adapter_name):
+    return name.replace(FSDP_PREFIX, "").replace(f".{adapter_name}.", ".")
+
+
+def replicated_lora_state_dict(model, adapter_name="default"):
+    """The LoRA weights of an FSDP-wrapped model in PEFT format, without any collective call.
+
+    The LoRA parameters are ignored by FSDP, so every rank already holds them whole.
+    """
+    return {
+        _peft_key(name, adapter_name): param.detach().clone()
+        for name, param in model.named_parameters()
+        if "lora_" in name
+    }
+
+
+def load_replicated_lora_state_dict(model, state_dict, adapter_name="default"):
+    """Copy PEFT-format LoRA weights into an FSDP-wrapped model in place. Returns the keys that were not found."""
+    params = {_peft_key(name, adapter_name): param for name, param in model.named_parameters() if "lora_" in name}
+    missing = []
+    with torch.no_grad():
+        for key, param in params.items():
+            if key in state_dict:
+                param.copy_(state_dict[key].to(param.dtype))
+            else:
+                missing.append(key)
+    return missing
@@ -0,0 +1,92 @@
+"""Variance-reduced sampling of training timesteps.
+
+The default path draws every timestep independently from the weighting scheme's density
+(`compute_density_for_timestep_sampling`). `TimestepSampler` keeps that density as the target
+distribution `p` over the scheduler's timestep indices, splits the indices into contiguous buckets
+and picks buckets for a batch with systematic (stratified) sampling:
+
+- "stratified": buckets are drawn from `p` itself, so a batch covers the noise levels evenly and
+  no reweighting is needed.
+- "importance": buckets are drawn from `q_b ∝ p_b * sqrt(E[loss² | b])`, estimated from a running
+  per-bucket loss history and mixed with `p` so no bucket is starved. Each sample is reweighted
+  by `p_b / q_b`, so the expected loss is the same as under `p`.
+
+Within a bucket the index is always drawn from `p` restricted to the bucket. All state lives on
+the training device so sampling never synchronizes with the host.
+"""
+
+import torch
+
+
+class TimestepSampler:
+    def __init__(
+        self,
+        base_probs,
+        num_buckets=20,
+        mode="stratified",
+        history_decay=0.9,
+        uniform_mix=0.1,
+        min_bucket_samples=4,
+    ):
+        if mode not in ("stratified", "importance"):
+            raise ValueError(f"Unknown timestep sampling mode: {mode}")
+        num_timesteps = base_probs.shape[0]
+        num_buckets = min(num_buckets, num_timesteps)
+        device = base_probs.device
+
+        self.mode = mode
+        self.history_decay = history_decay
+        self.uniform_mix = uniform_mix
+        self.min_bucket_samples = min_bucket_samples
+        self.base_probs = base_probs.float().clamp(min=1e-12)
+        self.base_probs = self.base_probs / self.base_probs.sum()
+        self.bucket_ids = torch.arange(num_timesteps, device=device) * num_buckets // num_timesteps
+        self.bucket_probs = torch.zeros(num_buckets, device=device).scatter_add_(0, self.bucket_ids, self.base_probs)
+        self.loss_sq = torch.zeros(num_buckets, device=device)
+        self.counts = torch.zeros(num_buckets, device=device)
+
+    @classmethod
+    def from_density(cls, density_fn, num_timesteps, device, num_density_samples=1_000_000, **kwargs):
+        """Build the target distribution by histogramming `density_fn(batch_size)` samples in [0, 1)."""
+        u = density_fn(num_density_samples)
+        indices = (u * num_timesteps).long().clamp(0, num_timesteps - 1)
+        base_probs = torch.bincount(indices, minlength=num_timesteps).float() / num_density_samples
+        return cls(base_probs.to(device), **kwargs)
+
+    def bucket_distribution(self):
+        if self.mode == "stratified":
+            return self.bucket_probs
+        q = self.bucket_probs * self.loss_sq.sqrt().clamp(min=1e-12)
+        q = (1.0 - self.uniform_mix) * q / q.sum() + self.uniform_mix * self.bucket_probs
+        # Until every bucket has a loss estimate, sample from the target distribution.
+        warm = (self.counts >= self.min_bucket_samples).all()
+        return torch.where(warm, q, self.bucket_probs)
+
+    def sample(self, batch_size):
+        """Return `(indices, weights)`: timestep indices and the per-sample loss weights `p_b / q_b`."""
+        device = self.bucket_probs.device
+        q = self.bucket_distribution()
+        cdf = torch.cumsum(q, dim=0)
+        u = (torch.arange(batch_size, device=device) + torch.rand(1, device=device)) / batch_size
+        buckets = torch.searchsorted(cdf, u * cdf[-1]).clamp(max=q.shape[0] - 1)
+
+        in_bucket = self.bucket_ids[None, :] == buckets[:, None]
+        indices = torch.multinomial(self.base_probs[None, :] * in_bucket, 1).squeeze(1)
+        weights = self.bucket_probs[buckets] / q[buckets]
+
+        # Systematic sampling orders the samples by noise level, shuffle them across the batch.
+        perm = torch.randperm(batch_size, device=device)
+        return indices[perm], weights[perm]
+
+    def update(self, indices, losses):
+        """Add the unweighted per-sample losses of a step to the per-bucket loss history."""
+        buckets = self.bucket_ids[indices]
+        losses = losses.detach().float()
+        sums = torch.zeros_like(self.loss_sq).scatter_add_(0, buckets, losses**2)
+        counts = torch.zeros_like(self.counts).scatter_add_(0, buckets, torch.ones_like(losses))
+        mean_sq = sums / counts.clamp(min=1)
+        decayed = torch.where(
+            self.counts > 0, self.history_decay * self.loss_sq + (1.0 - self.history_decay) * mean_sq, mean_sq
+        )
+        self.loss_sq = torch.where(counts > 0, decayed, self.loss_sq)
+        self.counts += counts
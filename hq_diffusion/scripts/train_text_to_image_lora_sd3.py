@@ -27,56 +27,14 @@ from contextlib import nullcontext
 from pathlib import Path
 import json
 
-import numpy as np
 import torch
-import torch.utils.checkpoint
-import transformers
-from accelerate import Accelerator, DistributedType
-from accelerate.logging import get_logger
-from accelerate.utils import DistributedDataParallelKwargs, ProjectConfiguration, set_seed
-from huggingface_hub import create_repo, upload_folder
-from huggingface_hub.utils import insecure_hashlib
-from peft import LoraConfig, set_peft_model_state_dict
-from peft.utils import get_peft_model_state_dict
-from PIL import Image
-from PIL.ImageOps import exif_transpose
 from torch.utils.data import Dataset
-from torchvision import transforms
-from torchvision.transforms.functional import crop
-from tqdm.auto import tqdm
-from transformers import CLIPTokenizer, PretrainedConfig, T5TokenizerFast
-
-import diffusers
-from diffusers import (
-    AutoencoderKL,
-    FlowMatchEulerDiscreteScheduler,
-    SD3Transformer2DModel,
-    StableDiffusion3Pipeline,
-)
-from diffusers.optimization import get_scheduler
-from diffusers.training_utils import (
-    _set_state_dict_into_text_encoder,
-    cast_training_params,
-    compute_density_for_timestep_sampling,
-    compute_loss_weighting_for_sd3,
-    free_memory,
-)
-from diffusers.utils import (
-    check_min_version,
-    convert_unet_state_dict_to_peft,
-    is_wandb_available,
-)
-from diffusers.utils.hub_utils import load_or_create_model_card, populate_model_card
-from diffusers.utils.torch_utils import is_compiled_module
-
-
-if is_wandb_available():
-    import wandb
-
-# Will error if the minimal version of diffusers is not installed. Remove at your own risks.
-check_min_version("0.37.0.dev0")
-
-logger = get_logger(__name__)
+
+
+# Heavy dependencies (accelerate, diffusers, transformers, peft, huggingface_hub, torchvision, wandb, ...) are imported
+# where they are used, so `--help`, argument errors and spawned dataloader workers do not pay for them.
+# `logger` is replaced by the accelerate logger in `main`.
+logger = logging.getLogger(__name__)
 
 
 def save_model_card(
@@ -88,6 +46,8 @@ def save_model_card(
     validation_prompt=None,
     repo_folder=None,
 ):
+    from diffusers.utils.hub_utils import load_or_create_model_card, populate_model_card
+
     if "large" in base_model:
         model_variant = "SD3.5-Large"
         license_url = "https://huggingface.co/stabilityai/stable-diffusion-3.5-large/blob/main/LICENSE.md"
@@ -193,6 +153,9 @@ def log_validation(
     torch_dtype,
     is_final_validation=False,
 ):
+    import numpy as np
+    from diffusers.training_utils import free_memory
+
     logger.info(
         f"Running validation... \n Generating {args.num_validation_images} images with prompt:"
         f" {args.validation_prompt}."
@@ -214,6 +177,8 @@ def log_validation(
             np_images = np.stack([np.asarray(img) for img in images])
             tracker.writer.add_images(phase_name, np_images, epoch, dataformats="NHWC")
         if tracker.name == "wandb":
+            import wandb
+
             tracker.log(
                 {
                     phase_name: [
@@ -231,6 +196,8 @@ def log_validation(
 def import_model_class_from_model_name_or_path(
     pretrained_model_name_or_path: str, revision: str, subfolder: str = "text_encoder"
 ):
+    from transformers import PretrainedConfig
+
     text_encoder_config = PretrainedConfig.from_pretrained(
         pretrained_model_name_or_path, subfolder=subfolder, revision=revision
     )
@@ -342,6 +309,16 @@ def parse_args(input_args=None):
         default=77,
         help="Maximum sequence length to use with with the T5 text encoder",
     )
+    parser.add_argument(
+        "--text_seq_bucket_size",
+        type=int,
+        default=None,
+        help=(
+            "Trim the CLIP and T5 token sequences to the longest real prompt in the batch, rounded up to a multiple of"
+            " this size, instead of padding them to their maximum length. Short prompts then add far fewer text tokens"
+            " to the joint attention of every transformer block."
+        ),
+    )
     parser.add_argument(
         "--validation_prompt",
         type=str,
@@ -363,6 +340,36 @@ def parse_args(input_args=None):
             " `args.validation_prompt` multiple times: `args.num_validation_images`."
         ),
     )
+    parser.add_argument(
+        "--probe_steps",
+        type=int,
+        default=None,
+        help=(
+            "Evaluate the flow matching loss on a held-out probe set every X steps. The probe samples are removed from"
+            " the training data and use fixed noise and fixed timesteps, so the probe loss is comparable across steps."
+        ),
+    )
+    parser.add_argument(
+        "--num_probe_samples",
+        type=int,
+        default=8,
+        help="Number of instance images held out for the probe set.",
+    )
+    parser.add_argument(
+        "--early_stopping_patience",
+        type=int,
+        default=None,
+        help=(
+            "Stop training once the probe loss has not improved for this many consecutive probe evaluations. The best"
+            " adapter is always kept in `output_dir/best` when `--probe_steps` is set."
+        ),
+    )
+    parser.add_argument(
+        "--early_stopping_min_delta",
+        type=float,
+        default=0.0,
+        help="Minimum decrease of the probe loss that counts as an improvement for early stopping.",
+    )
     parser.add_argument(
         "--rank",
         type=int,
@@ -473,6 +480,34 @@ def parse_args(input_args=None):
         action="store_true",
         help="Whether or not to use gradient checkpointing to save memory at the expense of slower backward pass.",
     )
+    parser.add_argument(
+        "--gradient_checkpointing_blocks",
+        type=str,
+        default=None,
+        help=(
+            "Only checkpoint the given transformer blocks, as a comma separated list of block numbers"
+            ' (e.g. "0,1,2,3"), instead of all blocks as with `--gradient_checkpointing`.'
+        ),
+    )
+    parser.add_argument(
+        "--gradient_checkpointing_budget",
+        type=float,
+        default=None,
+        help=(
+            "Activation memory budget in GB for the transformer blocks. Per-block activation sizes are measured once at"
+            " startup and the fewest blocks needed to fit the budget are checkpointed."
+        ),
+    )
+    parser.add_argument(
+        "--base_quantization",
+        type=str,
+        default=None,
+        choices=["int8"],
+        help=(
+            "Store the frozen transformer block `Linear` weights in a compact format and dequantize them on the fly"
+            " (QLoRA-style). The LoRA parameters are kept in higher precision. Roughly halves the transformer memory."
+        ),
+    )
     parser.add_argument(
         "--learning_rate",
         type=float,
@@ -525,6 +560,29 @@ def parse_args(input_args=None):
         default="logit_normal",
         choices=["sigma_sqrt", "logit_normal", "mode", "cosmap"],
     )
+    parser.add_argument(
+        "--timestep_sampling",
+        type=str,
+        default="independent",
+        choices=["independent", "stratified", "importance"],
+        help=(
+            "How timesteps are drawn from the `--weighting_scheme` density. 'independent' samples every timestep"
+            " independently. 'stratified' spreads each batch over timestep buckets. 'importance' additionally favours"
+            " buckets with a high running loss and reweights the loss so the objective stays unbiased."
+        ),
+    )
+    parser.add_argument(
+        "--timestep_sampling_buckets",
+        type=int,
+        default=20,
+        help="Number of contiguous timestep buckets for `--timestep_sampling` 'stratified' and 'importance'.",
+    )
+    parser.add_argument(
+        "--timestep_loss_history_decay",
+        type=float,
+        default=0.9,
+        help="Decay of the running per-bucket loss history used by `--timestep_sampling=importance`.",
+    )
     parser.add_argument(
         "--logit_mean", type=float, default=0.0, help="mean to use when using the `'logit_normal'` weighting scheme."
     )
@@ -537,6 +595,16 @@ def parse_args(input_args=None):
         default=1.29,
         help="Scale of mode weighting scheme. Only effective when using the `'mode'` as the `weighting_scheme`.",
     )
+    parser.add_argument(
+        "--noise_samples_per_latent",
+        type=int,
+        default=1,
+        help=(
+            "Number of (timestep, noise) pairs drawn for every latent in a batch. The latents and text embeddings are"
+            " repeated so each fetched sample contributes several transformer samples without extra data loading or"
+            " encoding. The effective transformer batch size is `train_batch_size * noise_samples_per_latent`."
+        ),
+    )
     parser.add_argument(
         "--precondition_outputs",
         type=int,
@@ -557,6 +625,15 @@ def parse_args(input_args=None):
         help="Whether or not to use 8-bit Adam from bitsandbytes. Ignored if optimizer is not set to AdamW",
     )
 
+    parser.add_argument(
+        "--flat_lora_params",
+        action="store_true",
+        help=(
+            "Pack all trainable LoRA parameters and gradients into one contiguous buffer per dtype, so that grad-norm,"
+            " clipping and the optimizer step run as a few large fused/foreach operations."
+        ),
+    )
+
     parser.add_argument(
         "--adam_beta1", type=float, default=0.9, help="The beta1 parameter for the Adam and Prodigy optimizers."
     )
@@ -686,6 +763,15 @@ def parse_args(input_args=None):
             " 1.10.and an Nvidia Ampere GPU.  Default to  fp16 if a GPU is available else fp32."
         ),
     )
+    parser.add_argument(
+        "--shard_frozen_base",
+        action="store_true",
+        help=(
+            "For multi-process training: shard the frozen transformer weights across ranks with FSDP (one unit per"
+            " transformer block) instead of replicating the model with DDP. Only the LoRA parameters are replicated and"
+            " their gradients all-reduced. Works with NCCL and with gloo on CPU."
+        ),
+    )
     parser.add_argument("--local_rank", type=int, default=-1, help="For distributed training: local_rank")
 
     if input_args is not None:
@@ -703,6 +789,29 @@ def parse_args(input_args=None):
     if env_local_rank != -1 and env_local_rank != args.local_rank:
         args.local_rank = env_local_rank
 
+    if args.gradient_checkpointing_blocks is not None and args.gradient_checkpointing_budget is not None:
+        raise ValueError("Specify only one of `--gradient_checkpointing_blocks` or `--gradient_checkpointing_budget`")
+
+    if args.gradient_checkpointing and (
+        args.gradient_checkpointing_blocks is not None or args.gradient_checkpointing_budget is not None
+    ):
+        raise ValueError(
+            "`--gradient_checkpointing` checkpoints every block, it cannot be combined with"
+            " `--gradient_checkpointing_blocks` or `--gradient_checkpointing_budget`"
+        )
+
+    if args.shard_frozen_base:
+        if args.validation_prompt is not None:
+            raise ValueError("`--validation_prompt` is not supported with `--shard_frozen_base`")
+        if args.base_quantization is not None:
+            raise ValueError("`--base_quantization` cannot be combined with `--shard_frozen_base`")
+
+    if args.early_stopping_patience is not None and args.probe_steps is None:
+        raise ValueError("`--early_stopping_patience` requires `--probe_steps`")
+
+    if args.noise_samples_per_latent < 1:
+        raise ValueError("`--noise_samples_per_latent` must be at least 1")
+
     if args.with_prior_preservation:
         if args.class_data_dir is None:
             raise ValueError("You must specify a data directory for class images.")
@@ -735,6 +844,11 @@ class DreamBoothDataset(Dataset):
         repeats=1,
         center_crop=False,
     ):
+        from PIL import Image
+        from PIL.ImageOps import exif_transpose
+        from torchvision import transforms
+        from torchvision.transforms.functional import crop
+
         self.size = size
         self.center_crop = center_crop
 
@@ -817,6 +931,9 @@ class DreamBoothDataset(Dataset):
                 pass
             pass
 
+        # Every source image is repeated `repeats` times in a row.
+        self.repeats = repeats
+        self.num_source_images = len(instance_images)
         self.instance_images = []
         for img in instance_images:
             self.instance_images.extend(itertools.repeat(img, repeats))
@@ -855,12 +972,22 @@ class DreamBoothDataset(Dataset):
         if class_data_root is not None:
             self.class_data_root = Path(class_data_root)
             self.class_data_root.mkdir(parents=True, exist_ok=True)
-            self.class_images_path = list(self.class_data_root.iterdir())
+            self.class_images_path = list_class_images(self.class_data_root)
             if class_num is not None:
                 self.num_class_images = min(len(self.class_images_path), class_num)
             else:
                 self.num_class_images = len(self.class_images_path)
             self._length = max(self.num_class_images, self.num_instance_images)
+
+            # Use the latents saved by `generate_class_images` when every class image has them at this resolution.
+            self.class_latents_path = [
+                self.class_data_root / "latents" / f"{path.stem}.pt"
+                for path in self.class_images_path[: self.num_class_images]
+            ]
+            if not self.class_latents_path or not all(path.exists() for path in self.class_latents_path):
+                self.class_latents_path = None
+            elif torch.load(self.class_latents_path[0])["resolution"] != size:
+                self.class_latents_path = None
         else:
             self.class_data_root = None
 
@@ -876,22 +1003,57 @@ class DreamBoothDataset(Dataset):
     def __len__(self):
         return self._length
 
+    def get_instance_prompt(self, index):
+        if self.custom_instance_prompts:
+            caption = self.custom_instance_prompts[index % self.num_instance_images]
+            if caption:
+                return caption
+        # custom prompts were provided, but length does not match size of image dataset
+        return self.instance_prompt
+
+    def hold_out(self, num_samples):
+        """
+        Remove the last `num_samples` source images, with all their `--repeats` copies, from the dataset and return
+        the pixel values and prompts of one copy of each.
+        """
+        if num_samples >= self.num_source_images:
+            raise ValueError(
+                f"Cannot hold out {num_samples} samples from a dataset of {self.num_source_images} instance images."
+            )
+        num_copies = num_samples * self.repeats
+        indices = range(self.num_instance_images - num_copies, self.num_instance_images, self.repeats)
+        pixel_values = torch.stack([self.pixel_values[i] for i in indices])
+        prompts = [self.get_instance_prompt(i) for i in indices]
+
+        if self.custom_instance_prompts:
+            # Captions from a dataset column are repeated like the images, the ones from metadata.jsonl are not.
+            if len(self.custom_instance_prompts) == self.num_instance_images:
+                del self.custom_instance_prompts[-num_copies:]
+            elif len(self.custom_instance_prompts) == self.num_source_images:
+                del self.custom_instance_prompts[-num_samples:]
+        del self.pixel_values[-num_copies:]
+        del self.instance_images[-num_copies:]
+        self.num_source_images -= num_samples
+        self.num_instance_images -= num_copies
+        if self.class_data_root is not None:
+            self._length = max(self.num_class_images, self.num_instance_images)
+        else:
+            self._length = self.num_instance_images
+        return pixel_values, prompts
+
     def __getitem__(self, index):
         example = {}
         instance_image = self.pixel_values[index % self.num_instance_images]
         example["instance_images"] = instance_image
+        example["instance_prompt"] = self.get_instance_prompt(index)
 
-        if self.custom_instance_prompts:
-            caption = self.custom_instance_prompts[index % self.num_instance_images]
-            if caption:
-                example["instance_prompt"] = caption
-            else:
-                example["instance_prompt"] = self.instance_prompt
-
-        else:  # custom prompts were provided, but length does not match size of image dataset
-            example["instance_prompt"] = self.instance_prompt
+        if self.class_data_root and self.class_latents_path is not None:
+            example["class_latents"] = torch.load(self.class_latents_path[index % self.num_class_images])["latents"]
+            example["class_prompt"] = self.class_prompt
+        elif self.class_data_root:
+            from PIL import Image
+            from PIL.ImageOps import exif_transpose
 
-        if self.class_data_root:
             class_image = Image.open(self.class_images_path[index % self.num_class_images])
             class_image = exif_transpose(class_image)
 
@@ -903,20 +1065,161 @@ class DreamBoothDataset(Dataset):
         return example
 
 
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+
+
+def list_class_images(class_data_root):
+    return sorted(path for path in Path(class_data_root).iterdir() if path.suffix.lower() in IMAGE_EXTENSIONS)
+
+
+def missing_class_image_indices(class_images_dir, num_class_images):
+    """
+    Indices in `range(num_class_images)` that still need a class image. Generated images are named
+    `{index}-{hash}.jpg`, so an interrupted generation resumes where it stopped.
+    """
+    class_images = list_class_images(class_images_dir)
+    existing = set()
+    for path in class_images:
+        prefix = path.stem.split("-")[0]
+        if prefix.isdigit():
+            existing.add(int(prefix))
+    num_missing = max(0, num_class_images - len(class_images))
+    return [index for index in range(num_class_images) if index not in existing][:num_missing]
+
+
+def generate_class_images(pipeline, args, class_images_dir, indices, disable_progress_bar=False):
+    """
+    Generate the class images for `indices` with an already loaded pipeline.
+
+    The class prompt is encoded once. Generation starts at `--sample_batch_size` images per call and halves the batch
+    on out-of-memory errors. Each image is seeded by its index, so the result does not depend on the batching or on the
+    number of ranks. JPEG encoding, hashing and saving run in a background thread pool. The generated latents are
+    saved next to the images in `latents/`, so training can use them without encoding the images with the VAE again.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from diffusers.training_utils import free_memory
+    from huggingface_hub.utils import insecure_hashlib
+    from tqdm.auto import tqdm
+
+    device = pipeline._execution_device
+    latents_dir = class_images_dir / "latents"
+    # Sampling calls `set_timesteps` on the scheduler, which is also the training noise scheduler.
+    training_scheduler = pipeline.scheduler
+    pipeline.scheduler = copy.deepcopy(training_scheduler)
+    latents_dir.mkdir(exist_ok=True)
+
+    with torch.no_grad():
+        prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds = (
+            pipeline.encode_prompt(
+                prompt=args.class_prompt,
+                prompt_2=None,
+                prompt_3=None,
+                device=device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=True,
+                max_sequence_length=args.max_sequence_length,
+            )
+        )
+
+    def save(index, image, latents):
+        hash_image = insecure_hashlib.sha1(image.tobytes()).hexdigest()
+        stem = f"{index}-{hash_image}"
+        torch.save({"latents": latents, "resolution": args.resolution}, latents_dir / f"{stem}.pt")
+        # The image is written last: its presence marks the index as done when resuming.
+        image.save(class_images_dir / f"{stem}.jpg")
+
+    batch_size = args.sample_batch_size
+    position = 0
+    progress_bar = tqdm(total=len(indices), desc="Generating class images", disable=disable_progress_bar)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = []
+        while position < len(indices):
+            batch_indices = indices[position : position + batch_size]
+            n = len(batch_indices)
+            seed = args.seed if args.seed is not None else 0
+            generators = [torch.Generator(device=device).manual_seed(seed + index) for index in batch_indices]
+            try:
+                with torch.no_grad():
+                    latents = pipeline(
+                        prompt_embeds=prompt_embeds.repeat(n, 1, 1),
+                        negative_prompt_embeds=negative_prompt_embeds.repeat(n, 1, 1),
+                        pooled_prompt_embeds=pooled_prompt_embeds.repeat(n, 1),
+                        negative_pooled_prompt_embeds=negative_pooled_prompt_embeds.repeat(n, 1),
+                        height=args.resolution,
+                        width=args.resolution,
+                        generator=generators,
+                        output_type="latent",
+                    ).images
+                    images = pipeline.vae.decode(
+                        latents / pipeline.vae.config.scaling_factor + pipeline.vae.config.shift_factor,
+                        return_dict=False,
+                    )[0]
+            except torch.cuda.OutOfMemoryError:
+                if batch_size == 1:
+                    raise
+                batch_size = max(1, batch_size // 2)
+                free_memory()
+                logger.warning(f"Out of memory while generating class images, retrying with batch size {batch_size}")
+                continue
+
+            images = pipeline.image_processor.postprocess(images, output_type="pil")
+            latents = latents.to("cpu", dtype=torch.float32)
+            for index, image, image_latents in zip(batch_indices, images, latents):
+                futures.append(pool.submit(save, index, image, image_latents.clone()))
+            position += n
+            progress_bar.update(n)
+
+        for future in futures:
+            future.result()
+    progress_bar.close()
+    pipeline.scheduler = training_scheduler
+
+
+class LossPlateauTracker:
+    """Tracks the best probe loss and how many evaluations passed without an improvement."""
+
+    def __init__(self, patience=None, min_delta=0.0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_loss = float("inf")
+        self.num_bad_evaluations = 0
+
+    def update(self, loss):
+        """Record a probe loss. Returns True if it is a new best."""
+        if loss < self.best_loss - self.min_delta:
+            self.best_loss = loss
+            self.num_bad_evaluations = 0
+            return True
+        self.num_bad_evaluations += 1
+        return False
+
+    @property
+    def should_stop(self):
+        return self.patience is not None and self.num_bad_evaluations >= self.patience
+
+
 def collate_fn(examples, with_prior_preservation=False):
     pixel_values = [example["instance_images"] for example in examples]
     prompts = [example["instance_prompt"] for example in examples]
 
     # Concat class and instance examples for prior preservation.
     # We do this to avoid doing two forward passes.
+    class_latents = None
     if with_prior_preservation:
-        pixel_values += [example["class_images"] for example in examples]
+        if "class_latents" in examples[0]:
+            class_latents = torch.stack([example["class_latents"] for example in examples])
+        else:
+            pixel_values += [example["class_images"] for example in examples]
         prompts += [example["class_prompt"] for example in examples]
 
     pixel_values = torch.stack(pixel_values)
     pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
 
     batch = {"pixel_values": pixel_values, "prompts": prompts}
+    if class_latents is not None:
+        # Already scaled and shifted latents from class image generation, appended after the instance latents.
+        batch["class_latents"] = class_latents
     return batch
 
 
@@ -937,6 +1240,12 @@ class PromptDataset(Dataset):
         return example
 
 
+def bucketed_sequence_length(attention_mask, bucket_size):
+    """Length of the longest real sequence in `attention_mask`, rounded up to a multiple of `bucket_size`."""
+    longest = int(attention_mask.sum(dim=1).max())
+    return min(attention_mask.shape[1], max(1, math.ceil(longest / bucket_size)) * bucket_size)
+
+
 def tokenize_prompt(tokenizer, prompt):
     text_inputs = tokenizer(
         prompt,
@@ -957,10 +1266,12 @@ def _encode_prompt_with_t5(
     num_images_per_prompt=1,
     device=None,
     text_input_ids=None,
+    trim_bucket_size=None,
 ):
     prompt = [prompt] if isinstance(prompt, str) else prompt
     batch_size = len(prompt)
 
+    attention_mask = None
     if tokenizer is not None:
         text_inputs = tokenizer(
             prompt,
@@ -971,12 +1282,17 @@ def _encode_prompt_with_t5(
             return_tensors="pt",
         )
         text_input_ids = text_inputs.input_ids
+        attention_mask = text_inputs.attention_mask
     else:
         if text_input_ids is None:
             raise ValueError("text_input_ids must be provided when the tokenizer is not specified")
 
     prompt_embeds = text_encoder(text_input_ids.to(device))[0]
 
+    # The encoder still runs at full length so the embeddings of the real tokens are unchanged by trimming.
+    if trim_bucket_size is not None and attention_mask is not None:
+        prompt_embeds = prompt_embeds[:, : bucketed_sequence_length(attention_mask, trim_bucket_size)]
+
     dtype = text_encoder.dtype
     prompt_embeds = prompt_embeds.to(dtype=dtype, device=device)
 
@@ -996,10 +1312,12 @@ def _encode_prompt_with_clip(
     device=None,
     text_input_ids=None,
     num_images_per_prompt: int = 1,
+    trim_bucket_size=None,
 ):
     prompt = [prompt] if isinstance(prompt, str) else prompt
     batch_size = len(prompt)
 
+    attention_mask = None
     if tokenizer is not None:
         text_inputs = tokenizer(
             prompt,
@@ -1010,6 +1328,7 @@ def _encode_prompt_with_clip(
         )
 
         text_input_ids = text_inputs.input_ids
+        attention_mask = text_inputs.attention_mask
     else:
         if text_input_ids is None:
             raise ValueError("text_input_ids must be provided when the tokenizer is not specified")
@@ -1020,6 +1339,10 @@ def _encode_prompt_with_clip(
     prompt_embeds = prompt_embeds.hidden_states[-2]
     prompt_embeds = prompt_embeds.to(dtype=text_encoder.dtype, device=device)
 
+    # CLIP attention is causal, so dropping the trailing padding does not change the real tokens' embeddings.
+    if trim_bucket_size is not None and attention_mask is not None:
+        prompt_embeds = prompt_embeds[:, : bucketed_sequence_length(attention_mask, trim_bucket_size)]
+
     _, seq_len, _ = prompt_embeds.shape
     # duplicate text embeddings for each generation per prompt, using mps friendly method
     prompt_embeds = prompt_embeds.repeat(1, num_images_per_prompt, 1)
@@ -1036,6 +1359,7 @@ def encode_prompt(
     device=None,
     num_images_per_prompt: int = 1,
     text_input_ids_list=None,
+    trim_bucket_size=None,
 ):
     prompt = [prompt] if isinstance(prompt, str) else prompt
 
@@ -1052,6 +1376,7 @@ def encode_prompt(
             device=device if device is not None else text_encoder.device,
             num_images_per_prompt=num_images_per_prompt,
             text_input_ids=text_input_ids_list[i] if text_input_ids_list else None,
+            trim_bucket_size=trim_bucket_size,
         )
         clip_prompt_embeds_list.append(prompt_embeds)
         clip_pooled_prompt_embeds_list.append(pooled_prompt_embeds)
@@ -1067,6 +1392,7 @@ def encode_prompt(
         num_images_per_prompt=num_images_per_prompt,
         text_input_ids=text_input_ids_list[-1] if text_input_ids_list else None,
         device=device if device is not None else text_encoders[-1].device,
+        trim_bucket_size=trim_bucket_size,
     )
 
     clip_prompt_embeds = torch.nn.functional.pad(
@@ -1077,7 +1403,94 @@ def encode_prompt(
     return prompt_embeds, pooled_prompt_embeds
 
 
+def repeat_for_noise_samples(tensor, batch_size, num_samples):
+    """Repeat each of the `batch_size` rows of `tensor` `num_samples` times, keeping the rows of a sample adjacent.
+
+    Tensors that are shared across the batch (e.g. a single static prompt embedding) are returned unchanged.
+    """
+    if num_samples == 1 or tensor.shape[0] != batch_size:
+        return tensor
+    return tensor.repeat_interleave(num_samples, dim=0)
+
+
+def flow_matching_loss(model_pred, target, weighting, with_prior_preservation=False, timestep_weights=None):
+    """Weighted MSE of the flow matching objective.
+
+    With prior preservation the batch is the instance rows followed by the class rows (each half already repeated for
+    the noise samples), and `model_pred`, `target`, `weighting` and `timestep_weights` are all split in the same place.
+    `timestep_weights` are the importance weights p / q of the timestep sampler, which make the expected loss match
+    sampling from the weighting scheme density.
+
+    Returns `(loss, prior_loss, sample_losses)`: the instance and class losses averaged over their rows (`prior_loss`
+    is None without prior preservation) and the unweighted per-row losses in batch order.
+    """
+    num_parts = 2 if with_prior_preservation else 1
+    parts = zip(
+        torch.chunk(model_pred, num_parts, dim=0),
+        torch.chunk(target, num_parts, dim=0),
+        torch.chunk(weighting, num_parts, dim=0),
+        torch.chunk(timestep_weights, num_parts, dim=0) if timestep_weights is not None else [None] * num_parts,
+    )
+    losses = []
+    sample_losses = []
+    for part_pred, part_target, part_weighting, part_timestep_weights in parts:
+        part_losses = torch.mean(
+            (part_weighting.float() * (part_pred.float() - part_target.float()) ** 2).reshape(part_target.shape[0], -1),
+            1,
+        )
+        sample_losses.append(part_losses)
+        if part_timestep_weights is not None:
+            part_losses = part_losses * part_timestep_weights
+        losses.append(part_losses.mean())
+    return losses[0], losses[1] if with_prior_preservation else None, torch.cat(sample_losses)
+
+
 def main(args):
+    global logger
+
+    import transformers
+    from accelerate import Accelerator, DistributedType
+    from accelerate.logging import get_logger
+    from accelerate.utils import DistributedDataParallelKwargs, ProjectConfiguration, set_seed
+    from peft import LoraConfig, set_peft_model_state_dict
+    from peft.utils import get_peft_model_state_dict
+    from tqdm.auto import tqdm
+
+    import diffusers
+    from diffusers import SD3Transformer2DModel, StableDiffusion3Pipeline
+    from diffusers.optimization import get_scheduler
+    from diffusers.training_utils import (
+        _set_state_dict_into_text_encoder,
+        cast_training_params,
+        compute_density_for_timestep_sampling,
+        compute_loss_weighting_for_sd3,
+        free_memory,
+    )
+    from diffusers.utils import check_min_version, convert_unet_state_dict_to_peft, is_wandb_available
+    from diffusers.utils.torch_utils import is_compiled_module
+
+    from flat_optimizer import flatten_param_groups, fused_adamw_kwargs
+    from quantization import quantize_linear_weights
+    from selective_checkpointing import (
+        enable_block_checkpointing,
+        measure_block_activation_bytes,
+        select_blocks_for_budget,
+    )
+    from timestep_sampling import TimestepSampler
+
+    if args.shard_frozen_base:
+        from sharding import (
+            all_reduce_gradients,
+            load_replicated_lora_state_dict,
+            replicated_lora_state_dict,
+            shard_frozen_base,
+        )
+
+    # Will error if the minimal version of diffusers is not installed. Remove at your own risks.
+    check_min_version("0.37.0.dev0")
+
+    logger = get_logger(__name__)
+
     if args.train_text_encoder:
         raise RuntimeError("Training the text encoder is not supported for Stable Diffusion 3 models.")
     if args.report_to == "wandb" and args.hub_token is not None:
@@ -1130,58 +1543,14 @@ def main(args):
     if args.seed is not None:
         set_seed(args.seed)
 
-    # Generate class images if prior preservation is enabled.
-    if args.with_prior_preservation:
-        class_images_dir = Path(args.class_data_dir)
-        if not class_images_dir.exists():
-            class_images_dir.mkdir(parents=True)
-        cur_class_images = len(list(class_images_dir.iterdir()))
-
-        if cur_class_images < args.num_class_images:
-            has_supported_fp16_accelerator = torch.cuda.is_available() or torch.backends.mps.is_available()
-            torch_dtype = torch.float16 if has_supported_fp16_accelerator else torch.float32
-            if args.prior_generation_precision == "fp32":
-                torch_dtype = torch.float32
-            elif args.prior_generation_precision == "fp16":
-                torch_dtype = torch.float16
-            elif args.prior_generation_precision == "bf16":
-                torch_dtype = torch.bfloat16
-            pipeline = StableDiffusion3Pipeline.from_pretrained(
-                args.pretrained_model_name_or_path,
-                torch_dtype=torch_dtype,
-                revision=args.revision,
-                variant=args.variant,
-            )
-            pipeline.set_progress_bar_config(disable=True)
-
-            num_new_images = args.num_class_images - cur_class_images
-            logger.info(f"Number of class images to sample: {num_new_images}.")
-
-            sample_dataset = PromptDataset(args.class_prompt, num_new_images)
-            sample_dataloader = torch.utils.data.DataLoader(sample_dataset, batch_size=args.sample_batch_size)
-
-            sample_dataloader = accelerator.prepare(sample_dataloader)
-            pipeline.to(accelerator.device)
-
-            for example in tqdm(
-                sample_dataloader, desc="Generating class images", disable=not accelerator.is_local_main_process
-            ):
-                images = pipeline(example["prompt"]).images
-
-                for i, image in enumerate(images):
-                    hash_image = insecure_hashlib.sha1(image.tobytes()).hexdigest()
-                    image_filename = class_images_dir / f"{example['index'][i] + cur_class_images}-{hash_image}.jpg"
-                    image.save(image_filename)
-
-            del pipeline
-            free_memory()
-
     # Handle the repository creation
     if accelerator.is_main_process:
         if args.output_dir is not None:
             os.makedirs(args.output_dir, exist_ok=True)
 
         if args.push_to_hub:
+            from huggingface_hub import create_repo
+
             repo_id = create_repo(
                 repo_id=args.hub_model_id or Path(args.output_dir).name,
                 exist_ok=True,
@@ -1190,6 +1559,39 @@ def main(args):
     # Load the tokenizers
     pipe = StableDiffusion3Pipeline.from_single_file(
         args.pretrained_model_name_or_path, torch_dtype=torch.float16)
+
+    # Generate class images if prior preservation is enabled, reusing the components loaded above.
+    if args.with_prior_preservation:
+        class_images_dir = Path(args.class_data_dir)
+        class_images_dir.mkdir(parents=True, exist_ok=True)
+        # All ranks must list the directory before any of them starts writing, or they slice different lists.
+        accelerator.wait_for_everyone()
+        missing_indices = missing_class_image_indices(class_images_dir, args.num_class_images)
+
+        if missing_indices:
+            has_supported_fp16_accelerator = torch.cuda.is_available() or torch.backends.mps.is_available()
+            torch_dtype = torch.float16 if has_supported_fp16_accelerator else torch.float32
+            if args.prior_generation_precision == "fp32":
+                torch_dtype = torch.float32
+            elif args.prior_generation_precision == "fp16":
+                torch_dtype = torch.float16
+            elif args.prior_generation_precision == "bf16":
+                torch_dtype = torch.bfloat16
+            pipe.to(accelerator.device, dtype=torch_dtype)
+            pipe.set_progress_bar_config(disable=True)
+
+            logger.info(f"Number of class images to sample: {len(missing_indices)}.")
+            # Every rank generates its own share of the missing images.
+            generate_class_images(
+                pipe,
+                args,
+                class_images_dir,
+                missing_indices[accelerator.process_index :: accelerator.num_processes],
+                disable_progress_bar=not accelerator.is_local_main_process,
+            )
+            free_memory()
+        accelerator.wait_for_everyone()
+
     # pipe = pipe.to(torch_dtype=torch.float32)
     # tokenizer_one = CLIPTokenizer.from_pretrained(
     #     args.pretrained_model_name_or_path,
@@ -1268,6 +1670,16 @@ def main(args):
             "Mixed precision training with bfloat16 is not supported on MPS. Please use fp16 (recommended) or fp32 instead."
         )
 
+    if args.base_quantization == "int8":
+        # Quantize before the move below. Normally the transformer is still on the CPU here, so the full-precision
+        # weights never reach the GPU; if class images were just generated it is already on the device and is
+        # quantized there, layer by layer, releasing each full-precision weight as it is replaced.
+        num_converted, bytes_before, bytes_after = quantize_linear_weights(transformer)
+        logger.info(
+            f"Quantized {num_converted} transformer Linear layers to int8:"
+            f" {bytes_before / 1024**3:.2f} GB -> {bytes_after / 1024**3:.2f} GB"
+        )
+
     vae.to(accelerator.device, dtype=torch.float32)
     transformer.to(accelerator.device, dtype=weight_dtype)
     text_encoder_one.to(accelerator.device, dtype=weight_dtype)
@@ -1319,6 +1731,49 @@ def main(args):
         text_encoder_one.add_adapter(text_lora_config)
         text_encoder_two.add_adapter(text_lora_config)
 
+    # Selective activation checkpointing is set up after the LoRA layers are added, as they add activations too.
+    if args.gradient_checkpointing_blocks is not None:
+        checkpointed_blocks = [int(block.strip()) for block in args.gradient_checkpointing_blocks.split(",")]
+        enable_block_checkpointing(transformer.transformer_blocks, checkpointed_blocks)
+        logger.info(f"Gradient checkpointing transformer blocks {checkpointed_blocks}")
+    elif args.gradient_checkpointing_budget is not None:
+        # Measure with a single sample and scale, so the probe itself fits even when the full batch does not.
+        vae_scale_factor = 2 ** (len(vae.config.block_out_channels) - 1)
+        latent_size = args.resolution // vae_scale_factor
+        text_seq_len = 77 + args.max_sequence_length
+
+        def run_probe_forward():
+            with accelerator.autocast():
+                transformer(
+                    hidden_states=torch.randn(
+                        1, transformer.config.in_channels, latent_size, latent_size,
+                        device=accelerator.device, dtype=weight_dtype,
+                    ),
+                    timestep=torch.tensor([500.0], device=accelerator.device),
+                    encoder_hidden_states=torch.randn(
+                        1, text_seq_len, transformer.config.joint_attention_dim,
+                        device=accelerator.device, dtype=weight_dtype,
+                    ),
+                    pooled_projections=torch.randn(
+                        1, transformer.config.pooled_projection_dim, device=accelerator.device, dtype=weight_dtype
+                    ),
+                    return_dict=False,
+                )
+
+        block_bytes = measure_block_activation_bytes(transformer, transformer.transformer_blocks, run_probe_forward)
+        samples_per_step = (
+            args.train_batch_size * (2 if args.with_prior_preservation else 1) * args.noise_samples_per_latent
+        )
+        block_bytes = [size * samples_per_step for size in block_bytes]
+        checkpointed_blocks = select_blocks_for_budget(block_bytes, args.gradient_checkpointing_budget * 1024**3)
+        enable_block_checkpointing(transformer.transformer_blocks, checkpointed_blocks)
+        logger.info(
+            f"Block activations: {sum(block_bytes) / 1024**3:.2f} GB in total, budget"
+            f" {args.gradient_checkpointing_budget:.2f} GB. Gradient checkpointing"
+            f" {len(checkpointed_blocks)}/{len(block_bytes)} transformer blocks: {checkpointed_blocks}"
+        )
+        free_memory()
+
     def unwrap_model(model):
         model = accelerator.unwrap_model(model)
         model = model._orig_mod if is_compiled_module(model) else model
@@ -1354,6 +1809,10 @@ def main(args):
                 if weights:
                     weights.pop()
 
+            if args.shard_frozen_base:
+                # The sharded transformer is not prepared by the accelerator, so it is not in `models`.
+                transformer_lora_layers_to_save = replicated_lora_state_dict(transformer)
+
             StableDiffusion3Pipeline.save_lora_weights(
                 output_dir,
                 transformer_lora_layers=transformer_lora_layers_to_save,
@@ -1362,6 +1821,16 @@ def main(args):
             )
 
     def load_model_hook(models, input_dir):
+        if args.shard_frozen_base:
+            lora_state_dict_ = StableDiffusion3Pipeline.lora_state_dict(input_dir)
+            transformer_state_dict = {
+                k.replace("transformer.", "", 1): v for k, v in lora_state_dict_.items() if k.startswith("transformer.")
+            }
+            missing_keys = load_replicated_lora_state_dict(transformer, transformer_state_dict)
+            if missing_keys:
+                logger.warning(f"LoRA weights missing from {input_dir}: {missing_keys}")
+            return
+
         transformer_ = None
         text_encoder_one_ = None
         text_encoder_two_ = None
@@ -1473,6 +1942,10 @@ def main(args):
     else:
         params_to_optimize = [transformer_parameters_with_lr]
 
+    if args.flat_lora_params:
+        # The LoRA parameters become views into one flat buffer per dtype; the optimizer only sees the flat buffers.
+        params_to_optimize = flatten_param_groups(params_to_optimize)
+
     # Optimizer creation
     if not (args.optimizer.lower() == "prodigy" or args.optimizer.lower() == "adamw"):
         logger.warning(
@@ -1500,11 +1973,16 @@ def main(args):
         else:
             optimizer_class = torch.optim.AdamW
 
+        optimizer_kwargs = {}
+        if args.flat_lora_params and optimizer_class is torch.optim.AdamW:
+            optimizer_kwargs = fused_adamw_kwargs(params_to_optimize)
+
         optimizer = optimizer_class(
             params_to_optimize,
             betas=(args.adam_beta1, args.adam_beta2),
             weight_decay=args.adam_weight_decay,
             eps=args.adam_epsilon,
+            **optimizer_kwargs,
         )
 
     if args.optimizer.lower() == "prodigy":
@@ -1553,6 +2031,10 @@ def main(args):
         center_crop=args.center_crop,
     )
 
+    # Hold out the probe samples before the dataloader is built so they are never trained on.
+    if args.probe_steps is not None:
+        probe_pixel_values, probe_prompts = train_dataset.hold_out(args.num_probe_samples)
+
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
         batch_size=args.train_batch_size,
@@ -1568,7 +2050,11 @@ def main(args):
         def compute_text_embeddings(prompt, text_encoders, tokenizers):
             with torch.no_grad():
                 prompt_embeds, pooled_prompt_embeds = encode_prompt(
-                    text_encoders, tokenizers, prompt, args.max_sequence_length
+                    text_encoders,
+                    tokenizers,
+                    prompt,
+                    args.max_sequence_length,
+                    trim_bucket_size=args.text_seq_bucket_size,
                 )
                 prompt_embeds = prompt_embeds.to(accelerator.device)
                 pooled_prompt_embeds = pooled_prompt_embeds.to(accelerator.device)
@@ -1577,18 +2063,51 @@ def main(args):
     # If no type of tuning is done on the text_encoder and custom instance prompts are NOT
     # provided (i.e. the --instance_prompt is used for all images), we encode the instance prompt once to avoid
     # the redundant encoding.
-    if not args.train_text_encoder and not train_dataset.custom_instance_prompts:
+    # Trimmed embeddings of different prompts can differ in length, so when the static instance and class embeddings
+    # are concatenated below they are encoded in one batch to get the same length.
+    encode_static_prompts_together = (
+        args.text_seq_bucket_size is not None
+        and args.with_prior_preservation
+        and not args.train_text_encoder
+        and not train_dataset.custom_instance_prompts
+    )
+    if encode_static_prompts_together:
+        static_prompt_hidden_states, static_pooled_prompt_embeds = compute_text_embeddings(
+            [args.instance_prompt, args.class_prompt], text_encoders, tokenizers
+        )
+        instance_prompt_hidden_states, class_prompt_hidden_states = static_prompt_hidden_states.chunk(2)
+        instance_pooled_prompt_embeds, class_pooled_prompt_embeds = static_pooled_prompt_embeds.chunk(2)
+    elif not args.train_text_encoder and not train_dataset.custom_instance_prompts:
         instance_prompt_hidden_states, instance_pooled_prompt_embeds = compute_text_embeddings(
             args.instance_prompt, text_encoders, tokenizers
         )
 
     # Handle class prompt for prior-preservation.
-    if args.with_prior_preservation:
+    if args.with_prior_preservation and not encode_static_prompts_together:
         if not args.train_text_encoder:
             class_prompt_hidden_states, class_pooled_prompt_embeds = compute_text_embeddings(
                 args.class_prompt, text_encoders, tokenizers
             )
 
+    # Encode the probe set once, while the VAE and the text encoders are still loaded. The noise and the timesteps are
+    # fixed so the probe loss only changes with the adapter weights.
+    if args.probe_steps is not None:
+        with torch.no_grad():
+            probe_latents = vae.encode(probe_pixel_values.to(accelerator.device, dtype=vae.dtype)).latent_dist.mean
+            probe_latents = (probe_latents - vae.config.shift_factor) * vae.config.scaling_factor
+            probe_latents = probe_latents.to(dtype=weight_dtype)
+        probe_prompt_embeds, probe_pooled_prompt_embeds = compute_text_embeddings(
+            probe_prompts, text_encoders, tokenizers
+        )
+        probe_generator = torch.Generator().manual_seed(args.seed if args.seed is not None else 0)
+        probe_noise = torch.randn(probe_latents.shape, generator=probe_generator).to(probe_latents)
+        probe_indices = torch.linspace(
+            0, noise_scheduler_copy.config.num_train_timesteps - 1, args.num_probe_samples
+        ).long()
+        probe_timesteps = noise_scheduler_copy.timesteps[probe_indices].to(device=accelerator.device)
+        probe_tracker = LossPlateauTracker(args.early_stopping_patience, args.early_stopping_min_delta)
+        del probe_pixel_values
+
     # Clear the memory here
     if not args.train_text_encoder and not train_dataset.custom_instance_prompts:
         # Explicitly delete the objects as well, otherwise only the lists are deleted and the original references remain, preventing garbage collection
@@ -1653,7 +2172,12 @@ def main(args):
     )
 
     # Prepare everything with our `accelerator`.
-    if args.train_text_encoder:
+    if args.shard_frozen_base:
+        # The sharded transformer is not handed to `accelerator.prepare`, which would wrap it in DDP.
+        # The LoRA gradients are all-reduced explicitly after each backward instead.
+        transformer = shard_frozen_base(transformer, accelerator.device)
+        optimizer, train_dataloader, lr_scheduler = accelerator.prepare(optimizer, train_dataloader, lr_scheduler)
+    elif args.train_text_encoder:
         (
             transformer,
             text_encoder_one,
@@ -1693,6 +2217,8 @@ def main(args):
     logger.info(f"  Num batches each epoch = {len(train_dataloader)}")
     logger.info(f"  Num Epochs = {args.num_train_epochs}")
     logger.info(f"  Instantaneous batch size per device = {args.train_batch_size}")
+    if args.noise_samples_per_latent > 1:
+        logger.info(f"  Noise samples per latent = {args.noise_samples_per_latent}")
     logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
     logger.info(f"  Gradient Accumulation steps = {args.gradient_accumulation_steps}")
     logger.info(f"  Total optimization steps = {args.max_train_steps}")
@@ -1746,6 +2272,60 @@ def main(args):
             sigma = sigma.unsqueeze(-1)
         return sigma
 
+    def compute_probe_loss():
+        # One batched forward over the whole probe set, with the same loss as training.
+        transformer.eval()
+        with torch.no_grad(), accelerator.autocast():
+            sigmas = get_sigmas(probe_timesteps, n_dim=probe_latents.ndim, dtype=probe_latents.dtype)
+            noisy_model_input = (1.0 - sigmas) * probe_latents + sigmas * probe_noise
+            model_pred = transformer(
+                hidden_states=noisy_model_input,
+                timestep=probe_timesteps,
+                encoder_hidden_states=probe_prompt_embeds,
+                pooled_projections=probe_pooled_prompt_embeds,
+                return_dict=False,
+            )[0]
+            if args.precondition_outputs:
+                model_pred = model_pred * (-sigmas) + noisy_model_input
+                target = probe_latents
+            else:
+                target = probe_noise - probe_latents
+            weighting = compute_loss_weighting_for_sd3(weighting_scheme=args.weighting_scheme, sigmas=sigmas)
+            probe_loss = torch.mean((weighting.float() * (model_pred.float() - target.float()) ** 2))
+        transformer.train()
+        # Average over the ranks so that every rank makes the same early stopping decision.
+        return accelerator.reduce(probe_loss.detach(), reduction="mean").item()
+
+    def save_best_adapter():
+        if args.shard_frozen_base:
+            transformer_lora_layers = replicated_lora_state_dict(transformer)
+        else:
+            transformer_lora_layers = get_peft_model_state_dict(unwrap_model(transformer))
+        StableDiffusion3Pipeline.save_lora_weights(
+            save_directory=os.path.join(args.output_dir, "best"),
+            transformer_lora_layers=transformer_lora_layers,
+        )
+
+    stop_training = False
+
+    timestep_sampler = None
+    if args.timestep_sampling != "independent":
+        timestep_sampler = TimestepSampler.from_density(
+            lambda batch_size: compute_density_for_timestep_sampling(
+                weighting_scheme=args.weighting_scheme,
+                batch_size=batch_size,
+                logit_mean=args.logit_mean,
+                logit_std=args.logit_std,
+                mode_scale=args.mode_scale,
+            ),
+            num_timesteps=noise_scheduler_copy.config.num_train_timesteps,
+            device=accelerator.device,
+            num_buckets=args.timestep_sampling_buckets,
+            mode=args.timestep_sampling,
+            history_decay=args.timestep_loss_history_decay,
+        )
+        schedule_timesteps = noise_scheduler_copy.timesteps.to(accelerator.device)
+
     for epoch in range(first_epoch, args.num_train_epochs):
         transformer.train()
         if args.train_text_encoder:
@@ -1799,6 +2379,22 @@ def main(args):
 
                 model_input = (model_input - vae_config_shift_factor) * vae_config_scaling_factor
                 model_input = model_input.to(dtype=weight_dtype)
+                if "class_latents" in batch:
+                    model_input = torch.cat(
+                        [model_input, batch["class_latents"].to(device=model_input.device, dtype=weight_dtype)], dim=0
+                    )
+
+                # Reuse every latent and its conditioning for several noise levels. `repeat_interleave` keeps the
+                # instance and class halves contiguous for the prior preservation chunking below. The static prompt
+                # embeddings are shared across steps, so the repeated copies get their own names.
+                num_latents = model_input.shape[0]
+                model_input = repeat_for_noise_samples(model_input, num_latents, args.noise_samples_per_latent)
+                step_prompt_embeds = repeat_for_noise_samples(
+                    prompt_embeds, num_latents, args.noise_samples_per_latent
+                )
+                step_pooled_prompt_embeds = repeat_for_noise_samples(
+                    pooled_prompt_embeds, num_latents, args.noise_samples_per_latent
+                )
 
                 # Sample noise that we'll add to the latents
                 noise = torch.randn_like(model_input)
@@ -1806,15 +2402,19 @@ def main(args):
 
                 # Sample a random timestep for each image
                 # for weighting schemes where we sample timesteps non-uniformly
-                u = compute_density_for_timestep_sampling(
-                    weighting_scheme=args.weighting_scheme,
-                    batch_size=bsz,
-                    logit_mean=args.logit_mean,
-                    logit_std=args.logit_std,
-                    mode_scale=args.mode_scale,
-                )
-                indices = (u * noise_scheduler_copy.config.num_train_timesteps).long()
-                timesteps = noise_scheduler_copy.timesteps[indices].to(device=model_input.device)
+                if timestep_sampler is not None:
+                    indices, timestep_weights = timestep_sampler.sample(bsz)
+                    timesteps = schedule_timesteps[indices]
+                else:
+                    u = compute_density_for_timestep_sampling(
+                        weighting_scheme=args.weighting_scheme,
+                        batch_size=bsz,
+                        logit_mean=args.logit_mean,
+                        logit_std=args.logit_std,
+                        mode_scale=args.mode_scale,
+                    )
+                    indices = (u * noise_scheduler_copy.config.num_train_timesteps).long()
+                    timesteps = noise_scheduler_copy.timesteps[indices].to(device=model_input.device)
 
                 # Add noise according to flow matching.
                 # zt = (1 - texp) * x + texp * z1
@@ -1825,8 +2425,8 @@ def main(args):
                 model_pred = transformer(
                     hidden_states=noisy_model_input,
                     timestep=timesteps,
-                    encoder_hidden_states=prompt_embeds,
-                    pooled_projections=pooled_prompt_embeds,
+                    encoder_hidden_states=step_prompt_embeds,
+                    pooled_projections=step_pooled_prompt_embeds,
                     return_dict=False,
                 )[0]
 
@@ -1845,45 +2445,41 @@ def main(args):
                 else:
                     target = noise - model_input
 
-                if args.with_prior_preservation:
-                    # Chunk the noise and model_pred into two parts and compute the loss on each part separately.
-                    model_pred, model_pred_prior = torch.chunk(model_pred, 2, dim=0)
-                    target, target_prior = torch.chunk(target, 2, dim=0)
-
-                    # Compute prior loss
-                    prior_loss = torch.mean(
-                        (weighting.float() * (model_pred_prior.float() - target_prior.float()) ** 2).reshape(
-                            target_prior.shape[0], -1
-                        ),
-                        1,
-                    )
-                    prior_loss = prior_loss.mean()
-
-                # Compute regular loss.
-                loss = torch.mean(
-                    (weighting.float() * (model_pred.float() - target.float()) ** 2).reshape(target.shape[0], -1),
-                    1,
+                loss, prior_loss, sample_losses = flow_matching_loss(
+                    model_pred,
+                    target,
+                    weighting,
+                    with_prior_preservation=args.with_prior_preservation,
+                    timestep_weights=timestep_weights if timestep_sampler is not None else None,
                 )
-                loss = loss.mean()
+                if timestep_sampler is not None:
+                    # The history gets the unweighted losses, in the same order as `indices`.
+                    timestep_sampler.update(indices, sample_losses)
 
                 if args.with_prior_preservation:
                     # Add the prior loss to the instance loss.
                     loss = loss + args.prior_loss_weight * prior_loss
 
                 accelerator.backward(loss)
+                if accelerator.sync_gradients and args.shard_frozen_base and accelerator.num_processes > 1:
+                    all_reduce_gradients(transformer_lora_parameters)
                 if accelerator.sync_gradients:
-                    params_to_clip = (
-                        itertools.chain(
-                            transformer_lora_parameters, text_lora_parameters_one, text_lora_parameters_two
+                    if args.flat_lora_params:
+                        params_to_clip = [p for group in params_to_optimize for p in group["params"]]
+                    else:
+                        params_to_clip = (
+                            itertools.chain(
+                                transformer_lora_parameters, text_lora_parameters_one, text_lora_parameters_two
+                            )
+                            if args.train_text_encoder
+                            else transformer_lora_parameters
                         )
-                        if args.train_text_encoder
-                        else transformer_lora_parameters
-                    )
                     accelerator.clip_grad_norm_(params_to_clip, args.max_grad_norm)
 
                 optimizer.step()
                 lr_scheduler.step()
-                optimizer.zero_grad()
+                # The flat gradient buffers are shared with the LoRA parameters, so they must be zeroed in place.
+                optimizer.zero_grad(set_to_none=not args.flat_lora_params)
 
             # Checks if the accelerator has performed an optimization step behind the scenes
             if accelerator.sync_gradients:
@@ -1917,10 +2513,26 @@ def main(args):
                         logger.info(f"Saved state to {save_path}")
 
             logs = {"loss": loss.detach().item(), "lr": lr_scheduler.get_last_lr()[0]}
+
+            # Every rank evaluates the probe set and gets the same all-reduced loss, so they all stop at the same step.
+            if args.probe_steps is not None and accelerator.sync_gradients and global_step % args.probe_steps == 0:
+                probe_loss = compute_probe_loss()
+                logs["probe_loss"] = probe_loss
+                if probe_tracker.update(probe_loss):
+                    if accelerator.is_main_process:
+                        save_best_adapter()
+                        logger.info(f"New best probe loss {probe_loss:.5f} at step {global_step}, saved adapter")
+                elif probe_tracker.should_stop:
+                    logger.info(
+                        f"Probe loss has not improved on {probe_tracker.best_loss:.5f} for"
+                        f" {probe_tracker.num_bad_evaluations} evaluations, stopping at step {global_step}"
+                    )
+                    stop_training = True
+
             progress_bar.set_postfix(**logs)
             accelerator.log(logs, step=global_step)
 
-            if global_step >= args.max_train_steps:
+            if global_step >= args.max_train_steps or stop_training:
                 break
 
         if accelerator.is_main_process:
@@ -1962,15 +2574,24 @@ def main(args):
                     del pipeline
                     free_memory()
 
+        if stop_training:
+            break
+
     # Save the lora layers
     accelerator.wait_for_everyone()
     if accelerator.is_main_process:
-        transformer = unwrap_model(transformer)
-        if args.upcast_before_saving:
-            transformer.to(torch.float32)
+        if args.shard_frozen_base:
+            save_dtype = torch.float32 if args.upcast_before_saving else weight_dtype
+            transformer_lora_layers = {
+                k: v.to(save_dtype) for k, v in replicated_lora_state_dict(transformer).items()
+            }
         else:
-            transformer = transformer.to(weight_dtype)
-        transformer_lora_layers = get_peft_model_state_dict(transformer)
+            transformer = unwrap_model(transformer)
+            if args.upcast_before_saving:
+                transformer.to(torch.float32)
+            else:
+                transformer = transformer.to(weight_dtype)
+            transformer_lora_layers = get_peft_model_state_dict(transformer)
 
         if args.train_text_encoder:
             text_encoder_one = unwrap_model(text_encoder_one)
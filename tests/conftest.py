@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The training and inpaint-tool scripts import their sibling modules directly, as when run from their directories.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in ("hq_diffusion/scripts", "hq_diffusion/scripts/sd3_inpaint_tool"):
+    sys.path.insert(0, os.path.join(ROOT, path))
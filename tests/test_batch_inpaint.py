@@ -0,0 +1,40 @@
+import argparse
+import json
+
+import pytest
+from PIL import Image
+
+from batch_inpaint import group_by_image, load_image_items, read_coco_manifest
+
+diffusers_image_processor = pytest.importorskip("diffusers.image_processor")
+
+
+class _Pipe:
+    image_processor = diffusers_image_processor.VaeImageProcessor()
+    mask_processor = diffusers_image_processor.VaeImageProcessor(do_normalize=False, do_binarize=True, do_convert_grayscale=True)
+
+
+def test_coco_annotations_of_one_image_share_a_single_decode(tmp_path):
+    for name in ('a.png', 'b.png'):
+        Image.new('RGB', (640, 480), 'gray').save(tmp_path / name)
+    coco = {
+        'images': [{'id': 1, 'file_name': 'a.png'}, {'id': 2, 'file_name': 'b.png'}],
+        'categories': [{'id': 1, 'name': 'crack'}],
+        'annotations': [
+            {'id': 1, 'image_id': 1, 'category_id': 1, 'bbox': [10, 10, 40, 40]},
+            {'id': 2, 'image_id': 2, 'category_id': 1, 'bbox': [10, 10, 40, 40]},
+            {'id': 3, 'image_id': 1, 'category_id': 1, 'bbox': [300, 200, 60, 30]},
+        ],
+    }
+    (tmp_path / 'coco.json').write_text(json.dumps(coco))
+    args = argparse.Namespace(
+        categories=None, prompt_template='defect of {category}', negative_prompt='', num_variants=1, seed=0, padding=None,
+    )
+    items = read_coco_manifest(str(tmp_path / 'coco.json'), str(tmp_path), args)
+
+    groups = group_by_image(items)
+    assert [[item['id'] for item in group] for group in groups] == [['ann1', 'ann3'], ['ann2']]
+    loaded = load_image_items(groups[0], _Pipe)
+    assert [item['id'] for item in loaded] == ['ann1', 'ann3']
+    assert loaded[0]['original'] is loaded[1]['original']
+    assert loaded[0]['crop_box'] != loaded[1]['crop_box']
@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from train_text_to_image_lora_sd3 import flow_matching_loss, repeat_for_noise_samples
+
+
+def _per_row(pred, target, weighting):
+    return ((weighting * (pred - target) ** 2).reshape(pred.shape[0], -1)).mean(1)
+
+
+@pytest.mark.parametrize("batch_size,noise_samples", [(1, 1), (1, 2), (2, 3)])
+def test_prior_preservation_with_several_noise_samples(batch_size, noise_samples):
+    torch.manual_seed(0)
+    # Instance latents followed by class latents, each repeated for the noise samples as in the training step.
+    latents = torch.randn(2 * batch_size, 4, 8, 8)
+    rows = repeat_for_noise_samples(latents, 2 * batch_size, noise_samples).shape[0]
+    model_pred = torch.randn(rows, 4, 8, 8)
+    target = torch.randn(rows, 4, 8, 8)
+    weighting = torch.rand(rows, 1, 1, 1)
+    timestep_weights = torch.rand(rows)
+
+    loss, prior_loss, sample_losses = flow_matching_loss(
+        model_pred, target, weighting, with_prior_preservation=True, timestep_weights=timestep_weights
+    )
+
+    half = rows // 2
+    expected = _per_row(model_pred, target, weighting)
+    torch.testing.assert_close(sample_losses, expected)
+    torch.testing.assert_close(loss, (expected[:half] * timestep_weights[:half]).mean())
+    torch.testing.assert_close(prior_loss, (expected[half:] * timestep_weights[half:]).mean())
+
+
+def test_without_prior_preservation():
+    model_pred = torch.randn(4, 4, 8, 8)
+    target = torch.randn(4, 4, 8, 8)
+    weighting = torch.rand(4, 1, 1, 1)
+
+    loss, prior_loss, sample_losses = flow_matching_loss(model_pred, target, weighting)
+
+    assert prior_loss is None
+    torch.testing.assert_close(loss, _per_row(model_pred, target, weighting).mean())
+    assert sample_losses.shape == (4,)
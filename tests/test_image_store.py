@@ -0,0 +1,29 @@
+import io
+import os
+
+from PIL import Image
+
+from image_store import ImageStore
+
+
+def png_bytes(color):
+    buffered = io.BytesIO()
+    Image.new('RGB', (8, 8), color).save(buffered, format='PNG')
+    return buffered.getvalue()
+
+
+def test_shared_directory_evicts_least_recently_used_files(tmp_path):
+    uploads = [png_bytes(color) for color in ('red', 'green', 'blue')]
+    store = ImageStore(directory=str(tmp_path), max_file_bytes=len(uploads[0]) + len(uploads[2]))
+    first, _ = store.put_bytes(uploads[0])
+    second, _ = store.put_bytes(uploads[1])
+    os.utime(tmp_path / first, (0, 0))
+    os.utime(tmp_path / second, (1, 1))
+    assert store.get(first) is not None  # reading refreshes the file's mtime
+    third, _ = store.put_bytes(uploads[2])
+
+    assert sorted(os.listdir(tmp_path)) == sorted([first, third])
+    # another process sharing the directory sees the evicted id as expired
+    other = ImageStore(directory=str(tmp_path))
+    assert other.get(second) is None
+    assert other.get(first) is not None
@@ -0,0 +1,43 @@
+import threading
+import time
+
+from job_queue import JobQueue
+
+
+def test_cancel_job_while_worker_is_forming_a_group():
+    groups = []
+    handled = threading.Event()
+
+    def handler(jobs):
+        groups.append([job.params for job in jobs])
+        handled.set()
+        return [{} for _ in jobs]
+
+    queue = JobQueue(handler, batch_key=lambda job: 'same', batch_window=0.5, max_batch_jobs=4)
+    first = queue.submit('first')
+    time.sleep(0.1)  # the worker has taken `first` and waits for compatible jobs
+    assert queue.cancel(first.id).status == 'cancelled'
+    second = queue.submit('second')
+
+    assert handled.wait(5)
+    assert second.done.wait(5)
+    assert groups == [['second']]
+    assert first.status == 'cancelled' and second.status == 'done'
+
+
+def test_finished_jobs_release_their_params():
+    blocker = threading.Event()
+
+    def handler(jobs):
+        blocker.wait(5)
+        raise RuntimeError('boom')
+
+    queue = JobQueue(handler, max_backlog=2)
+    running = queue.submit({'original_image': 'running'})
+    queued = queue.submit({'original_image': 'queued'})
+    assert queue.cancel(queued.id).status == 'cancelled'
+    assert queued.params is None
+
+    blocker.set()
+    assert running.done.wait(5)
+    assert running.status == 'failed' and running.params is None
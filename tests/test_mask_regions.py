@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from batch_inpaint import resize_to_crop
+from mask_regions import crop_region_box, fill_model_input
+
+diffusers_image_processor = pytest.importorskip("diffusers.image_processor")
+
+
+class _Pipe:
+    image_processor = diffusers_image_processor.VaeImageProcessor()
+    mask_processor = diffusers_image_processor.VaeImageProcessor(do_normalize=False, do_binarize=True, do_convert_grayscale=True)
+
+
+def test_fill_model_input_round_trips_a_non_square_crop():
+    # A mask next to the short border of the image gives a crop box clamped to 440 x 300.
+    image = np.zeros((300, 1000, 3), dtype=np.uint8)
+    image[:, 620:] = 255
+    image[150:, :, 0] = 128
+    image = Image.fromarray(image)
+    mask = Image.new('L', image.size, 0)
+    mask.paste(255, (600, 100, 640, 200))
+    crop_box = crop_region_box((600, 100, 40, 100), 200, image.width, image.height, 512, 512)
+    x1, y1, x2, y2 = crop_box
+    assert (x2 - x1, y2 - y1) == (440, 300)
+
+    model_image, model_mask = fill_model_input(_Pipe, image.crop(crop_box), mask.crop(crop_box), 512, 512)
+    assert model_image.size == model_mask.size == (512, 512)
+
+    # An identity "model": pasting its output back must line up with the original crop and the mask.
+    restored = np.asarray(resize_to_crop(_Pipe, model_image, crop_box)).astype(int)
+    original = np.asarray(image.crop(crop_box)).astype(int)
+    assert restored.shape == original.shape
+    assert np.abs(restored - original).mean() < 1
+    restored_mask = np.asarray(resize_to_crop(_Pipe, model_mask.convert('RGB'), crop_box).convert('L')) > 127
+    assert (restored_mask == (np.asarray(mask.crop(crop_box)) > 127)).mean() > 0.999
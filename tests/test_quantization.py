@@ -0,0 +1,46 @@
+import torch
+
+from quantization import Int8Linear
+
+
+def _reference_linear(quantized):
+    linear = torch.nn.Linear(quantized.in_features, quantized.out_features)
+    with torch.no_grad():
+        linear.weight.copy_(quantized.dequantize())
+        linear.bias.copy_(quantized.bias)
+    return linear
+
+
+def test_int8_linear_matches_linear_output_and_grads():
+    torch.manual_seed(0)
+    quantized = Int8Linear.from_linear(torch.nn.Linear(32, 16))
+    quantized.bias.requires_grad_(True)
+    reference = _reference_linear(quantized)
+
+    x = torch.randn(2, 5, 32, requires_grad=True)
+    x_ref = x.detach().clone().requires_grad_(True)
+    out = quantized(x)
+    out_ref = reference(x_ref)
+    torch.testing.assert_close(out, out_ref)
+
+    grad = torch.randn_like(out)
+    out.backward(grad)
+    out_ref.backward(grad)
+    torch.testing.assert_close(x.grad, x_ref.grad)
+    torch.testing.assert_close(quantized.bias.grad, reference.bias.grad)
+    assert quantized.weight.grad is None
+
+
+def test_int8_linear_saves_only_int8_weight_for_backward():
+    quantized = Int8Linear.from_linear(torch.nn.Linear(32, 16))
+    saved = []
+
+    def pack(tensor):
+        saved.append(tensor)
+        return tensor
+
+    x = torch.randn(4, 32, requires_grad=True)
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        quantized(x).sum().backward()
+    weights = [tensor for tensor in saved if tensor.shape == quantized.weight.shape]
+    assert weights and all(tensor.dtype == torch.int8 for tensor in weights)
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+import torch
+from safetensors import safe_open
+
+from reduce_lora_rank import lora_pairs, reduce_lora_rank, save_reduced
+
+diffusers = pytest.importorskip("diffusers")
+peft = pytest.importorskip("peft")
+
+
+def _tiny_transformer():
+    return diffusers.SD3Transformer2DModel(
+        sample_size=8,
+        patch_size=2,
+        in_channels=4,
+        num_layers=2,
+        attention_head_dim=8,
+        num_attention_heads=2,
+        joint_attention_dim=16,
+        caption_projection_dim=16,
+        pooled_projection_dim=16,
+        out_channels=4,
+    )
+
+
+def _lora_state_dict(transformer, rank):
+    """A trained-looking LoRA (alpha == rank) whose modules have updates of different effective rank."""
+    torch.manual_seed(0)
+    state_dict = {}
+    for i, (name, module) in enumerate(
+        (name, module) for name, module in transformer.named_modules() if name.endswith(("to_q", "to_k", "to_v"))
+    ):
+        effective_rank = 1 + i % rank
+        lora_A = torch.zeros(rank, module.in_features)
+        lora_B = torch.zeros(module.out_features, rank)
+        lora_A[:effective_rank] = torch.randn(effective_rank, module.in_features)
+        lora_B[:, :effective_rank] = torch.randn(module.out_features, effective_rank)
+        state_dict[f"transformer.{name}.lora_A.weight"] = lora_A
+        state_dict[f"transformer.{name}.lora_B.weight"] = lora_B
+    return state_dict
+
+
+def test_energy_reduced_adapter_round_trips_with_per_module_ranks(tmp_path):
+    transformer = _tiny_transformer()
+    state_dict = _lora_state_dict(transformer, rank=4)
+    reduced, report = reduce_lora_rank(state_dict, energy=0.999)
+    assert len({entry["new_rank"] for entry in report}) > 1
+
+    path = tmp_path / "pytorch_lora_weights.safetensors"
+    save_reduced(reduced, report, str(path))
+    with safe_open(str(path), framework="pt") as f:
+        metadata = json.loads(f.metadata()["lora_adapter_metadata"])
+    assert metadata["transformer.rank_pattern"] == metadata["transformer.alpha_pattern"] != {}
+
+    transformer.load_lora_adapter(str(path), prefix="transformer", adapter_name="reduced")
+
+    pairs, _ = lora_pairs(state_dict)
+    modules = dict(transformer.named_modules())
+    for entry in report:
+        layer = modules[entry["module"].removeprefix("transformer.")]
+        assert layer.r["reduced"] == entry["new_rank"]
+        assert layer.scaling["reduced"] == 1.0
+        lora_A, lora_B = pairs[entry["module"]]
+        loaded_update = layer.lora_B["reduced"].weight @ layer.lora_A["reduced"].weight
+        torch.testing.assert_close(loaded_update * layer.scaling["reduced"], lora_B @ lora_A, atol=1e-4, rtol=1e-4)